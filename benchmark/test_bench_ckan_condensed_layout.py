@@ -0,0 +1,118 @@
+"""Benchmark access to condensed files via HTTP for different layouts
+
+Run in the test environment (CKAN with MinIO, see the GitHub Actions
+workflow) with::
+
+    pytest --ckan-ini=/srv/app/ckan.ini \
+        benchmark/test_bench_ckan_condensed_layout.py
+
+For every layout of the condensed file (see :mod:`ckanext.dc_serve.layout`),
+the time for opening the public condensed file via HTTP and reading the
+first feature ("deform") is measured. The file is read without caching,
+one HTTP range request per read operation of HDF5, so the number of
+range requests (in "extra_info") reflects the layout and not the cache
+of a particular client.
+"""
+import io
+import pathlib
+from unittest import mock
+
+import h5py
+import pytest
+import requests
+
+from dcor_shared import s3cc
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = (pathlib.Path(__file__).parent.parent
+             / "ckanext" / "dc_serve" / "tests" / "data")
+
+DATASETS = ["calibration_beads_47", "cytoshot_blood"]
+
+#: Configuration options for the condensed file layouts
+LAYOUTS = {
+    "default": {},
+    "paged": {"ckanext.dc_serve.condense_page_size": "65536"},
+    "paged-chunked": {"ckanext.dc_serve.condense_page_size": "65536",
+                      "ckanext.dc_serve.condense_chunk_bytes": "4194304"},
+    "paged-chunked-gzip": {"ckanext.dc_serve.condense_page_size": "65536",
+                           "ckanext.dc_serve.condense_chunk_bytes": "4194304",
+                           "ckanext.dc_serve.condense_compression": "gzip"},
+}
+
+
+class RangeRequestFile(io.RawIOBase):
+    """Read-only file object for a URL with one range request per read"""
+
+    def __init__(self, url):
+        super(RangeRequestFile, self).__init__()
+        self.url = url
+        self.session = requests.Session()
+        self.length = int(
+            self.session.head(url).headers["Content-Length"])
+        self.position = 0
+        #: Number of range requests so far
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.length + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        stop = min(self.position + len(buffer), self.length)
+        if stop <= self.position:
+            return 0
+        response = self.session.get(
+            self.url, headers={"Range": f"bytes={self.position}-{stop - 1}"})
+        self.requests += 1
+        data = response.content
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_first_feature(url):
+    """Open the HDF5 file at `url` and read "deform"
+
+    Returns the number of range requests.
+    """
+    with RangeRequestFile(url) as fd, h5py.File(fd, "r") as h5:
+        h5["events"]["deform"][:]
+        return fd.requests
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+@pytest.mark.parametrize("name", DATASETS)
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_bench_ckan_condensed_layout(enqueue_job_mock, benchmark, ckan_config,
+                                     monkeypatch, name, layout):
+    benchmark.group = f"condensed-layout-{name}"
+    for key, value in LAYOUTS[layout].items():
+        monkeypatch.setitem(ckan_config, key, value)
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / f"{name}.rtdc",
+        activate=True)
+    url = s3cc.get_s3_url_for_artifact(res_dict["id"], "condensed")
+
+    with RangeRequestFile(url) as fd:
+        benchmark.extra_info["file_bytes"] = fd.length
+    benchmark.extra_info["range_requests"] = open_first_feature(url)
+    benchmark.pedantic(open_first_feature, args=(url,), rounds=5)
@@ -0,0 +1,64 @@
+"""Benchmark the number of database queries per dcserv request
+
+Run with::
+
+    pytest --ckan-ini=/srv/app/ckan.ini benchmark/test_bench_ckan_db_queries.py
+
+The number of SQL statements executed per request is stored in the
+"extra_info" of each benchmark (shown with ``--benchmark-verbose`` or
+in the JSON output via ``--benchmark-json``).
+"""
+import pathlib
+from unittest import mock
+
+from ckan import model
+import pytest
+import sqlalchemy
+
+from ckanext.dc_serve import serve
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = (pathlib.Path(__file__).parent.parent
+             / "ckanext" / "dc_serve" / "tests" / "data")
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+@pytest.mark.parametrize("ttl", [0, 60])
+def test_bench_ckan_dcserv_db_queries(enqueue_job_mock, app, benchmark,
+                                      ckan_config, monkeypatch, ttl):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.resource_info_ttl",
+                        str(ttl))
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    params = {"id": res_dict["id"], "query": "metadata"}
+    # warm up all caches
+    app.get("/api/3/action/dcserv", params=params, status=200)
+
+    counter = QueryCounter()
+    sqlalchemy.event.listen(model.meta.engine, "before_cursor_execute",
+                            counter)
+    rounds = 20
+    try:
+        benchmark.pedantic(app.get,
+                           args=("/api/3/action/dcserv",),
+                           kwargs={"params": params, "status": 200},
+                           rounds=rounds)
+    finally:
+        sqlalchemy.event.remove(model.meta.engine, "before_cursor_execute",
+                                counter)
+    benchmark.group = "dcserv-db-queries"
+    benchmark.extra_info["db_queries_per_request"] = counter.count / rounds
+    serve._resource_info_cache.clear()
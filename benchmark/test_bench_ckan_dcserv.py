@@ -0,0 +1,184 @@
+"""Benchmark dcserv queries against the S3 object store
+
+Run in the test environment (CKAN with MinIO, see the GitHub Actions
+workflow) with::
+
+    pytest --ckan-ini=/srv/app/ckan.ini benchmark/test_bench_ckan_dcserv.py
+
+Every dcserv query is benchmarked for a cold kernel cache (the kernel
+is loaded from the kernel artifact on S3) and for a warm kernel cache.
+The datasets are the files bundled with the tests and a synthetically
+enlarged file with large tables and logs. In addition, the time for
+building a kernel from the original and condensed files on S3, the
+time for extracting the tables and logs from either the original or
+the condensed file, the time for serializing tables, and
+the size and allocated memory per kernel (in "extra_info") are
+measured.
+
+Compare runs with ``--benchmark-autosave`` and ``--benchmark-compare``.
+"""
+import pathlib
+import shutil
+import tracemalloc
+from unittest import mock
+
+from ckan.tests import helpers
+import dclab
+from dcor_shared import s3cc
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+import numpy as np
+import pytest
+
+from ckanext.dc_serve import kernel_cache, serve
+
+
+data_path = (pathlib.Path(__file__).parent.parent
+             / "ckanext" / "dc_serve" / "tests" / "data")
+
+#: Number of rows of the table and lines of the log in the enlarged file
+ENLARGED_SIZE = 200_000
+
+DATASETS = ["calibration_beads_47", "cytoshot_blood", "enlarged"]
+
+#: Resource IDs of the datasets created for this benchmark session
+_resources = {}
+
+
+def make_enlarged_file(path):
+    """Copy cytoshot_blood.rtdc and add a large table and a large log"""
+    shutil.copy2(data_path / "cytoshot_blood.rtdc", path)
+    rng = np.random.default_rng(42)
+    table = {"frame": np.arange(ENLARGED_SIZE),
+             "time": np.arange(ENLARGED_SIZE) / 2000,
+             "brightness": rng.normal(size=ENLARGED_SIZE),
+             "temperature": np.full(ENLARGED_SIZE, 23.5),
+             }
+    table["brightness"][::97] = np.nan
+    with dclab.RTDCWriter(path) as hw:
+        hw.store_table("enlarged_sensors", table)
+        hw.store_log("enlarged_log",
+                     [f"line {ii}: frame processed" for ii in
+                      range(ENLARGED_SIZE)])
+    return path
+
+
+@pytest.fixture
+def resource_id(request, with_plugins, tmp_path_factory):
+    """Return the ID of a resource for the dataset `request.param`
+
+    The datasets are only created once per benchmark session.
+    """
+    name = request.param
+    if not _resources:
+        helpers.reset_db()
+    if name not in _resources:
+        if name == "enlarged":
+            path = make_enlarged_file(
+                tmp_path_factory.mktemp("enlarged") / "enlarged.rtdc")
+        else:
+            path = data_path / f"{name}.rtdc"
+        with mock.patch('ckan.plugins.toolkit.enqueue_job',
+                        side_effect=synchronous_enqueue_job):
+            _, res_dict = make_dataset_via_s3(resource_path=path,
+                                              activate=True)
+        _resources[name] = res_dict["id"]
+    return _resources[name]
+
+
+def clear_kernel_cache():
+    kernel_cache.get_kernel_cache().clear()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.parametrize("resource_id", DATASETS, indirect=True)
+@pytest.mark.parametrize("query", serve.DCSERV_QUERIES)
+@pytest.mark.parametrize("cache", ["cold", "warm"])
+def test_bench_ckan_dcserv_query(app, benchmark, resource_id, query, cache):
+    benchmark.group = f"dcserv-{query}-{cache}"
+    params = {"id": resource_id, "query": query}
+    # warm up everything (including the kernel cache)
+    app.get("/api/3/action/dcserv", params=params, status=200)
+    benchmark.pedantic(
+        app.get,
+        args=("/api/3/action/dcserv",),
+        kwargs={"params": params, "status": 200},
+        setup=clear_kernel_cache if cache == "cold" else None,
+        rounds=10,
+        warmup_rounds=0)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.parametrize("resource_id", DATASETS, indirect=True)
+def test_bench_ckan_kernel_build(benchmark, resource_id):
+    """Build a kernel from the original and condensed files on S3"""
+    benchmark.group = "kernel-build"
+    bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+
+    def build():
+        return serve.get_resource_kernel_from_s3(resource_id, public=True,
+                                                 bucket_name=bucket_name)
+
+    tracemalloc.start()
+    try:
+        r_data = build()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["kernel_bytes"] = \
+        kernel_cache.estimate_kernel_size(r_data)
+    benchmark.extra_info["build_peak_memory_bytes"] = peak
+    benchmark.pedantic(build, rounds=3, warmup_rounds=0)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.parametrize("resource_id", DATASETS, indirect=True)
+@pytest.mark.parametrize("artifact", ["resource", "condensed"])
+def test_bench_ckan_kernel_sections_source(benchmark, resource_id, artifact):
+    """Extract tables and logs from the original or condensed file
+
+    The condensed file is used by :func:`serve.get_resource_kernel_base`
+    for these sections if it is available.
+    """
+    benchmark.group = "kernel-sections-source"
+    bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+
+    def extract():
+        ds = serve.get_s3_dc_handle_timed(resource_id, artifact=artifact,
+                                          bucket_name=bucket_name)
+        return serve.get_resource_kernel_from_dc(
+            resource_id, ds, sections=["tables", "logs"])
+
+    benchmark.pedantic(extract, rounds=5, warmup_rounds=0)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.parametrize("resource_id", DATASETS, indirect=True)
+def test_bench_ckan_kernel_artifact(benchmark, resource_id):
+    """Load a kernel from the kernel artifact on S3"""
+    benchmark.group = "kernel-artifact"
+    bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+    tracemalloc.start()
+    try:
+        r_data = serve.get_resource_kernel_artifact(resource_id, public=True,
+                                                    bucket_name=bucket_name)
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["kernel_bytes"] = \
+        kernel_cache.estimate_kernel_size(r_data)
+    benchmark.extra_info["kernel_memory_bytes"] = current
+    benchmark.pedantic(serve.get_resource_kernel_artifact,
+                       args=(resource_id,),
+                       kwargs={"public": True, "bucket_name": bucket_name},
+                       rounds=10)
+
+
+@pytest.mark.parametrize("name", DATASETS)
+def test_bench_ckan_table_serialization(benchmark, tmp_path, name):
+    benchmark.group = "table-serialization"
+    if name == "enlarged":
+        path = make_enlarged_file(tmp_path / "enlarged.rtdc")
+    else:
+        path = data_path / f"{name}.rtdc"
+    with dclab.new_dataset(path) as ds:
+        benchmark(serve.get_dc_tables, ds)
@@ -0,0 +1,51 @@
+"""Benchmark conversion of DC tables to JSON-compatible lists
+
+Run with::
+
+    pytest benchmark/test_bench_tables.py
+
+The "reference" benchmarks use the recursive NaN replacement which
+was used before the vectorized conversion was introduced.
+"""
+import numpy as np
+import pytest
+
+from ckanext.dc_serve import tables
+
+
+def make_table(size):
+    """Structured table similar to per-frame sensor tables"""
+    rng = np.random.default_rng(42)
+    data = np.zeros((size, 1), dtype=[("frame", "<i8"),
+                                      ("time", "<f8"),
+                                      ("brightness", "<f8"),
+                                      ("temperature", "<f4"),
+                                      ("flow_rate", "<f8"),
+                                      ])
+    data["frame"][:, 0] = np.arange(size)
+    data["time"][:, 0] = np.arange(size) / 2000
+    data["brightness"][:, 0] = rng.normal(size=size)
+    data["temperature"][:, 0] = 23.5
+    data["flow_rate"][:, 0] = 0.04
+    # sensor dropouts
+    data["brightness"][::97] = np.nan
+    return data
+
+
+SIZES = {"small": 100, "large": 500_000}
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_bench_table_to_list(benchmark, size):
+    benchmark.group = f"table-{size}"
+    data = make_table(SIZES[size])
+    benchmark(tables.table_to_list, data)
+
+
+@pytest.mark.parametrize("size", SIZES.keys())
+def test_bench_table_to_list_reference(benchmark, size):
+    benchmark.group = f"table-{size}"
+    data = make_table(SIZES[size])
+    benchmark.pedantic(
+        lambda: tables.replace_nan_with_none_recursive(data.tolist()),
+        rounds=3 if size == "large" else 50)
@@ -1,20 +1,35 @@
+import concurrent.futures
 import datetime
+import functools
+import multiprocessing
 import time
 import traceback
 
 import ckan.model as model
+from dcor_shared import s3, s3cc
 
 import click
 
 
 from . import jobs
+from .kernel_cache import get_kernel_cache, get_most_accessed_resources
+from .serve import (
+    get_resource_kernel, get_resource_kernel_key, is_dc_resource_object
+)
 
 
 @click.option('--modified-days', default=-1,
               help='Only run for datasets modified within this number of days '
                    + 'in the past. Set to -1 to apply to all datasets.')
+@click.option('--workers', default=1,
+              help='Number of resources to process in parallel (each in a '
+                   + 'separate worker process).')
+@click.option('--incremental', is_flag=True,
+              help='Update existing condensed resources incrementally '
+                   + '(compute missing features and rewrite the DCOR '
+                   + 'basins), e.g. after upgrading dclab.')
 @click.command()
-def run_jobs_dc_serve(modified_days=-1):
+def run_jobs_dc_serve(modified_days=-1, workers=1, incremental=False):
     """Compute condensed resources for all .rtdc files
 
     This also happens for draft datasets.
@@ -28,6 +43,10 @@ def run_jobs_dc_serve(modified_days=-1):
         past_str = time.strftime("%Y-%m-%d", past.timetuple())
         datasets = datasets.filter(model.Package.metadata_modified >= past_str)
 
+    if workers > 1:
+        _run_jobs_parallel(datasets, workers, incremental)
+        return
+
     job_list = jobs.RQJob.get_all_job_methods_in_order(
         ckanext="dc_serve")
 
@@ -40,7 +59,8 @@ def run_jobs_dc_serve(modified_days=-1):
             res_dict = resource.as_dict()
             try:
                 for job in job_list:
-                    if job.method(res_dict):
+                    if job.method(res_dict,
+                                  **_get_job_kwargs(job, incremental)):
                         if not nl:
                             click.echo("")
                             nl = True
@@ -58,5 +78,191 @@ def run_jobs_dc_serve(modified_days=-1):
     click.echo("Done!")
 
 
+def _get_job_kwargs(job, incremental):
+    """Return the keyword arguments for a job of `run_jobs_dc_serve`"""
+    if incremental and job.method is jobs.generate_condensed_resource:
+        return {"incremental": True}
+    return {}
+
+
+def _run_jobs_parallel(datasets, workers, incremental=False):
+    """Run the jobs of `run_jobs_dc_serve` in a pool of worker processes
+
+    The jobs of a resource run in order in one process. Progress is
+    reported in the order of the resources. The jobs make sure via
+    :class:`.res_file_lock.CKANResourceFileLock` that a resource is
+    not condensed by two processes (e.g. also by a background job)
+    at the same time.
+    """
+    res_dicts = [res.as_dict() for dataset in datasets
+                 for res in dataset.resources]
+    # Return the database connection of this process to the pool, the
+    # worker processes create their own connections.
+    model.Session.remove()
+    click.echo(f"Running jobs for {len(res_dicts)} resources with "
+               f"{workers} worker processes")
+
+    t_start = time.perf_counter()
+    durations = []
+    failed = []
+    jobs_run = 0
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        # The workers inherit the CKAN configuration of this process.
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_jobs_worker)
+    try:
+        results = pool.map(functools.partial(_run_jobs_for_resource,
+                                             incremental=incremental),
+                           res_dicts)
+        for ii, (res_dict, result) in enumerate(zip(res_dicts, results)):
+            titles, error, duration = result
+            durations.append(duration)
+            jobs_run += len(titles)
+            click.echo(f"[{ii + 1}/{len(res_dicts)}] {res_dict['id']} "
+                       f"({res_dict['name']}): {duration:.2f}s")
+            for title in titles:
+                click.echo(f"OK: {title} for {res_dict['name']}")
+            if error is not None:
+                failed.append(res_dict["id"])
+                click.echo(f"Failed for {res_dict['name']}!", err=True)
+                click.echo(error, err=True)
+    except BaseException:
+        # Do not wait for the remaining resources (e.g. KeyboardInterrupt)
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    t_total = time.perf_counter() - t_start
+    if durations:
+        click.echo(f"Duration per resource: mean "
+                   f"{sum(durations) / len(durations):.2f}s, "
+                   f"max {max(durations):.2f}s")
+    for rid in failed:
+        click.echo(f"Failed: {rid}", err=True)
+    click.echo(f"Done! Processed {len(res_dicts)} resources in "
+               f"{t_total:.1f}s ({jobs_run} jobs run, {len(failed)} failed)")
+
+
+def _init_jobs_worker():
+    """Initialize a worker process of :func:`_run_jobs_parallel`"""
+    # Database connections inherited from the parent process must not
+    # be used (or closed) by this process.
+    model.meta.engine.dispose(close=False)
+    # Every process uses its own S3 client.
+    s3.get_s3.cache_clear()
+
+
+def _run_jobs_for_resource(res_dict, incremental=False):
+    """Run all jobs of this extension for a resource
+
+    Returns the titles of the jobs that did something, the traceback
+    if a job failed (otherwise None), and the duration in seconds.
+    """
+    t0 = time.perf_counter()
+    titles = []
+    error = None
+    try:
+        for job in jobs.RQJob.get_all_job_methods_in_order(
+                ckanext="dc_serve"):
+            if job.method(res_dict, **_get_job_kwargs(job, incremental)):
+                titles.append(job.title)
+    except Exception:
+        error = traceback.format_exc()
+    return titles, error, time.perf_counter() - t0
+
+
+@click.option('--modified-days', default=-1,
+              help='Only warm kernels of resources in datasets modified '
+                   + 'within this number of days in the past. Set to -1 '
+                   + 'to apply to all datasets.')
+@click.option('--most-accessed', default=0,
+              help='Only warm kernels of this number of most accessed '
+                   + 'resources (counted by dcserv).')
+@click.option('--workers', default=4,
+              help='Number of resource kernels to build in parallel.')
+@click.option('--force', is_flag=True,
+              help='Build kernels even if they are already cached.')
+@click.command()
+def dc_serve_warm_kernels(modified_days=-1, most_accessed=0, workers=4,
+                          force=False):
+    """Build resource kernels and store them in the kernel cache
+
+    Resources in recently modified datasets are warmed first. This is
+    only useful for kernel caches that are shared with the web workers
+    (`ckanext.dc_serve.kernel_cache` set to "sqlite" or "redis").
+    """
+    cache = get_kernel_cache()
+    if cache.name == "memory":
+        raise click.ClickException(
+            "The 'memory' kernel cache is not shared with the CKAN workers, "
+            "please configure 'ckanext.dc_serve.kernel_cache'!")
+
+    query = model.Session.query(model.Resource, model.Package).join(
+        model.Package, model.Package.id == model.Resource.package_id).filter(
+        model.Resource.state == "active").filter(
+        model.Package.state == "active")
+    if modified_days >= 0:
+        past = datetime.date.today() - datetime.timedelta(days=modified_days)
+        past_str = time.strftime("%Y-%m-%d", past.timetuple())
+        query = query.filter(model.Package.metadata_modified >= past_str)
+    if most_accessed > 0:
+        ids = get_most_accessed_resources(most_accessed)
+        rows = {res.id: (res, pkg) for res, pkg in
+                query.filter(model.Resource.id.in_(ids)).all()}
+        rows = [rows[rid] for rid in ids if rid in rows]
+    else:
+        rows = query.order_by(model.Package.metadata_modified.desc()).all()
+
+    todo = []
+    for res, pkg in rows:
+        public = not pkg.private
+        if (is_dc_resource_object(res)
+                and (force or not cache.has(
+                    get_resource_kernel_key(res.id, public=public)))):
+            todo.append((res.id, public))
+    click.echo(f"Warming {len(todo)} resource kernels "
+               f"({len(rows) - len(todo)} skipped) with {workers} workers")
+
+    def warm(resource_id, public, bucket_name):
+        t0 = time.perf_counter()
+        if force:
+            cache.delete(get_resource_kernel_key(resource_id, public=public))
+        get_resource_kernel(resource_id, public=public,
+                            bucket_name=bucket_name)
+        return time.perf_counter() - t0
+
+    t_start = time.perf_counter()
+    failed = 0
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # The workers must not access the database, so the S3 bucket
+        # names are looked up here and passed to the workers.
+        futures = {}
+        for rid, public in todo:
+            bucket_name = s3cc.get_s3_bucket_name_for_resource(rid)
+            futures[pool.submit(warm, rid, public, bucket_name)] = rid
+        for future in concurrent.futures.as_completed(futures):
+            rid = futures[future]
+            done += 1
+            try:
+                duration = future.result()
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                failed += 1
+                click.echo(f"[{done}/{len(todo)}] "
+                           f"{e.__class__.__name__} for {rid}!",
+                           err=True)
+                click.echo(traceback.format_exc(), err=True)
+            else:
+                click.echo(f"[{done}/{len(todo)}] {rid}: "
+                           f"{duration:.2f}s")
+
+    t_total = time.perf_counter() - t_start
+    click.echo(f"Done! Warmed {done - failed} kernels in {t_total:.1f}s "
+               f"({failed} failed)")
+
+
 def get_commands():
-    return [run_jobs_dc_serve]
+    return [run_jobs_dc_serve, dc_serve_warm_kernels]
@@ -0,0 +1,122 @@
+"""Invalidation of cached resource information across workers
+
+When a resource is updated or deleted (or when the privacy of its
+dataset changes), the worker handling that request evicts the
+affected cache entries (see :func:`.serve.invalidate_resource`).
+Other worker processes, which keep their own in-process caches, are
+notified via a Redis stream. Every worker polls that stream at most
+once every ``ckanext.dc_serve.invalidation_poll_interval`` seconds.
+"""
+import functools
+import logging
+import threading
+import time
+
+from ckan import common
+from ckan.lib.redis import connect_to_redis
+
+
+logger = logging.getLogger(__name__)
+
+#: Redis stream with invalidation messages
+INVALIDATION_STREAM = "ckanext.dc_serve:invalidated"
+#: Approximate maximum number of messages kept in the stream
+INVALIDATION_STREAM_MAXLEN = 10000
+
+
+class InvalidationListener:
+    """Read invalidation messages published by other workers
+
+    Only messages published after the listener was created are
+    returned.
+    """
+
+    def __init__(self, poll_interval: float = 1.0):
+        self.poll_interval = poll_interval
+        self._last_poll = -float("inf")
+        self._lock = threading.Lock()
+        try:
+            self._last_id = get_latest_stream_id()
+        except BaseException:
+            logger.warning("Failed to read invalidation stream",
+                           exc_info=True)
+            # messages published until the first poll are unknown
+            self._last_id = None
+
+    def poll(self):
+        """Return the messages published since the last poll
+
+        Each message is a dictionary with the keys "id" (resource ID)
+        and "public" (None or bool, see :func:`publish_invalidation`).
+        An empty list is returned if the poll interval has not yet
+        elapsed or if another thread is already polling. None is
+        returned if messages may have been lost, in which case all
+        cached information should be discarded.
+        """
+        now = time.monotonic()
+        if now - self._last_poll < self.poll_interval:
+            return []
+        if not self._lock.acquire(blocking=False):
+            return []
+        try:
+            self._last_poll = now
+            redis = connect_to_redis()
+            if self._last_id is None:
+                self._last_id = get_latest_stream_id()
+                return None
+            resp = redis.xread({INVALIDATION_STREAM: self._last_id},
+                               count=INVALIDATION_STREAM_MAXLEN)
+            if not resp:
+                return []
+            entries = resp[0][1]
+            self._last_id = entries[-1][0]
+        except BaseException:
+            logger.warning("Failed to read invalidation messages",
+                           exc_info=True)
+            return []
+        finally:
+            self._lock.release()
+
+        if len(entries) >= INVALIDATION_STREAM_MAXLEN:
+            # We might have missed messages that were trimmed.
+            return None
+        messages = []
+        for _, fields in entries:
+            fields = {_to_str(k): _to_str(v) for k, v in fields.items()}
+            public = fields.get("public", "")
+            messages.append({"id": fields["id"],
+                             "public": None if public == "" else public == "1",
+                             })
+        return messages
+
+
+def get_latest_stream_id():
+    """Return the ID of the latest message in the invalidation stream"""
+    latest = connect_to_redis().xrevrange(INVALIDATION_STREAM, count=1)
+    return latest[0][0] if latest else "0-0"
+
+
+def _to_str(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+@functools.lru_cache(maxsize=1)
+def get_invalidation_listener() -> InvalidationListener:
+    """Return the invalidation listener of this process"""
+    return InvalidationListener(poll_interval=float(common.config.get(
+        "ckanext.dc_serve.invalidation_poll_interval", 1)))
+
+
+def publish_invalidation(resource_id: str, public: bool = None) -> None:
+    """Notify all workers that cached resource information is outdated
+
+    If `public` is None, all information about the resource is
+    invalidated. Otherwise, only the privacy of the resource (which
+    is now `public`) changed.
+    """
+    connect_to_redis().xadd(
+        INVALIDATION_STREAM,
+        {"id": resource_id,
+         "public": "" if public is None else str(int(public))},
+        maxlen=INVALIDATION_STREAM_MAXLEN,
+        approximate=True)
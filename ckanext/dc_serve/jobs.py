@@ -1,3 +1,6 @@
+import gzip
+import io
+import json
 import logging
 import pathlib
 import tempfile
@@ -8,8 +11,10 @@ import warnings
 import botocore.exceptions
 from ckan import common, model
 import ckan.plugins.toolkit as toolkit
+import dclab
 from dclab import RTDCWriter
 from dclab.cli import condense_dataset
+from dclab.rtdc_dataset import RTDC_HDF5
 from dcor_shared import (
     DC_MIME_TYPES, get_dc_instance, s3cc, rqjob_register, s3, wait_for_resource
 )
@@ -17,11 +22,26 @@ from dcor_shared import RQJob  # noqa: F401
 
 import h5py
 
+from .kernel_cache import set_condensed_signal
+from .layout import (
+    copy_condensed_layout, get_condensed_file_kwargs, needs_condensed_layout
+)
 from .res_file_lock import CKANResourceFileLock
+from .serve import (
+    complement_resource_kernel_from_dc, get_resource_kernel_document,
+    get_resource_kernel_from_dc
+)
+from .upload import upload_artifact
 
 
 logger = logging.getLogger(__name__)
 
+#: Names of the basins written by :func:`_write_dcor_basins`
+DCOR_BASIN_NAMES = ["DCOR dcserv", "DCOR direct S3", "DCOR public S3 via HTTP"]
+#: Name prefixes of the intra-dataset basins written by
+#: :func:`_write_dcor_basins`
+DCOR_BASIN_NAME_PREFIXES = ("DCOR intra-dataset for ", "DCOR self-reference ")
+
 
 def admin_context():
     return {'ignore_auth': True, 'user': 'default'}
@@ -31,8 +51,18 @@ def admin_context():
                 queue="dcor-long",
                 timeout=3600,
                 )
-def generate_condensed_resource(resource, override=False):
-    """Condense .rtdc file and upload to S3"""
+def generate_condensed_resource(resource, override=False, incremental=False):
+    """Condense .rtdc file and upload to S3
+
+    In addition to the condensed file, a compact kernel document
+    (see :func:`.serve.get_resource_kernel_document`) is uploaded
+    as the "kernel" artifact.
+
+    With `incremental`, an existing condensed file is updated instead
+    of condensing the resource again: Only scalar features missing in
+    the condensed file are computed and the DCOR basins are rewritten
+    (e.g. after a dclab upgrade).
+    """
     # Check whether we should be generating a condensed resource file.
     if not common.asbool(common.config.get(
             "ckanext.dc_serve.create_condensed_datasets", "true")):
@@ -56,6 +86,7 @@ def generate_condensed_resource(resource, override=False):
     if (resource.get('mimetype', '') in DC_MIME_TYPES
         # Check whether the file already exists on S3
         and (override
+             or incremental
              or not s3cc.artifact_exists(resource_id=rid,
                                          artifact="condensed"))):
         # Create the condensed file in a cache location
@@ -92,7 +123,8 @@ def generate_condensed_resource(resource, override=False):
                 # resource.
                 if fl.is_locked:
                     _generate_condensed_resource(res_dict=resource,
-                                                 path_cond=path_cond)
+                                                 path_cond=path_cond,
+                                                 incremental=incremental)
                     return True
         except BaseException:
             logger.error(traceback.format_exc())
@@ -101,7 +133,7 @@ def generate_condensed_resource(resource, override=False):
     return False
 
 
-def _generate_condensed_resource(res_dict, path_cond):
+def _generate_condensed_resource(res_dict, path_cond, incremental=False):
     """Condense dataset and add all relevant basins
 
     Creating the condensed resource (new file with scalar-only features)
@@ -122,39 +154,211 @@ def _generate_condensed_resource(res_dict, path_cond):
       a reference to it based on the DCOR API. The use case is data
       processed with dcnum when exploiting basins. Without this basin,
       image data would not be available when opening "_dcn.rtdc" files.
+
+    If the condensed file is estimated to be smaller than
+    ``ckanext.dc_serve.condense_in_memory_max_bytes``, it is created
+    in memory (HDF5 core driver without backing store) and uploaded
+    from there instead of being written to `path_cond`.
+
+    The HDF5 layout of the condensed file (file space strategy,
+    chunking, and compression) is configurable (see :mod:`.layout`).
+
+    If `incremental` is set and the resource already has a condensed
+    file, then that file is downloaded, complemented with missing
+    features (see :func:`_complement_condensed_file`), and its DCOR
+    basins are replaced.
     """
     rid = res_dict["id"]
     # Now we would like to combine feature data
-    with get_dc_instance(rid) as ds, \
-            h5py.File(path_cond, "w") as h5_cond:
-        # Features available in the input file
-        feats_src = set(ds.features_innate)
-
-        # Condense the dataset (do not store any warning
-        # messages during instantiation, because we are
-        # scared of leaking credentials).
-        with warnings.catch_warnings(record=True) as w:
-            warnings.simplefilter("always")
-            condense_dataset(ds=ds,
-                             h5_cond=h5_cond,
-                             store_ancillary_features=True,
-                             store_basin_features=True,
-                             warnings_list=w)
-
-        # Features available in the condensed file
-        feats_dst = set(h5_cond["events"].keys())
-        # Features that are in the input, but not in the
-        # condensed file.
-        feats_input = sorted(feats_src - feats_dst)
-        if common.asbool(common.config.get(
-                "ckanext.dc_serve.enable_intra_dataset_basins", "true")):
-            # Additional upstream basins within this DCOR dataset.
-            basins_upstream = _get_intra_dataset_upstream_basins(res_dict, ds)
-        else:
-            basins_upstream = []
+    with get_dc_instance(rid) as ds:
+        h5_cond = None
+        if incremental:
+            h5_cond = _open_condensed_artifact(path_cond, ds, rid)
+        if h5_cond is None:
+            incremental = False
+            h5_cond = _create_condensed_file(path_cond, ds)
+        with h5_cond:
+            # Features available in the input file
+            feats_src = set(ds.features_innate)
+
+            if incremental:
+                _complement_condensed_file(ds, h5_cond)
+                _remove_dcor_basins(h5_cond)
+            else:
+                # Condense the dataset (do not store any warning
+                # messages during instantiation, because we are
+                # scared of leaking credentials).
+                with warnings.catch_warnings(record=True) as w:
+                    warnings.simplefilter("always")
+                    condense_dataset(ds=ds,
+                                     h5_cond=h5_cond,
+                                     store_ancillary_features=True,
+                                     store_basin_features=True,
+                                     warnings_list=w)
+
+            # Features available in the condensed file
+            feats_dst = set(h5_cond["events"].keys())
+            # Features that are in the input, but not in the
+            # condensed file.
+            feats_input = sorted(feats_src - feats_dst)
+            if common.asbool(common.config.get(
+                    "ckanext.dc_serve.enable_intra_dataset_basins", "true")):
+                # Additional upstream basins within this DCOR dataset.
+                basins_upstream = _get_intra_dataset_upstream_basins(
+                    res_dict, ds)
+            else:
+                basins_upstream = []
 
-    # Write DCOR basins
-    with RTDCWriter(path_cond) as hw:
+            # Kernel of the original resource for the kernel artifact
+            try:
+                kernel = get_resource_kernel_from_dc(rid, ds)
+            except BaseException:
+                logger.error(f"Failed to extract resource kernel for {rid}")
+                logger.error(traceback.format_exc())
+                kernel = None
+
+            # Write DCOR basins (the file is kept open, since it might only
+            # exist in memory)
+            _write_dcor_basins(h5_cond, res_dict, feats_input,
+                               basins_upstream)
+
+            # Chunking and compression for access via HTTP (the features
+            # are copied to a new file, so that no space is wasted)
+            path_layout = path_cond.with_name(
+                f"{path_cond.stem}_layout{path_cond.suffix}")
+            if needs_condensed_layout(h5_cond):
+                h5_layout = _create_condensed_file(path_layout, ds)
+                with h5_layout:
+                    copy_condensed_layout(h5_cond, h5_layout)
+                    source = _get_condensed_source(h5_layout, path_layout)
+            else:
+                source = _get_condensed_source(h5_cond, path_cond)
+
+    try:
+        # Upload the condensed file to S3
+        upload_artifact(resource_id=rid,
+                        artifact="condensed",
+                        source=source)
+
+        # Upload the kernel document to S3 (only after the condensed file
+        # is available, because the kernel describes the condensed file
+        # as well)
+        if kernel is not None:
+            try:
+                _upload_kernel_artifact(kernel, source)
+            except BaseException:
+                # The kernel artifact is only an optimization for dcserv.
+                logger.error(f"Failed to upload kernel artifact for {rid}")
+                logger.error(traceback.format_exc())
+    finally:
+        path_layout.unlink(missing_ok=True)
+
+    # Tell the dcserv workers that the condensed resource is available.
+    try:
+        set_condensed_signal(rid)
+    except BaseException:
+        logger.warning(f"Could not signal condensed resource for {rid}")
+
+
+def _create_condensed_file(path_cond, ds):
+    """Return the :class:`h5py.File` to which `ds` is condensed
+
+    The file is created in memory if its estimated size (the size
+    of all scalar features as 64-bit floats) is below
+    ``ckanext.dc_serve.condense_in_memory_max_bytes``.
+    """
+    max_bytes = common.asint(common.config.get(
+        "ckanext.dc_serve.condense_in_memory_max_bytes", 0))
+    if max_bytes > 0:
+        size_estimate = 8 * len(ds) * len(ds.features_scalar)
+        if size_estimate <= max_bytes:
+            logger.info(f"Condensing {path_cond.name} in memory "
+                        f"(estimated {size_estimate} bytes)")
+            return h5py.File(path_cond.name, "w", driver="core",
+                             backing_store=False,
+                             **get_condensed_file_kwargs())
+    return h5py.File(path_cond, "w", **get_condensed_file_kwargs())
+
+
+def _get_condensed_source(h5_cond, path_cond):
+    """Return the content of an in-memory condensed file or its path"""
+    if h5_cond.driver in ["core", "fileobj"]:
+        h5_cond.flush()
+        return h5_cond.id.get_file_image()
+    return path_cond
+
+
+def _open_condensed_artifact(path_cond, ds, resource_id):
+    """Return the existing condensed artifact as a writable h5py.File
+
+    The artifact is downloaded to `path_cond` (or into memory if it
+    is smaller than ``ckanext.dc_serve.condense_in_memory_max_bytes``).
+    Returns None if there is no condensed artifact or if it does not
+    match `ds` (different number of events).
+    """
+    if not s3cc.artifact_exists(resource_id=resource_id,
+                                artifact="condensed"):
+        return None
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact="condensed")
+    s3_client, _, _ = s3.get_s3()
+    size = s3_client.head_object(Bucket=bucket_name,
+                                 Key=object_name)["ContentLength"]
+    max_bytes = common.asint(common.config.get(
+        "ckanext.dc_serve.condense_in_memory_max_bytes", 0))
+    if size <= max_bytes:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+        h5_cond = h5py.File(io.BytesIO(response["Body"].read()), "r+")
+    else:
+        s3_client.download_file(bucket_name, object_name, str(path_cond))
+        h5_cond = h5py.File(path_cond, "r+")
+
+    if ("events" not in h5_cond
+            or h5_cond.attrs.get("experiment:event count") != len(ds)):
+        logger.warning(f"Condensed resource {resource_id} does not match "
+                       f"the resource, condensing it again")
+        h5_cond.close()
+        path_cond.unlink(missing_ok=True)
+        return None
+    return h5_cond
+
+
+def _complement_condensed_file(ds, h5_cond):
+    """Store the scalar features of `ds` missing in `h5_cond`
+
+    These are the innate, ancillary, and basin features that
+    :func:`dclab.cli.condense_dataset` would have stored, but which
+    are not in the condensed file (e.g. new ancillary features of
+    a more recent version of dclab). Returns the list of features
+    that were added.
+    """
+    feats_sc = set(ds.features_scalar)
+    feats_want = feats_sc & (set(ds.features_innate)
+                             | set(ds.features_ancillary)
+                             | set(ds.features_basin))
+    feats_have = (set(h5_cond["events"].keys())
+                  | set(h5_cond.get("basin_events", {}).keys()))
+    feats_missing = sorted(feats_want - feats_have)
+    logger.info(f"Adding features {feats_missing} to condensed file")
+    with RTDCWriter(h5_cond) as hw:
+        for feat in feats_missing:
+            hw.store_feature(feat=feat, data=ds[feat])
+    return feats_missing
+
+
+def _remove_dcor_basins(h5_cond):
+    """Remove the basins written by :func:`_write_dcor_basins`"""
+    for bn_dict in RTDC_HDF5.basin_get_dicts_from_h5file(h5_cond):
+        if (bn_dict["type"] == "remote"
+                and (bn_dict["name"] in DCOR_BASIN_NAMES
+                     or bn_dict["name"].startswith(
+                        DCOR_BASIN_NAME_PREFIXES))):
+            del h5_cond["basins"][bn_dict["key"]]
+
+
+def _write_dcor_basins(h5_cond, res_dict, feats_input, basins_upstream):
+    """Store the DCOR basins in the condensed file"""
+    with RTDCWriter(h5_cond) as hw:
         # DCOR
         site_url = common.config["ckan.site_url"]
         rid = res_dict["id"]
@@ -200,11 +404,24 @@ def _generate_condensed_resource(res_dict, path_cond):
         for bn_dict in basins_upstream:
             hw.store_basin(verify=False, **bn_dict)
 
-    # Upload the condensed file to S3
-    s3cc.upload_artifact(resource_id=rid,
-                         path_artifact=path_cond,
-                         artifact="condensed",
-                         override=True)
+
+def _upload_kernel_artifact(kernel, cond):
+    """Complement the resource kernel and upload it to S3
+
+    The kernel document is uploaded as the gzip-compressed JSON
+    "kernel" artifact. `cond` is the path to the condensed file or
+    its content.
+    """
+    rid = kernel["id"]
+    if isinstance(cond, bytes):
+        cond = io.BytesIO(cond)
+    with dclab.new_dataset(cond) as ds_con:
+        complement_resource_kernel_from_dc(kernel, ds_con)
+    doc = get_resource_kernel_document(kernel)
+    doc["dclab_version"] = dclab.__version__
+    upload_artifact(resource_id=rid,
+                    artifact="kernel",
+                    source=gzip.compress(json.dumps(doc).encode("utf-8")))
 
 
 def _get_intra_dataset_upstream_basins(res_dict, ds) -> list[dict]:
@@ -0,0 +1,498 @@
+"""Storage backends for resource kernels
+
+A resource kernel is the dictionary assembled by
+:func:`ckanext.dc_serve.serve.get_resource_kernel`. Building it requires
+opening the resource (and its condensed version) on S3, which is slow.
+The backends defined here allow to keep kernels in memory (per process),
+in an SQLite database on the local disk (shared by all workers on one
+node) or in Redis (shared by all workers that use the same Redis
+instance). The backend is selected via the
+``ckanext.dc_serve.kernel_cache`` configuration option.
+"""
+import abc
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+from ckan import common
+from ckan.lib.redis import connect_to_redis
+
+from . import metrics
+
+
+#: Redis key prefix for completion signals of condense jobs
+CONDENSED_SIGNAL_PREFIX = "ckanext.dc_serve:condensed:"
+#: Lifetime of completion signals of condense jobs in seconds
+CONDENSED_SIGNAL_EXPIRE = 24 * 3600
+#: Redis key of the sorted set counting dcserv requests per resource
+ACCESS_COUNTS_KEY = "ckanext.dc_serve:access-counts"
+#: Interval in seconds in which workers add their access counts to Redis
+ACCESS_COUNTS_FLUSH_INTERVAL = 60
+#: Maximum number of resources in :const:`ACCESS_COUNTS_KEY`
+ACCESS_COUNTS_MAX_RESOURCES = 10000
+#: Lifetime of :const:`ACCESS_COUNTS_KEY` in seconds after the last flush
+ACCESS_COUNTS_EXPIRE = 30 * 24 * 3600
+#: Resolution in seconds of the access times of the SQLite kernel cache
+SQLITE_ATIME_RESOLUTION = 60
+#: Redis key prefix for locks of kernel builds (see :func:`kernel_build_lock`)
+KERNEL_LOCK_PREFIX = "ckanext.dc_serve:kernel-lock:"
+#: Maximum time in seconds a kernel build may hold the lock
+KERNEL_BUILD_LOCK_TIMEOUT = 120
+
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+_access_counts = collections.Counter()
+_access_counts_lock = threading.Lock()
+_access_counts_last_flush = [time.monotonic()]
+
+
+class KernelCache(abc.ABC):
+    """Base class for resource kernel stores
+
+    The cache keeps track of hits, misses, and evictions (counted
+    per process) which are returned by :func:`KernelCache.stats`.
+    Backends that support it are bounded by `max_bytes`, the
+    estimated size of all kernels (see :func:`estimate_kernel_size`),
+    and evict the least recently used kernels first.
+    """
+    name = "base"
+
+    def __init__(self, max_bytes: int = 256 * 1024**2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, count: bool = True):
+        """Return the kernel stored under `key` or None if not cached
+
+        Set `count` to False for internal lookups (e.g. checking the
+        cache again after acquiring a build lock), which should not
+        be counted as hits or misses.
+        """
+        kernel = self._get(key)
+        if count:
+            if kernel is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            metrics.inc("dcserv_kernel_cache_requests_total",
+                        backend=self.name,
+                        result="miss" if kernel is None else "hit")
+        return kernel
+
+    def set(self, key: str, kernel: dict) -> None:
+        """Store (or replace) a kernel"""
+        self._set(key, kernel)
+
+    def _count_eviction(self) -> None:
+        self.evictions += 1
+        metrics.inc("dcserv_kernel_cache_evictions_total", backend=self.name)
+
+    def stats(self) -> dict:
+        """Return cache statistics
+
+        The number of entries and bytes refers to the entire cache,
+        the number of hits, misses and evictions only to the current
+        process. For backends that do not track their size, "entries"
+        and "bytes" are None.
+        """
+        entries, size = self._usage()
+        return {"backend": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                }
+
+    @abc.abstractmethod
+    def _get(self, key: str):
+        """Return the kernel stored under `key` or None"""
+
+    @abc.abstractmethod
+    def _set(self, key: str, kernel: dict) -> None:
+        """Store a kernel, evicting other kernels if necessary"""
+
+    @abc.abstractmethod
+    def _usage(self) -> tuple:
+        """Return the number of cached kernels and their size in bytes"""
+
+    @abc.abstractmethod
+    def has(self, key: str) -> bool:
+        """Whether a kernel is stored under `key` (not counted as hit)"""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove the kernel stored under `key` (if it exists)"""
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """Remove all kernels from the cache"""
+
+
+class MemoryKernelCache(KernelCache):
+    """In-process LRU cache (not shared between workers)"""
+    name = "memory"
+
+    def __init__(self, *args, **kwargs):
+        super(MemoryKernelCache, self).__init__(*args, **kwargs)
+        #: kernels and their estimated size, ordered by last access
+        self._data = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def _set(self, key, kernel):
+        size = estimate_kernel_size(kernel)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            if size > self.max_bytes:
+                # This kernel would evict all other kernels.
+                self._count_eviction()
+                return
+            self._data[key] = (kernel, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self._bytes -= old_size
+                self._count_eviction()
+
+    def _usage(self):
+        with self._lock:
+            return len(self._data), self._bytes
+
+    def has(self, key):
+        with self._lock:
+            return key in self._data
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+class SQLiteKernelCache(KernelCache):
+    """Kernel cache in an SQLite database on the local disk
+
+    All worker processes on a node that point to the same database
+    file share the cache. Kernels are stored as JSON documents. The
+    access times used for evicting kernels are only updated if they
+    are older than :const:`SQLITE_ATIME_RESOLUTION` seconds.
+    """
+    name = "sqlite"
+
+    def __init__(self, path, *args, **kwargs):
+        super(SQLiteKernelCache, self).__init__(*args, **kwargs)
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS kernels ("
+                         "key TEXT PRIMARY KEY, "
+                         "data TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, "
+                         "atime REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS kernels_atime "
+                         "ON kernels (atime)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return a connection for the current thread and process
+
+        SQLite connections must not be shared between threads or
+        be inherited by forked worker processes.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            # Allow concurrent readers while a worker is writing.
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data, atime FROM kernels "
+                               "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            # Updating the access time is a write transaction, which
+            # would serialize all reading workers.
+            now = time.time()
+            if now - row[1] > SQLITE_ATIME_RESOLUTION:
+                conn.execute("UPDATE kernels SET atime = ? WHERE key = ?",
+                             (now, key))
+        return json.loads(row[0])
+
+    def _set(self, key, kernel):
+        data = json.dumps(kernel)
+        size = len(data)
+        with self._connect() as conn:
+            if size > self.max_bytes:
+                conn.execute("DELETE FROM kernels WHERE key = ?", (key,))
+                self._count_eviction()
+                return
+            conn.execute("INSERT OR REPLACE INTO kernels "
+                         "(key, data, size, atime) VALUES (?, ?, ?, ?)",
+                         (key, data, size, time.time()))
+            total, = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM kernels").fetchone()
+            while total > self.max_bytes:
+                old_key, old_size = conn.execute(
+                    "SELECT key, size FROM kernels "
+                    "ORDER BY atime ASC LIMIT 1").fetchone()
+                conn.execute("DELETE FROM kernels WHERE key = ?", (old_key,))
+                total -= old_size
+                self._count_eviction()
+
+    def _usage(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM kernels"
+            ).fetchone()
+
+    def has(self, key):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM kernels WHERE key = ?",
+                                (key,)).fetchone() is not None
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kernels WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kernels")
+
+
+class RedisKernelCache(KernelCache):
+    """Kernel cache in the Redis instance configured for CKAN
+
+    Every worker connected to the same Redis instance shares the cache.
+    Entries expire after `expire` seconds so that kernels of deleted
+    resources do not accumulate. The size of this cache is not bounded
+    by `max_bytes`; configure Redis' `maxmemory` instead.
+    """
+    name = "redis"
+    prefix = "ckanext.dc_serve:kernel:"
+
+    def __init__(self, *args, expire: int = 7 * 24 * 3600, **kwargs):
+        super(RedisKernelCache, self).__init__(*args, **kwargs)
+        self.expire = expire
+        self._redis = connect_to_redis()
+
+    def _get(self, key):
+        data = self._redis.get(self.prefix + key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def _set(self, key, kernel):
+        self._redis.set(self.prefix + key, json.dumps(kernel),
+                        ex=self.expire)
+
+    def _usage(self):
+        return None, None
+
+    def has(self, key):
+        return bool(self._redis.exists(self.prefix + key))
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self.prefix + "*"):
+            self._redis.delete(key)
+
+
+@contextlib.contextmanager
+def kernel_build_lock(key: str, shared: bool = False):
+    """Single-flight lock for building (or complementing) a kernel
+
+    Only one thread per process builds the kernel stored under `key`
+    at a time. If `shared` is set (for kernel caches shared between
+    workers), a Redis lock is acquired as well, so that only one
+    worker builds the kernel. Callers must check the cache again
+    after acquiring the lock, since the kernel might have been built
+    while they were waiting.
+
+    If the Redis lock cannot be acquired within
+    :const:`KERNEL_BUILD_LOCK_TIMEOUT` seconds (or if Redis is not
+    available), the kernel is built without it.
+    """
+    with _build_locks_lock:
+        item = _build_locks.setdefault(key, [threading.Lock(), 0])
+        item[1] += 1
+    try:
+        with item[0]:
+            redis_lock = None
+            if shared:
+                try:
+                    redis_lock = connect_to_redis().lock(
+                        KERNEL_LOCK_PREFIX + key,
+                        timeout=KERNEL_BUILD_LOCK_TIMEOUT,
+                        blocking_timeout=KERNEL_BUILD_LOCK_TIMEOUT)
+                    if not redis_lock.acquire():
+                        redis_lock = None
+                except BaseException:
+                    redis_lock = None
+            try:
+                yield
+            finally:
+                if redis_lock is not None:
+                    try:
+                        redis_lock.release()
+                    except BaseException:
+                        # The lock expired.
+                        pass
+    finally:
+        with _build_locks_lock:
+            item[1] -= 1
+            if item[1] == 0:
+                _build_locks.pop(key, None)
+
+
+def get_condensed_signal(resource_id: str):
+    """Return the time at which a condense job signaled completion
+
+    Returns None if no signal was set (or if Redis is not available).
+    See :func:`set_condensed_signal`.
+    """
+    try:
+        value = connect_to_redis().get(CONDENSED_SIGNAL_PREFIX + resource_id)
+    except BaseException:
+        return None
+    return None if value is None else float(value)
+
+
+def set_condensed_signal(resource_id: str) -> None:
+    """Signal that the condensed artifact of a resource is available
+
+    The signal is stored in Redis (and thus visible to all workers),
+    regardless of the kernel cache backend. Workers that failed to
+    complement a kernel with condensed information use it to retry
+    immediately instead of waiting for their backoff to expire.
+    """
+    connect_to_redis().set(CONDENSED_SIGNAL_PREFIX + resource_id,
+                           time.time(),
+                           ex=CONDENSED_SIGNAL_EXPIRE)
+
+
+def get_most_accessed_resources(limit: int) -> list:
+    """Return the IDs of the `limit` most accessed resources
+
+    See :func:`record_resource_access`.
+    """
+    flush_resource_access()
+    ids = connect_to_redis().zrevrange(ACCESS_COUNTS_KEY, 0, limit - 1)
+    return [rid.decode("utf-8") if isinstance(rid, bytes) else rid
+            for rid in ids]
+
+
+def record_resource_access(resource_id: str) -> None:
+    """Count a dcserv request for a resource
+
+    The counts are used for warming the kernel cache with the most
+    accessed resources (``ckan dc-serve-warm-kernels --most-accessed``).
+    They are collected per worker process and added to Redis every
+    :const:`ACCESS_COUNTS_FLUSH_INTERVAL` seconds (see
+    :func:`flush_resource_access`).
+    """
+    with _access_counts_lock:
+        _access_counts[resource_id] += 1
+        due = (time.monotonic() - _access_counts_last_flush[0]
+               >= ACCESS_COUNTS_FLUSH_INTERVAL)
+    if due:
+        flush_resource_access()
+
+
+def flush_resource_access() -> None:
+    """Add the access counts of this worker to the counts in Redis
+
+    Only the :const:`ACCESS_COUNTS_MAX_RESOURCES` most accessed
+    resources are kept and the counts expire if they are not updated
+    for :const:`ACCESS_COUNTS_EXPIRE` seconds. Errors are ignored.
+    """
+    with _access_counts_lock:
+        counts = dict(_access_counts)
+        _access_counts.clear()
+        _access_counts_last_flush[0] = time.monotonic()
+    if not counts:
+        return
+    try:
+        pipe = connect_to_redis().pipeline(transaction=False)
+        for resource_id, count in counts.items():
+            pipe.zincrby(ACCESS_COUNTS_KEY, count, resource_id)
+        pipe.zremrangebyrank(ACCESS_COUNTS_KEY,
+                             0, -ACCESS_COUNTS_MAX_RESOURCES - 1)
+        pipe.expire(ACCESS_COUNTS_KEY, ACCESS_COUNTS_EXPIRE)
+        pipe.execute()
+    except BaseException:
+        pass
+
+
+def estimate_kernel_size(kernel: dict) -> int:
+    """Return the estimated size of a kernel in bytes
+
+    The estimate is the length of the JSON representation, which is
+    also what is stored by the on-disk and Redis backends and what is
+    sent to clients. Kernels built by dcserv contain their size
+    ("kernel_bytes", see
+    :func:`ckanext.dc_serve.serve.set_resource_kernel_digest`), so
+    that they do not have to be serialized again.
+    """
+    size = kernel.get("kernel_bytes")
+    if size is None:
+        size = len(json.dumps(kernel))
+    return size
+
+
+@functools.lru_cache(maxsize=1)
+def get_kernel_cache() -> KernelCache:
+    """Return the kernel cache defined by the CKAN configuration"""
+    backend = common.config.get("ckanext.dc_serve.kernel_cache", "memory")
+    max_bytes = common.asint(common.config.get(
+        "ckanext.dc_serve.kernel_cache_max_bytes", 256 * 1024**2))
+    if backend == "memory":
+        cache = MemoryKernelCache(max_bytes=max_bytes)
+    elif backend == "sqlite":
+        path = common.config.get("ckanext.dc_serve.kernel_cache_path")
+        if not path:
+            path = (pathlib.Path(tempfile.gettempdir())
+                    / "ckanext-dc_serve" / "kernel_cache.sqlite3")
+        cache = SQLiteKernelCache(path, max_bytes=max_bytes)
+    elif backend == "redis":
+        cache = RedisKernelCache(max_bytes=max_bytes)
+    else:
+        raise ValueError(f"Invalid value for ckanext.dc_serve.kernel_cache: "
+                         f"'{backend}' (must be 'memory', 'sqlite', or "
+                         f"'redis')")
+    return cache
+
+
+atexit.register(flush_resource_access)
@@ -0,0 +1,175 @@
+"""HDF5 layout of condensed resource files
+
+Condensed files are the first basin of every resource (see
+:func:`.serve.get_resource_basins_dicts_public`) and clients mostly
+access them via HTTP range requests. Their layout can be tuned for
+this use case:
+
+- ``ckanext.dc_serve.condense_page_size``: Files are created with the
+  paged file space strategy of HDF5, which allocates small objects
+  (metadata and raw data in separate pages) in pages of this size
+  and tracks free space in the file. Objects read when opening the
+  file are thus close to each other. Note that this does not
+  consolidate all metadata in one block.
+- ``ckanext.dc_serve.condense_chunk_bytes``: Scalar features are
+  written with chunks of (at most) this size. Larger chunks mean
+  fewer range requests for reading a feature.
+- ``ckanext.dc_serve.condense_compression``: Compression of the scalar
+  features ("zstd", "gzip", or "none").
+
+Since :func:`dclab.cli.condense_dataset` writes the features with
+dclab's layout, condensed files that do not have the configured
+layout are copied to a new file with that layout (see
+:func:`copy_condensed_layout`).
+"""
+import logging
+
+from ckan import common
+import h5py
+import hdf5plugin
+
+
+logger = logging.getLogger(__name__)
+
+#: Keyword arguments for :func:`h5py.Group.create_dataset` by compression
+COMPRESSIONS = {
+    # dclab's default compression
+    "zstd": hdf5plugin.Zstd(clevel=5),
+    "gzip": {"compression": "gzip", "compression_opts": 4},
+    "none": {},
+}
+
+#: HDF5 filter of each compression
+COMPRESSION_FILTERS = {
+    "zstd": hdf5plugin.ZSTD_ID,
+    "gzip": h5py.h5z.FILTER_DEFLATE,
+    "none": None,
+}
+
+
+def get_condensed_compression() -> str:
+    """Return the configured compression of condensed files"""
+    compression = common.config.get("ckanext.dc_serve.condense_compression",
+                                    "zstd")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Invalid compression '{compression}' for "
+                         f"condensed files, expected one of "
+                         f"{sorted(COMPRESSIONS)}")
+    return compression
+
+
+def get_condensed_file_kwargs() -> dict:
+    """Return keyword arguments of :class:`h5py.File` for condensed files"""
+    page_size = common.asint(common.config.get(
+        "ckanext.dc_serve.condense_page_size", 0))
+    if page_size > 0:
+        # Free space is tracked in the file, so that it can be reused when
+        # the file is updated incrementally.
+        return {"fs_strategy": "page",
+                "fs_page_size": page_size,
+                "fs_persist": True}
+    return {}
+
+
+def get_condensed_layout() -> tuple:
+    """Return the configured chunk size in bytes and compression
+
+    A chunk size of 0 means that the chunks of dclab are kept.
+    """
+    chunk_bytes = common.asint(common.config.get(
+        "ckanext.dc_serve.condense_chunk_bytes", 0))
+    return max(chunk_bytes, 0), get_condensed_compression()
+
+
+def get_feature_chunks(dset: h5py.Dataset, chunk_bytes: int):
+    """Return the chunks of a scalar feature for the layout"""
+    if chunk_bytes > 0:
+        return (min(len(dset), max(1, chunk_bytes // dset.dtype.itemsize)),)
+    return dset.chunks or True
+
+
+def iter_layout_features(h5: h5py.File):
+    """Yield the scalar features to which the layout applies
+
+    These are the non-empty 1D datasets in the "events" and
+    "basin_events" groups.
+    """
+    for group_name in ["events", "basin_events"]:
+        group = h5.get(group_name)
+        if group is None:
+            continue
+        for feat in group:
+            dset = group[feat]
+            if (isinstance(dset, h5py.Dataset)
+                    and dset.ndim == 1 and len(dset) > 0):
+                yield dset
+
+
+def needs_condensed_layout(h5_cond: h5py.File) -> bool:
+    """Whether the features of a condensed file differ from the layout
+
+    Always False if ``ckanext.dc_serve.condense_chunk_bytes`` is not
+    set and ``ckanext.dc_serve.condense_compression`` is "zstd" (the
+    compression used by dclab). Features that already have the
+    layout (e.g. when a condensed file is updated incrementally) do
+    not count.
+    """
+    chunk_bytes, compression = get_condensed_layout()
+    if chunk_bytes == 0 and compression == "zstd":
+        return False
+    for dset in iter_layout_features(h5_cond):
+        if (get_feature_chunks(dset, chunk_bytes) != dset.chunks
+                or (get_compression_filter(dset)
+                    != COMPRESSION_FILTERS[compression])):
+            return True
+    return False
+
+
+def copy_condensed_layout(h5_src: h5py.File, h5_dst: h5py.File) -> None:
+    """Copy a condensed file to a new file with the configured layout
+
+    The scalar features are written with the configured chunks and
+    compression, all other objects and attributes are copied as they
+    are. Deleting and recreating the features in `h5_src` instead
+    would leave their old extents unused in the file (HDF5 does not
+    reclaim them by default), so the file would grow.
+    """
+    chunk_bytes, compression = get_condensed_layout()
+    features = {dset.name for dset in iter_layout_features(h5_src)}
+    h5_dst.attrs.update(h5_src.attrs)
+    for name in h5_src:
+        if name not in ["events", "basin_events"]:
+            h5_src.copy(h5_src[name], h5_dst, name=name)
+            continue
+        group = h5_dst.create_group(name)
+        group.attrs.update(h5_src[name].attrs)
+        for feat in h5_src[name]:
+            dset = h5_src[name][feat]
+            if dset.name not in features:
+                h5_src.copy(dset, group, name=feat)
+                continue
+            dset_new = group.create_dataset(
+                feat,
+                data=dset[:],
+                chunks=get_feature_chunks(dset, chunk_bytes),
+                maxshape=dset.maxshape,
+                fletcher32=dset.fletcher32,
+                **COMPRESSIONS[compression])
+            dset_new.attrs.update(dset.attrs)
+    logger.info(f"Wrote {len(features)} condensed features with "
+                f"{compression} compression and "
+                f"{chunk_bytes or 'default'} chunk bytes")
+
+
+def get_compression_filter(dset: h5py.Dataset):
+    """Return the HDF5 compression filter of a dataset (or None)
+
+    The shuffle and checksum filters are ignored.
+    """
+    dcpl = dset.id.get_create_plist()
+    for ii in range(dcpl.get_nfilters()):
+        filter_id = dcpl.get_filter(ii)[0]
+        if filter_id not in [h5py.h5z.FILTER_SHUFFLE,
+                             h5py.h5z.FILTER_FLETCHER32]:
+            return filter_id
+    return None
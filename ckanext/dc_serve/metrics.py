@@ -0,0 +1,184 @@
+"""Prometheus metrics for dcserv and the download routes
+
+Metrics are collected per worker process and periodically added to a
+Redis hash (every ``ckanext.dc_serve.metrics_flush_interval`` seconds),
+so that the metrics route returns the sum over all workers. The
+metrics are rendered in the Prometheus text exposition format.
+Collection is disabled unless ``ckanext.dc_serve.metrics`` is set.
+"""
+import atexit
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from ckan import common
+from ckan.lib.redis import connect_to_redis
+
+
+logger = logging.getLogger(__name__)
+
+#: Redis hash in which the metrics of all workers are summed up
+METRICS_KEY = "ckanext.dc_serve:metrics"
+
+#: Upper bounds of histogram buckets in seconds
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                     5.0, 10.0, 30.0)
+
+#: Type and description of all metrics
+METRICS = {
+    "dcserv_request_duration_seconds": (
+        "histogram", "Duration of dcserv requests by query and format"),
+    "dcserv_errors_total": (
+        "counter", "Failed dcserv and download requests by query or route "
+                   "and error type"),
+    "dcserv_kernel_cache_requests_total": (
+        "counter", "Kernel cache lookups by backend and result (hit, miss)"),
+    "dcserv_kernel_cache_evictions_total": (
+        "counter", "Kernels evicted from the kernel cache by backend"),
+    "dcserv_kernel_loads_total": (
+        "counter", "Kernels loaded after a cache miss by source (converted, "
+                   "artifact, dc)"),
+    "dcserv_route_duration_seconds": (
+        "histogram", "Duration of the download routes by route"),
+    "dcserv_s3_request_duration_seconds": (
+        "histogram", "Duration of S3 operations by operation"),
+}
+
+_values = {}
+_lock = threading.Lock()
+_last_flush = [time.monotonic()]
+
+
+def is_enabled() -> bool:
+    """Whether metrics collection is enabled"""
+    return common.asbool(common.config.get("ckanext.dc_serve.metrics",
+                                           "false"))
+
+
+def _field(name: str, labels: dict) -> str:
+    """Return the sample name of a metric with labels"""
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{labels[key]}"' for key in sorted(labels))
+    return f"{name}{{{label_str}}}"
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increment a counter"""
+    if not is_enabled():
+        return
+    field = _field(name, labels)
+    with _lock:
+        _values[field] = _values.get(field, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation (in seconds) to a histogram"""
+    if not is_enabled():
+        return
+    # All buckets are created (with zero counts), so that the
+    # histogram is complete.
+    increments = {_field(f"{name}_sum", labels): value,
+                  _field(f"{name}_count", labels): 1}
+    for le in HISTOGRAM_BUCKETS + ("+Inf",):
+        field = _field(f"{name}_bucket", dict(labels, le=le))
+        increments[field] = int(le == "+Inf" or value <= le)
+    with _lock:
+        for field, inc_value in increments.items():
+            _values[field] = _values.get(field, 0) + inc_value
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    """Context manager that adds its duration to a histogram"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+def timed(name: str, error_label: str, **labels):
+    """Decorator that adds the duration of a function to a histogram
+
+    Exceptions (including those raised by :func:`flask.abort`) are
+    counted in "dcserv_errors_total" with `error_label` as label
+    value for the key "query".
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                try:
+                    return func(*args, **kwargs)
+                except BaseException as e:
+                    inc("dcserv_errors_total",
+                        query=error_label,
+                        error=e.__class__.__name__)
+                    raise
+        return wrapper
+    return decorator
+
+
+def flush() -> None:
+    """Add the metrics of this worker to the metrics in Redis"""
+    with _lock:
+        values = dict(_values)
+        _values.clear()
+        _last_flush[0] = time.monotonic()
+    if not values:
+        return
+    try:
+        pipe = connect_to_redis().pipeline(transaction=False)
+        for field, value in values.items():
+            pipe.hincrbyfloat(METRICS_KEY, field, value)
+        pipe.execute()
+    except BaseException:
+        logger.warning("Failed to flush dcserv metrics", exc_info=True)
+
+
+def maybe_flush() -> None:
+    """Flush the metrics if the flush interval elapsed"""
+    interval = float(common.config.get(
+        "ckanext.dc_serve.metrics_flush_interval", 5))
+    if time.monotonic() - _last_flush[0] >= interval:
+        flush()
+
+
+def render() -> str:
+    """Return the metrics of all workers in the Prometheus text format"""
+    flush()
+    samples = {}
+    for field, value in connect_to_redis().hgetall(METRICS_KEY).items():
+        if isinstance(field, bytes):
+            field = field.decode("utf-8")
+        samples[field] = float(value)
+
+    lines = []
+    for name, (kind, description) in sorted(METRICS.items()):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            prefixes = [f"{name}_bucket", f"{name}_sum", f"{name}_count"]
+        else:
+            prefixes = [name]
+        for prefix in prefixes:
+            for field in sorted(samples, key=_sort_key):
+                if field == prefix or field.startswith(prefix + "{"):
+                    lines.append(f"{field} {samples[field]!r}")
+    return "\n".join(lines) + "\n"
+
+
+def _sort_key(field: str) -> tuple:
+    """Sort samples by name and labels, histogram buckets by bound"""
+    if 'le="' not in field:
+        return field, 0
+    start = field.index('le="')
+    stop = field.index('"', start + 4)
+    return (field[:start] + field[stop:],
+            float(field[start + 4:stop].replace("+Inf", "inf")))
+
+
+atexit.register(flush)
@@ -1,26 +1,42 @@
+import logging
+
 from ckan import config
+import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
-from flask import Blueprint
+from flask import Blueprint, Flask
 
 from .cli import get_commands
+from .profiling import profiling_start, profiling_stop, profiling_teardown
 from . import helpers as dcor_helpers
 from . import jobs
-from .route_funcs import dccondense, dcresource
-from .serve import dcserv
+from .route_funcs import (
+    dccondense, dcresource, dcserv_binary, dcserv_cache_headers,
+    dcserv_metrics, dcserv_metrics_flush, dcserv_not_modified
+)
+from .serve import (
+    bulk_update_delete, bulk_update_private, bulk_update_public, dcserv,
+    dcserv_batch, dcserv_kernel_cache_stats, delete_kernel_artifact,
+    invalidate_resource, package_update
+)
 
 from dcor_shared import s3
 
 
+logger = logging.getLogger(__name__)
+
+
 class DCServePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IBlueprint)
     plugins.implements(plugins.IClick)
     plugins.implements(plugins.IConfigurer, inherit=True)
     plugins.implements(plugins.IConfigDeclaration, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IActions, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IBlueprint
     def get_blueprint(self):
@@ -37,9 +53,23 @@ class DCServePlugin(plugins.SingletonPlugin):
             ('/dataset/<uuid:ds_id>/resource/<uuid:res_id>/download/<name>',
              'dcresource',
              dcresource),
+            ('/api/dcserv/<uuid:res_id>/<query>',
+             'dcserv_binary',
+             dcserv_binary),
+            ('/api/dcserv/metrics',
+             'dcserv_metrics',
+             dcserv_metrics),
         ]
         for rule in rules:
             blueprint.add_url_rule(*rule)
+        # Conditional GET requests for dcserv (the ETag and Cache-Control
+        # headers are set in `make_middleware`)
+        blueprint.before_app_request(dcserv_not_modified)
+        blueprint.after_app_request(dcserv_metrics_flush)
+        # Opt-in profiling of dcserv and download requests
+        blueprint.before_app_request(profiling_start)
+        blueprint.after_app_request(profiling_stop)
+        blueprint.teardown_app_request(profiling_teardown)
         return blueprint
 
     # IClick
@@ -74,6 +104,139 @@ class DCServePlugin(plugins.SingletonPlugin):
             "temporary directory for creating condensed resource files"
         )
 
+        declaration.declare_int(
+            dc_serve_group.condense_in_memory_max_bytes, 0).set_description(
+            "create condensed resource files in memory (instead of in the "
+            "temporary directory) if their estimated size is below this "
+            "number of bytes; set to 0 to always use the temporary directory"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.condense_page_size, 0).set_description(
+            "page size in bytes of the paged file space strategy for "
+            "condensed resource files (small objects are allocated in pages "
+            "of this size); set to 0 to use the default strategy"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.condense_chunk_bytes, 0).set_description(
+            "chunk size in bytes of the features in condensed resource "
+            "files; set to 0 to use the chunks chosen by dclab"
+        )
+
+        declaration.declare(
+            dc_serve_group.condense_compression, "zstd").set_description(
+            "compression of the features in condensed resource files "
+            "('zstd', 'gzip', or 'none')"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.upload_part_size, 64 * 1024**2).set_description(
+            "part size in bytes for uploading condensed and kernel artifacts "
+            "to S3; larger artifacts are uploaded in multiple parts"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.upload_max_concurrency, 4).set_description(
+            "number of parts uploaded in parallel when uploading condensed "
+            "and kernel artifacts to S3"
+        )
+
+        declaration.declare(
+            dc_serve_group.kernel_cache, "memory").set_description(
+            "backend for caching resource kernels ('memory' for an "
+            "in-process cache, 'sqlite' for a cache on the local disk "
+            "shared by all workers, or 'redis' for a cache in the Redis "
+            "instance configured for CKAN)"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.kernel_cache_max_bytes,
+            256 * 1024**2).set_description(
+            "maximum estimated size of all cached resource kernels in bytes "
+            "(per worker for the 'memory' backend, ignored by the 'redis' "
+            "backend); least recently used kernels are evicted first"
+        )
+
+        declaration.declare(dc_serve_group.kernel_cache_path).set_description(
+            "location of the SQLite database file for the 'sqlite' kernel "
+            "cache backend; if not specified, a file in the system's "
+            "temporary directory is used"
+        )
+
+        declaration.declare(
+            dc_serve_group.presigned_url_reuse_fraction, 0.5
+        ).set_description(
+            "fraction of the lifetime of presigned basin URLs for private "
+            "resources after which new URLs are generated (URLs are reused "
+            "before that)"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.max_threads, 8).set_description(
+            "maximum number of threads per worker for serving data "
+            "concurrently (e.g. loading resource kernels in dcserv_batch)"
+        )
+
+        declaration.declare_int(
+            dc_serve_group.max_open_threads, 4).set_description(
+            "maximum number of threads per worker for opening resources on "
+            "S3 concurrently (e.g. the original and condensed resource when "
+            "building a resource kernel)"
+        )
+
+        declaration.declare(
+            dc_serve_group.resource_info_ttl, 60).set_description(
+            "time in seconds for which database information about resources "
+            "(dataset, organization, privacy) is cached by dcserv; set to 0 "
+            "to disable caching"
+        )
+
+        declaration.declare_bool(
+            dc_serve_group.metrics, False).set_description(
+            "collect Prometheus metrics for dcserv and the download routes "
+            "(available to sysadmins via /api/dcserv/metrics)"
+        )
+
+        declaration.declare(
+            dc_serve_group.metrics_flush_interval, 5).set_description(
+            "interval in seconds in which workers add their metrics to the "
+            "metrics shared via Redis"
+        )
+
+        declaration.declare(dc_serve_group.profile_dir).set_description(
+            "directory to which cProfile statistics of dcserv and download "
+            "requests are written; profiling is disabled if not set"
+        )
+
+        declaration.declare(
+            dc_serve_group.profile_sample_fraction, 0).set_description(
+            "fraction of dcserv and download requests that are profiled "
+            "(sysadmins may request profiling with the 'profile' parameter)"
+        )
+
+        declaration.declare(
+            dc_serve_group.invalidation_poll_interval, 1).set_description(
+            "interval in seconds in which workers check whether other "
+            "workers invalidated cached resource information (e.g. after "
+            "a resource was updated or a dataset was made public)"
+        )
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        """Set the dcserv cache headers after CKAN's after-request handler
+
+        Flask calls after-request functions in the reverse order of
+        their registration. CKAN's `ckan_after_request` (registered
+        before the blueprints of all plugins) sets the max-age of all
+        cacheable responses to ``ckan.cache_expires``, so the headers
+        of dcserv responses are set by a function that runs after it.
+        """
+        if isinstance(app, Flask):
+            app.after_request_funcs.setdefault(None, []).insert(
+                0, dcserv_cache_headers)
+        return app
+
     # IResourceController
     def after_resource_create(self, context, resource):
         """Generate condensed dataset"""
@@ -81,10 +244,36 @@ class DCServePlugin(plugins.SingletonPlugin):
             # All jobs are defined via decorators in jobs.py
             jobs.RQJob.enqueue_all_jobs(resource, ckanext="dc_serve")
 
+    def after_resource_update(self, context, resource):
+        """Evict cached information (e.g. a changed mimetype)"""
+        invalidate_resource(resource["id"])
+
+    def before_resource_delete(self, context, resource, resources):
+        """Evict cached information and delete the kernel artifact"""
+        invalidate_resource(resource["id"])
+        _delete_kernel_artifact(resource["id"])
+
+    # IPackageController
+    def after_dataset_delete(self, context, pkg_dict):
+        """Evict cached information and delete the kernel artifacts"""
+        pkg = model.Package.get(pkg_dict["id"])
+        if pkg is not None:
+            for res in pkg.resources:
+                invalidate_resource(res.id)
+                _delete_kernel_artifact(res.id)
+
     # IActions
     def get_actions(self):
         # Registers the custom API method
-        return {'dcserv': dcserv}
+        return {'dcserv': dcserv,
+                'dcserv_batch': dcserv_batch,
+                'dcserv_kernel_cache_stats': dcserv_kernel_cache_stats,
+                # invalidate cached information if the privacy changed
+                'bulk_update_delete': bulk_update_delete,
+                'bulk_update_private': bulk_update_private,
+                'bulk_update_public': bulk_update_public,
+                'package_update': package_update,
+                }
 
     # ITemplateHelpers
     def get_helpers(self):
@@ -96,3 +285,17 @@ class DCServePlugin(plugins.SingletonPlugin):
                 dcor_helpers.resource_has_condensed,
         }
         return hlps
+
+
+def _delete_kernel_artifact(resource_id):
+    """Delete the kernel artifact of a resource, logging failures
+
+    The kernel artifact is only an optimization. If a deleted dataset
+    is restored, dcserv extracts the kernels from the resource files.
+    """
+    if s3.is_available():
+        try:
+            delete_kernel_artifact(resource_id)
+        except BaseException:
+            logger.error(f"Failed to delete kernel artifact of {resource_id}",
+                         exc_info=True)
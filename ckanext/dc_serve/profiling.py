@@ -0,0 +1,124 @@
+"""Opt-in profiling of dcserv and download requests
+
+If ``ckanext.dc_serve.profile_dir`` is set, requests to dcserv
+(API actions and the binary route) and to the download routes are
+profiled with :mod:`cProfile`
+
+- for a random fraction (``ckanext.dc_serve.profile_sample_fraction``)
+  of all requests and
+- for requests by sysadmins with the ``profile`` request argument set
+  (e.g. "/api/3/action/dcserv?id=...&query=tables&profile=1").
+
+The statistics (loadable with :class:`pstats.Stats`) are written to
+"<profile_dir>/<resource_id>/<query>_<time_ns>_<pid>.pstats". Only the
+thread handling the request is profiled (not the thread pool used
+by dcserv_batch).
+"""
+import cProfile
+import logging
+import os
+import pathlib
+import random
+import re
+import time
+
+from ckan import authz, common
+from ckan.common import c
+import flask
+
+
+logger = logging.getLogger(__name__)
+
+#: API actions that are profiled
+PROFILED_ACTIONS = ["dcserv", "dcserv_batch"]
+
+#: Endpoints of this extension's blueprint that are profiled
+PROFILED_ROUTES = ["dccondense", "dcresource", "dcserv_binary"]
+
+
+def get_request_profile_key():
+    """Return resource ID and query of the current request
+
+    Returns None if the request is not profiled (not a dcserv or
+    download request). Both values are sanitized so that they can
+    be used as file names.
+    """
+    endpoint = flask.request.endpoint or ""
+    view_args = flask.request.view_args or {}
+    if endpoint.startswith("api.") \
+            and view_args.get("logic_function") in PROFILED_ACTIONS:
+        if view_args["logic_function"] == "dcserv_batch":
+            rid, query = "batch", "batch"
+        else:
+            rid = flask.request.args.get("id", "unknown")
+            query = flask.request.args.get("query", "unknown")
+    elif endpoint.rsplit(".", 1)[-1] in PROFILED_ROUTES:
+        rid = str(view_args.get("res_id", "unknown"))
+        query = view_args.get("query", endpoint.rsplit(".", 1)[-1])
+    else:
+        return None
+    return (re.sub(r"[^0-9a-zA-Z_-]", "_", rid)[:64],
+            re.sub(r"[^0-9a-zA-Z_-]", "_", query)[:64])
+
+
+def is_profiling_requested() -> bool:
+    """Whether the current request should be profiled"""
+    if (common.asbool(flask.request.args.get("profile", "false"))
+            and c.user and authz.is_sysadmin(c.user)):
+        return True
+    fraction = float(common.config.get(
+        "ckanext.dc_serve.profile_sample_fraction", 0))
+    return fraction > 0 and random.random() < fraction
+
+
+def profiling_start():
+    """Start profiling the current request if requested
+
+    This is registered as a `before_app_request` function.
+    """
+    profile_dir = common.config.get("ckanext.dc_serve.profile_dir")
+    if not profile_dir:
+        return
+    key = get_request_profile_key()
+    if key is None or not is_profiling_requested():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active (e.g. in another thread with
+        # Python 3.12+, where only one profiler can be active).
+        logger.info("Not profiling request, profiler already active")
+        return
+    flask.g.dc_serve_profile = (profiler, key, pathlib.Path(profile_dir))
+
+
+def profiling_stop(response):
+    """Stop profiling and write the statistics to the profile directory
+
+    This is registered as an `after_app_request` function.
+    """
+    item = flask.g.pop("dc_serve_profile", None)
+    if item is not None:
+        profiler, (rid, query), profile_dir = item
+        profiler.disable()
+        path = (profile_dir / rid
+                / f"{query}_{time.time_ns()}_{os.getpid()}.pstats")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(path))
+        except OSError:
+            logger.warning(f"Failed to write profile {path}", exc_info=True)
+        else:
+            logger.info(f"Wrote profile {path}")
+    return response
+
+
+def profiling_teardown(exc):
+    """Make sure the profiler is disabled if a request failed
+
+    This is registered as a `teardown_app_request` function.
+    """
+    item = flask.g.pop("dc_serve_profile", None)
+    if item is not None:
+        item[0].disable()
@@ -39,9 +39,17 @@ class CKANResourceFileLock:
         lock_successful: bool
             Returns True if the lock was acquired
         """
-        if not self.is_locked and not self.lockfile.exists():
-            self.lockfile.touch()
-            self.is_locked = True
+        if not self.is_locked:
+            try:
+                # Create the lock file atomically, so that two processes
+                # can never acquire the same lock.
+                fd = os.open(self.lockfile,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                os.close(fd)
+                self.is_locked = True
         return self.is_locked
 
     def release(self):
@@ -1,4 +1,5 @@
 import pathlib
+import time
 
 import flask
 from ckan.common import config, c
@@ -10,7 +11,180 @@ import ckan.plugins.toolkit as toolkit
 import botocore.exceptions
 from dcor_shared import s3
 
+from . import metrics
+from .kernel_cache import record_resource_access
+from .serve import (
+    check_binary_query, check_resource_access, get_dcserv_etag,
+    get_dcserv_select, get_query_etag, is_dc_resource, is_resource_public,
+    serve_query_binary
+)
 
+
+#: Max-age (Cache-Control) of dcserv responses for public resources
+DCSERV_PUBLIC_MAX_AGE = 3600
+
+
+def dcserv_cache_headers(response):
+    """Set ETag and Cache-Control headers for dcserv responses
+
+    This function must run after CKAN's `ckan_after_request`, which
+    sets the max-age of all cacheable responses to
+    ``ckan.cache_expires``. Therefore, it is not registered via the
+    blueprint, but inserted as the last after-request function of
+    the Flask app (see :meth:`.plugin.DCServePlugin.make_middleware`).
+
+    The ETag is only defined (in `flask.g`) by the dcserv action, the
+    binary route, and :func:`dcserv_not_modified` for queries that
+    depend only on the resource kernel.
+    """
+    etag = flask.g.get("dc_serve_etag")
+    if etag is None or response.status_code not in [200, 304]:
+        return response
+
+    response.set_etag(etag)
+    cc = response.cache_control
+    if flask.g.get("dc_serve_public"):
+        # CKAN marks responses for logged-in users as private, which
+        # is not necessary for public resources.
+        cc.private = None
+        cc.public = True
+        cc.max_age = DCSERV_PUBLIC_MAX_AGE
+        cc.must_revalidate = True
+    else:
+        cc.public = None
+        cc.max_age = None
+        cc.private = True
+        # always revalidate using the ETag
+        cc.no_cache = True
+    if response.status_code == 304:
+        return response
+    return response.make_conditional(flask.request)
+
+
+def dcserv_not_modified():
+    """Answer conditional GET requests to the dcserv action early
+
+    This is registered as a `before_app_request` function. If a GET
+    request to the dcserv action has an `If-None-Match` header that
+    matches the ETag of the query (computed from the resource kernel),
+    then "304 Not Modified" is returned without serving the query and
+    without CKAN encoding the JSON response. In all other cases
+    (including errors), the request is handled by the dcserv action.
+    """
+    request = flask.request
+    if (not request.if_none_match
+            or request.method != "GET"
+            or not (request.endpoint or "").startswith("api.")
+            or (request.view_args or {}).get("logic_function") != "dcserv"
+            or request.args.get("version", "2") != "2"
+            or request.args.get("format", "json") != "json"):
+        return None
+    rid = request.args.get("id")
+    query = request.args.get("query")
+    if not rid or not query:
+        return None
+    context = {'model': model, 'session': model.Session,
+               'user': c.user, 'auth_user_obj': c.userobj}
+    try:
+        check_resource_access(context, rid)
+        if not is_dc_resource(rid):
+            return None
+        etag = get_dcserv_etag(rid, query, get_dcserv_select(request.args))
+    except (logic.NotFound, logic.NotAuthorized, logic.ValidationError):
+        return None
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    flask.g.dc_serve_etag = etag
+    flask.g.dc_serve_public = is_resource_public(rid)
+    return flask.Response(status=304)
+
+
+def dcserv_metrics():
+    """Serve metrics in the Prometheus text format (sysadmins only)
+
+    Returns 404 unless ``ckanext.dc_serve.metrics`` is enabled.
+    """
+    if not metrics.is_enabled():
+        return toolkit.abort(404, toolkit._('Metrics are disabled'))
+    context = {'model': model, 'session': model.Session,
+               'user': c.user, 'auth_user_obj': c.userobj}
+    try:
+        logic.check_access("sysadmin", context)
+    except logic.NotAuthorized:
+        return toolkit.abort(403, toolkit._('Not authorized'))
+    return flask.Response(metrics.render(),
+                          mimetype="text/plain; version=0.0.4")
+
+
+def dcserv_metrics_flush(response):
+    """Periodically add the metrics of this worker to the shared metrics
+
+    This is registered as an `after_app_request` function.
+    """
+    if metrics.is_enabled():
+        metrics.maybe_flush()
+    return response
+
+
+def dcserv_binary(res_id, query):
+    """Serve the result of a dcserv query in a binary format
+
+    `res_id` is a string or uuid, `query` is a dcserv query and the
+    format is specified via the "format" request argument (see
+    :func:`.serve.serve_query_binary`). In contrast to the dcserv
+    API action, the data are not wrapped in a JSON response.
+    """
+    context = {'model': model, 'session': model.Session,
+               'user': c.user, 'auth_user_obj': c.userobj}
+    rid = str(res_id)
+    fmt = flask.request.args.get("format")
+    try:
+        check_resource_access(context, rid)
+    except (logic.NotFound, logic.NotAuthorized):
+        # Treat not found and not authorized equally, to not leak information
+        # to unprivileged users.
+        return toolkit.abort(404, toolkit._('Resource not found'))
+
+    if not is_dc_resource(rid):
+        return toolkit.abort(
+            400, f"Resource ID {rid} must be an .rtdc dataset!")
+
+    # Validate the query before answering with 304 (Not Modified).
+    try:
+        check_binary_query(query, fmt)
+    except logic.ValidationError as e:
+        metrics.inc("dcserv_errors_total",
+                    query="invalid",
+                    error=e.__class__.__name__)
+        return toolkit.abort(400, e.error_dict["message"])
+
+    # ETag and caching headers are set in :func:`dcserv_cache_headers`.
+    etag = get_query_etag(rid, query)
+    if etag is not None:
+        flask.g.dc_serve_etag = f"{etag}-{fmt}"
+        flask.g.dc_serve_public = is_resource_public(rid)
+        if flask.request.if_none_match.contains_weak(flask.g.dc_serve_etag):
+            return flask.Response(status=304)
+
+    t0 = time.perf_counter()
+    data, mimetype = serve_query_binary(rid, query, fmt)
+    metrics.observe("dcserv_request_duration_seconds",
+                    time.perf_counter() - t0,
+                    query=query,
+                    format=fmt)
+    record_resource_access(rid)
+
+    suffix = "npz" if fmt == "npz" else "json.gz"
+    return flask.Response(
+        data,
+        mimetype=mimetype,
+        headers={"Content-Disposition":
+                 f'attachment; filename="{rid}_{query}.{suffix}"'})
+
+
+@metrics.timed("dcserv_route_duration_seconds",
+               error_label="dccondense",
+               route="dccondense")
 def dccondense(ds_id, res_id):
     """Access to the condensed resource
 
@@ -43,8 +217,10 @@ def dccondense(ds_id, res_id):
         object_name = f"condensed/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
         s3_client, _, _ = s3.get_s3()
         try:
-            s3_client.head_object(Bucket=bucket_name,
-                                  Key=object_name)
+            with metrics.timer("dcserv_s3_request_duration_seconds",
+                               operation="head_object"):
+                s3_client.head_object(Bucket=bucket_name,
+                                      Key=object_name)
         except botocore.exceptions.ClientError:
             pass
         else:
@@ -57,11 +233,13 @@ def dccondense(ds_id, res_id):
                 expiration = 3600
             else:
                 expiration = 86400
-            ps_url = s3.create_presigned_url(
-                bucket_name=bucket_name,
-                object_name=object_name,
-                filename=cond_name,
-                expiration=expiration)
+            with metrics.timer("dcserv_s3_request_duration_seconds",
+                               operation="presign"):
+                ps_url = s3.create_presigned_url(
+                    bucket_name=bucket_name,
+                    object_name=object_name,
+                    filename=cond_name,
+                    expiration=expiration)
             return toolkit.redirect_to(ps_url)
 
     # We don't have an S3 object, so we have to deliver the internal
@@ -79,6 +257,9 @@ def dccondense(ds_id, res_id):
     return toolkit.abort(404, toolkit._('No condensed download available'))
 
 
+@metrics.timed("dcserv_route_duration_seconds",
+               error_label="dcresource",
+               route="dcresource")
 def dcresource(ds_id, res_id, name):
     """Access to the resource data
 
@@ -114,8 +295,10 @@ def dcresource(ds_id, res_id, name):
         object_name = f"resource/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
         s3_client, _, _ = s3.get_s3()
         try:
-            s3_client.head_object(Bucket=bucket_name,
-                                  Key=object_name)
+            with metrics.timer("dcserv_s3_request_duration_seconds",
+                               operation="head_object"):
+                s3_client.head_object(Bucket=bucket_name,
+                                      Key=object_name)
         except botocore.exceptions.ClientError:
             pass
         else:
@@ -128,11 +311,13 @@ def dcresource(ds_id, res_id, name):
                 expiration = 3600
             else:
                 expiration = 86400
-            ps_url = s3.create_presigned_url(
-                bucket_name=bucket_name,
-                object_name=object_name,
-                filename=res_dict["name"],
-                expiration=expiration)
+            with metrics.timer("dcserv_s3_request_duration_seconds",
+                               operation="presign"):
+                ps_url = s3.create_presigned_url(
+                    bucket_name=bucket_name,
+                    object_name=object_name,
+                    filename=res_dict["name"],
+                    expiration=expiration)
             return toolkit.redirect_to(ps_url)
 
     # We don't have an S3 object, so we have to deliver the local
@@ -1,23 +1,125 @@
 import atexit
+import collections
+import concurrent.futures
 import copy
 import functools
+import gzip
+import hashlib
+import json
 import logging
+import os
+import threading
 import time
+import traceback
 
 import ckan.common as common
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
-from dcor_shared import (
-    DC_MIME_TYPES, s3cc, is_resource_private,
-)
+import botocore.exceptions
+from dclab.rtdc_dataset import fmt_s3
+from dcor_shared import DC_MIME_TYPES, s3, s3cc
+
+import flask
 
-import numpy as np
+from . import metrics
+from .invalidation import get_invalidation_listener, publish_invalidation
+from .kernel_cache import (
+    get_condensed_signal, get_kernel_cache, kernel_build_lock,
+    record_resource_access
+)
+from .tables import (
+    get_table_descr, list_to_table, table_to_list, tables_to_npz
+)
 
 
 logger = logging.getLogger(__name__)
 
+#: Version of the kernel document stored as "kernel" artifact on S3
+#: (increment when the structure of the document changes)
+KERNEL_ARTIFACT_VERSION = 1
+
+#: Initial and maximum time in seconds to wait before retrying to
+#: complement a kernel with condensed resource information after a failure
+#: (the waiting time doubles with every failure)
+CONDENSED_RETRY_INITIAL = 10
+CONDENSED_RETRY_MAX = 3600
+
+#: Sections of a resource kernel that are loaded independently of each
+#: other (see :func:`get_resource_kernel`)
+KERNEL_SECTIONS = ["config", "trace_list", "tables", "logs", "basins"]
+
+#: Kernel sections that are complemented with information from the
+#: condensed resource
+KERNEL_CONDENSED_SECTIONS = ["logs", "basins"]
+
+#: Kernel sections that are always extracted from the original resource
+#: (the metadata in the condensed resource differ, e.g. dclab appends its
+#: version to "setup:software version")
+KERNEL_ORIGINAL_SECTIONS = ["config", "trace_list", "basins"]
+
+#: Kernel sections for which the condensed resource is opened (the
+#: other sections only require the original resource)
+KERNEL_CONDENSED_OPEN_SECTIONS = ["tables", "logs", "basins"]
+
+#: Resource kernel sections stored in the kernel artifact
+KERNEL_ARTIFACT_SECTIONS = ["config", "trace_list", "tables",
+                            "table_dtypes", "logs", "basin_features"]
+
+#: Resource kernel keys serialized for computing the kernel ETags
+#: (see :func:`set_resource_kernel_digest`)
+KERNEL_ETAG_KEYS = ["config", "logs", "tables", "trace_list", "basin_dicts",
+                    "basin_features"]
+
+#: Queries supported by :func:`dcserv`
+DCSERV_QUERIES = ["basins", "feature_list", "logs", "logs_list", "metadata",
+                  "size", "tables", "tables_list", "trace_list", "valid"]
+
+#: Queries that support selecting entries via the `name`, `offset`, and
+#: `limit` parameters (see :func:`select_entries`)
+DCSERV_SELECT_QUERIES = ["logs", "tables"]
+
+#: Binary formats (and their mimetypes) supported by
+#: :func:`serve_query_binary` for each query
+DCSERV_BINARY_FORMATS = {
+    "logs": {"gzip": "application/gzip"},
+    "tables": {"npz": "application/octet-stream"},
+}
+
+#: Kernel sections required by dcserv queries (only these sections are
+#: loaded and the ETags of the queries are derived from them)
+DCSERV_QUERY_SECTIONS = {"basins": "basins",
+                         "logs": "logs",
+                         "logs_list": "logs",
+                         "metadata": "config",
+                         "size": "config",
+                         "tables": "tables",
+                         "tables_list": "tables",
+                         "trace_list": "trace_list",
+                         }
+
+#: Maximum number of resources in one :func:`dcserv_batch` request
+DCSERV_BATCH_MAX_RESOURCES = 500
+
+#: Maximum number of presigned URLs cached by :func:`get_presigned_url`
+PRESIGNED_URL_CACHE_SIZE = 4096
+
+#: Maximum number of resources cached by :func:`is_dc_resource`
+IS_DC_RESOURCE_CACHE_SIZE = 16384
+
+_presigned_url_cache = collections.OrderedDict()
+_presigned_url_lock = threading.Lock()
+
+#: Maximum number of resources cached by :func:`get_resource_info`
+RESOURCE_INFO_CACHE_SIZE = 16384
+
+_dc_resource_cache = collections.OrderedDict()
+_dc_resource_lock = threading.Lock()
+
+_resource_info_cache = collections.OrderedDict()
+_resource_info_lock = threading.Lock()
+
 
 def admin_context():
     return {'ignore_auth': True, 'user': 'default'}
@@ -45,16 +147,25 @@ def get_dc_tables(ds, from_basins: bool = False) -> dict:
                 tables.update(get_dc_tables(bn.ds))
     else:
         for tab in ds.tables:
-            tab_list = ds.tables[tab][:].tolist()
-            # find any NaNs and replace them with None (JSON compatibility)
-            tab_list = replace_nan_with_none_recursive(tab_list)
+            # NaNs are replaced with None (JSON compatibility)
             tables[tab] = (ds.tables[tab].keys(),
-                           tab_list
+                           table_to_list(ds.tables[tab][:])
                            )
 
     return tables
 
 
+def get_dc_table_dtypes(ds) -> dict:
+    """Return the dtype descriptions of the tables of a dataset
+
+    The descriptions are required for restoring the tables returned
+    by :func:`get_dc_tables` in binary responses (see
+    :func:`.tables.get_table_descr`).
+    """
+    # Only read the first row, we are only interested in the dtype.
+    return {tab: get_table_descr(ds.tables[tab][:1]) for tab in ds.tables}
+
+
 # Required so that GET requests work
 @toolkit.side_effect_free
 def dcserv(context, data_dict=None):
@@ -64,14 +175,24 @@ def dcserv(context, data_dict=None):
     'query'. Query may be one of the following:
 
      - 'logs': dictionary of logs
+     - 'logs_list': list of log names
      - 'metadata': the metadata configuration dictionary
      - 'size': the number of events in the dataset
      - 'tables': dictionary of tables (each entry consists of a tuple
         with the column names and the array data)
+     - 'tables_list': list of table names
      - 'basins': list of basin dictionaries (upstream and http data)
      - 'trace_list': list of available traces
      - 'valid': whether the corresponding .rtdc file is accessible.
      - 'version': which version of the API to use (defaults to 2);
+     - 'format': must be 'json' (default); binary formats are served
+       via the `/api/dcserv/<resource_id>/<query>` route (see
+       :func:`serve_query_binary`)
+
+    For the 'logs' and 'tables' queries, the optional keys 'name'
+    (return only the log lines or the table with that name instead of
+    a dictionary), 'offset', and 'limit' (return only `limit` log lines
+    or table rows starting at `offset`) are supported.
 
     .. versionchanged: 0.15.0
 
@@ -98,11 +219,14 @@ def dcserv(context, data_dict=None):
                                     "'2' instead!")
     if data_dict["version"] not in ["2"]:
         raise logic.ValidationError("Please specify version '1' or '2'!")
+    if data_dict.get("format", "json") != "json":
+        raise logic.ValidationError(
+            f"Format '{data_dict['format']}' is not supported by the "
+            f"dcserv action, please use the route "
+            f"/api/dcserv/<resource_id>/<query>?format=...")
 
     # Perform all authorization checks for the resource
-    logic.check_access("resource_show",
-                       context=context,
-                       data_dict={"id": data_dict["id"]})
+    check_resource_access(context, data_dict["id"])
 
     query = data_dict["query"]
     rid = data_dict["id"]
@@ -112,76 +236,718 @@ def dcserv(context, data_dict=None):
         raise logic.ValidationError(
             f"Resource ID {rid} must be an .rtdc dataset!")
 
+    select = get_dcserv_select(data_dict)
+
+    t0 = time.perf_counter()
+    try:
+        data = serve_query(rid, query, **(select or {}))
+    except BaseException as e:
+        metrics.inc("dcserv_errors_total",
+                    query=query if query in DCSERV_QUERIES else "invalid",
+                    error=e.__class__.__name__)
+        raise
+    metrics.observe("dcserv_request_duration_seconds",
+                    time.perf_counter() - t0,
+                    query=query,
+                    format="json")
+    record_resource_access(rid)
+
+    if flask.has_request_context():
+        # ETag and caching headers are set in
+        # :func:`.route_funcs.dcserv_cache_headers`.
+        etag = get_dcserv_etag(rid, query, select)
+        if etag is not None:
+            flask.g.dc_serve_etag = etag
+            flask.g.dc_serve_public = is_resource_public(rid)
+    return data
+
+
+@toolkit.side_effect_free
+def dcserv_batch(context, data_dict=None):
+    """Serve DC data for multiple resources and queries via the CKAN API
+
+    Required keys in `data_dict` are 'ids' (list of resource ids) and
+    'queries' (list of queries, see :func:`dcserv`). Both may also be
+    given as comma-separated strings.
+
+    The "result" value is a dictionary with the resource IDs as keys.
+    Each value is a dictionary with the queries as keys and either
+    ``{"success": True, "result": ...}`` or
+    ``{"success": False, "error": "..."}`` as values. Errors concerning
+    a resource (not found, not authorized, not a DC resource) are
+    reported for each query of that resource.
+
+    Access is checked for every resource like in :func:`dcserv`
+    (including the state of the resource and its dataset) and the
+    resource kernels are loaded concurrently.
+    """
+    if data_dict is None:
+        data_dict = {}
+    data_dict.setdefault("version", "2")
+
+    ids = _as_list(data_dict.get("ids"))
+    queries = _as_list(data_dict.get("queries"))
+    if not ids:
+        raise logic.ValidationError("Please specify 'ids' parameter!")
+    if not queries:
+        raise logic.ValidationError("Please specify 'queries' parameter!")
+    if data_dict["version"] not in ["2"]:
+        raise logic.ValidationError("Please specify version '2'!")
+    if len(ids) > DCSERV_BATCH_MAX_RESOURCES:
+        raise logic.ValidationError(
+            f"Please specify at most {DCSERV_BATCH_MAX_RESOURCES} "
+            f"resources per request!")
+    for query in queries:
+        if query not in DCSERV_QUERIES:
+            raise logic.ValidationError(
+                f"Invalid query parameter '{query}'!")
+    ids = list(dict.fromkeys(ids))  # unique, but keep order
+
+    results = {}
+    todo = []
+    for rid in ids:
+        # Same checks as for a single dcserv request. Auth functions
+        # cache objects in the context, so every resource gets its own.
+        res_context = {k: v for k, v in context.items()
+                       if k not in ["package", "resource"]}
+        try:
+            check_resource_access(res_context, rid)
+            info = get_resource_info(rid)
+            if info is None or not info["active"]:
+                raise logic.NotFound(f"Resource {rid} not found")
+        except logic.NotFound:
+            error = "Not found"
+        except logic.NotAuthorized:
+            error = f"Not authorized to read resource {rid}"
+        else:
+            if is_dc_resource(rid):
+                todo.append((rid, not info["private"]))
+                continue
+            error = f"Resource ID {rid} must be an .rtdc dataset!"
+        results[rid] = {q: {"success": False, "error": error}
+                        for q in queries}
+
+    t0 = time.perf_counter()
+    # Everything that touches the database must happen in this thread,
+    # so the bucket names are looked up here and passed to the pool.
+    pool = get_thread_pool()
+    futures = {}
+    for rid, public in todo:
+        bucket_name = s3cc.get_s3_bucket_name_for_resource(rid)
+        futures[rid] = pool.submit(_serve_queries, rid, queries, public,
+                                   bucket_name)
+    for rid, future in futures.items():
+        results[rid] = future.result()
+    metrics.observe("dcserv_request_duration_seconds",
+                    time.perf_counter() - t0,
+                    query="batch",
+                    format="json")
+    return results
+
+
+def _as_int(data_dict, key, default):
+    """Return a non-negative integer parameter from `data_dict`"""
+    value = data_dict.get(key)
+    if value is None or value == "":
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise logic.ValidationError(
+            f"Parameter '{key}' must be a non-negative integer!")
+    return value
+
+
+def _as_list(value) -> list:
+    """Convert comma-separated strings or lists to lists"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip() for v in value if v.strip()]
+
+
+def _serve_queries(resource_id, queries, public, bucket_name) -> dict:
+    """Answer multiple queries for a resource (used by :func:`dcserv_batch`)
+
+    Exceptions are caught and reported per query. This function runs
+    in a thread pool and does not access the database (`public` and
+    `bucket_name` are looked up in the request thread).
+    """
+    record_resource_access(resource_id)
+    results = {}
+    for query in queries:
+        try:
+            data = serve_query(resource_id, query, public=public,
+                               bucket_name=bucket_name)
+        except logic.ValidationError as e:
+            results[query] = {"success": False,
+                              "error": e.error_dict.get("message",
+                                                        str(e.error_dict))}
+        except BaseException as e:
+            metrics.inc("dcserv_errors_total",
+                        query=query,
+                        error=e.__class__.__name__)
+            logger.error(f"Failed to serve '{query}' for {resource_id}")
+            logger.error(traceback.format_exc())
+            results[query] = {"success": False,
+                              "error": "Internal server error"}
+        else:
+            results[query] = {"success": True, "result": data}
+    return results
+
+
+def get_dcserv_select(data_dict) -> dict:
+    """Return the selection parameters of a dcserv request
+
+    Returns None if nothing is selected, otherwise the keyword
+    arguments "name", "offset", and "limit" for :func:`serve_query`.
+    """
+    select = {"name": data_dict.get("name"),
+              "offset": _as_int(data_dict, "offset", 0),
+              "limit": _as_int(data_dict, "limit", None),
+              }
+    if select == {"name": None, "offset": 0, "limit": None}:
+        return None
+    if data_dict.get("query") not in DCSERV_SELECT_QUERIES:
+        raise logic.ValidationError(
+            f"The parameters 'name', 'offset', and 'limit' are only "
+            f"supported for the queries {DCSERV_SELECT_QUERIES}!")
+    return select
+
+
+def get_dcserv_etag(resource_id, query, select=None):
+    """Return the ETag of the response of the dcserv action
+
+    This is the ETag of the query (see :func:`get_query_etag`) which
+    is extended by a hash of the selection parameters `select` (see
+    :func:`get_dcserv_select`).
+    """
+    etag = get_query_etag(resource_id, query)
+    if etag is not None and select is not None:
+        etag += "-" + hashlib.sha256(
+            json.dumps(select, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+    return etag
+
+
+def get_query_etag(resource_id, query, public=None):
+    """Return an ETag for the result of a dcserv query
+
+    Returns None for queries that do not depend only on the resource
+    kernel (e.g. "valid" or "basins" for private resources, which
+    contain presigned URLs).
+    """
+    section = DCSERV_QUERY_SECTIONS.get(query)
+    if section is None:
+        return None
+    r_data = get_query_kernel(resource_id, query, public=public)
+    if section == "basins" and not r_data["public"]:
+        return None
+    etags = r_data.get("etags")
+    if etags is None:
+        # kernel cached by an older version of this extension
+        etags = get_resource_kernel_etags(r_data)
+    return f"{query}-{etags[section]}"
+
+
+def get_query_kernel(resource_id, query, public=None, bucket_name=None):
+    """Return the resource kernel required for a dcserv query
+
+    Only the kernel section required for `query` is loaded. Returns
+    None for queries that do not need the kernel. Within a request,
+    the kernel is looked up only once (it is stored in
+    :data:`flask.g`), so that serving a query and computing its ETag
+    (see :func:`get_query_etag`) do not load it from the kernel cache
+    repeatedly. For `bucket_name`, see :func:`get_resource_kernel`.
+    """
+    section = DCSERV_QUERY_SECTIONS.get(query)
+    if section is None:
+        return None
+    if public is None:
+        public = is_resource_public(resource_id)
+    if not flask.has_request_context():
+        return get_resource_kernel(resource_id, public=public,
+                                   sections=[section],
+                                   bucket_name=bucket_name)
+    kernels = flask.g.setdefault("dc_serve_kernels", {})
+    key = (resource_id, public, section)
+    if key not in kernels:
+        kernels[key] = get_resource_kernel(resource_id, public=public,
+                                           sections=[section],
+                                           bucket_name=bucket_name)
+    return kernels[key]
+
+
+def serve_query(resource_id, query, public=None,
+                name=None, offset=0, limit=None, bucket_name=None):
+    """Return the result of a dcserv query for a DC resource
+
+    No access checks are performed here. If `public` is None, the
+    privacy of the resource is looked up in the database. The
+    parameters `name`, `offset`, and `limit` only apply to the
+    queries "logs" and "tables" (see :func:`select_entries`). If
+    `bucket_name` is None, the S3 bucket of the resource is looked
+    up in the database as well.
+    """
+    rid = resource_id
+    # only load the kernel section required for this query
+    r_data = get_query_kernel(rid, query, public=public,
+                              bucket_name=bucket_name)
     if query == "valid":
-        data = s3cc.artifact_exists(rid, artifact="resource")
+        with metrics.timer("dcserv_s3_request_duration_seconds",
+                           operation="head_object"):
+            data = s3.object_exists(*get_s3_bucket_object(
+                rid, artifact="resource", bucket_name=bucket_name))
     elif query == "metadata":
-        return get_resource_kernel(rid)["config"]
-    else:
-        if query == "feature_list":
-            # Don't return any features. Basins are responsible.
-            data = []
-        elif query == "logs":
-            data = get_resource_kernel(rid)["logs"]
-        elif query == "size":
-            data = get_resource_kernel(
-                rid)["config"]["experiment"]["event count"]
-        elif query == "basins":
-            r_data = get_resource_kernel(rid)
-            # Return all basins from the condensed file
-            # (the S3 basins are already in there).
-            if r_data["public"] and "basin_dicts" in r_data:
-                # We have a public resource and a complete set of basins.
-                data = copy.deepcopy(r_data["basin_dicts"])
-            else:
-                # We have a private resource and must work with presigned URLs.
-                # The basins just links to the original resource and
-                # condensed file.
-                data = get_resource_basins_dicts_private(rid)
-            # populate the basin features in-place
-            basin_features = r_data["basin_features"]
-            for bn_dict in data:
-                name = bn_dict["name"]
-                if name in basin_features:
-                    bn_dict["features"] = basin_features[name]
-        elif query == "tables":
-            data = get_resource_kernel(rid)["tables"]
-        elif query == "trace_list":
-            data = get_resource_kernel(rid)["trace_list"]
+        data = r_data["config"]
+    elif query == "feature_list":
+        # Don't return any features. Basins are responsible.
+        data = []
+    elif query == "logs":
+        data = select_entries(r_data["logs"],
+                              kind="log",
+                              name=name,
+                              offset=offset,
+                              limit=limit)
+    elif query == "logs_list":
+        data = sorted(r_data["logs"])
+    elif query == "size":
+        data = r_data["config"]["experiment"]["event count"]
+    elif query == "basins":
+        # Return all basins from the condensed file
+        # (the S3 basins are already in there).
+        if r_data["public"] and "basin_dicts" in r_data:
+            # We have a public resource and a complete set of basins.
+            data = copy.deepcopy(r_data["basin_dicts"])
         else:
-            raise logic.ValidationError(
-                f"Invalid query parameter '{query}'!")
+            # We have a private resource and must work with presigned URLs.
+            # The basins just links to the original resource and
+            # condensed file.
+            data = get_resource_basins_dicts_private(
+                rid, bucket_name=bucket_name)
+        # populate the basin features in-place
+        basin_features = r_data["basin_features"]
+        for bn_dict in data:
+            name = bn_dict["name"]
+            if name in basin_features:
+                bn_dict["features"] = basin_features[name]
+    elif query == "tables":
+        data = select_entries(r_data["tables"],
+                              kind="table",
+                              name=name,
+                              offset=offset,
+                              limit=limit)
+    elif query == "tables_list":
+        data = sorted(r_data["tables"])
+    elif query == "trace_list":
+        data = r_data["trace_list"]
+    else:
+        raise logic.ValidationError(
+            f"Invalid query parameter '{query}'!")
     return data
 
 
-@functools.lru_cache(maxsize=1024)
+def select_entries(entries, kind, name=None, offset=0, limit=None):
+    """Select a named log or table and slice its lines or rows
+
+    Parameters
+    ----------
+    entries: dict
+        Logs (lists of lines) or tables (tuples of column names and
+        rows) of a resource kernel
+    kind: str
+        Either "log" or "table"
+    name: str
+        If given, only the entry with that name is returned (instead
+        of a dictionary of entries)
+    offset: int
+        Index of the first line or row to return
+    limit: int
+        Maximum number of lines or rows to return per entry
+    """
+    if name is not None:
+        if name not in entries:
+            raise logic.ValidationError(f"The {kind} '{name}' does not "
+                                        f"exist!")
+        entries = {name: entries[name]}
+
+    if offset or limit is not None:
+        stop = None if limit is None else offset + limit
+        if kind == "table":
+            entries = {en: (columns, rows[offset:stop])
+                       for en, (columns, rows) in entries.items()}
+        else:
+            entries = {en: lines[offset:stop]
+                       for en, lines in entries.items()}
+
+    return entries if name is None else entries[name]
+
+
+def check_binary_query(query, fmt):
+    """Raise a ValidationError if `fmt` is not a binary format of `query`
+
+    Returns the dictionary of formats and mimetypes of `query` from
+    :const:`DCSERV_BINARY_FORMATS`. This check does not load any data.
+    """
+    formats = DCSERV_BINARY_FORMATS.get(query)
+    if formats is None:
+        raise logic.ValidationError(
+            f"Query '{query}' is not available in a binary format!")
+    if fmt not in formats:
+        raise logic.ValidationError(
+            f"Invalid format '{fmt}' for query '{query}', expected one "
+            f"of {sorted(formats)}!")
+    return formats
+
+
+def serve_query_binary(resource_id, query, fmt, public=None):
+    """Return the result of a dcserv query in a binary format
+
+    Returns a tuple of the data (bytes) and its mimetype. The supported
+    formats are defined in :const:`DCSERV_BINARY_FORMATS`:
+
+     - 'tables' as 'npz': compressed numpy .npz file with one
+       (structured) array per table, preserving column names and dtypes
+     - 'logs' as 'gzip': gzip-compressed JSON dictionary of logs
+
+    No access checks are performed here. If `public` is None, the
+    privacy of the resource is looked up in the database.
+    """
+    formats = check_binary_query(query, fmt)
+    r_data = get_query_kernel(resource_id, query, public=public)
+    if query == "tables":
+        # kernels created by older versions do not have dtypes
+        dtypes = r_data.get("table_dtypes", {})
+        arrays = {}
+        for tab, (names, table) in r_data["tables"].items():
+            arrays[tab] = list_to_table(names, table, dtypes.get(tab))
+        data = tables_to_npz(arrays)
+    else:  # logs
+        data = gzip.compress(json.dumps(r_data["logs"]).encode("utf-8"))
+    return data, formats[fmt]
+
+
+@toolkit.side_effect_free
+def dcserv_kernel_cache_stats(context, data_dict=None):
+    """Return statistics of the resource kernel cache (sysadmins only)
+
+    The returned dictionary contains the keys "backend", "hits",
+    "misses", "evictions", "entries", "bytes", "max_bytes", and
+    "pid". Hits, misses and evictions are counted for the worker
+    process (identified by "pid") that handled the request.
+    """
+    logic.check_access("sysadmin", context)
+    stats = get_kernel_cache().stats()
+    stats["pid"] = os.getpid()
+    return stats
+
+
+def check_resource_access(context, resource_id: str) -> None:
+    """Check whether the user may access a resource (via "resource_show")
+
+    The authorization functions are always run, so that overrides by
+    other plugins (IAuthFunctions) apply. Only the database lookups of
+    dcserv itself (see :func:`get_resource_info`) are cached. Raises
+    :class:`ckan.logic.NotFound` or :class:`ckan.logic.NotAuthorized`.
+    """
+    logic.check_access("resource_show",
+                       context=context,
+                       data_dict={"id": resource_id})
+
+
+def get_resource_info(resource_id: str):
+    """Return cached database information about a resource
+
+    Returns a dictionary with the keys "package_id", "organization_id",
+    "private", and "active" (whether the resource and its dataset are
+    active) or None if the resource does not exist. The information is
+    cached for ``ckanext.dc_serve.resource_info_ttl`` seconds or until
+    the resource is invalidated (see :func:`invalidate_resource`).
+    """
+    process_invalidations()
+    ttl = float(common.config.get("ckanext.dc_serve.resource_info_ttl", 60))
+    now = time.monotonic()
+    with _resource_info_lock:
+        item = _resource_info_cache.get(resource_id)
+        if item is not None and now < item[1] + ttl:
+            _resource_info_cache.move_to_end(resource_id)
+            return item[0]
+
+    row = model.Session.query(
+        model.Resource.state,
+        model.Package.id,
+        model.Package.owner_org,
+        model.Package.private,
+        model.Package.state,
+    ).join(model.Package, model.Package.id == model.Resource.package_id
+           ).filter(model.Resource.id == resource_id).first()
+    if row is None:
+        return None
+    res_state, pkg_id, org_id, private, pkg_state = row
+    info = {"package_id": pkg_id,
+            "organization_id": org_id,
+            "private": bool(private),
+            "active": res_state == "active" and pkg_state == "active",
+            }
+    if ttl > 0:
+        with _resource_info_lock:
+            _resource_info_cache[resource_id] = (info, now)
+            while len(_resource_info_cache) > RESOURCE_INFO_CACHE_SIZE:
+                _resource_info_cache.popitem(last=False)
+    return info
+
+
+def is_resource_public(resource_id: str) -> bool:
+    """Whether a resource belongs to a public dataset (cached)
+
+    Raises :class:`ckan.logic.NotFound` if the resource does not exist.
+    """
+    info = get_resource_info(resource_id)
+    if info is None:
+        raise logic.NotFound(f"Resource {resource_id} not found")
+    return not info["private"]
+
+
 def is_dc_resource(res_id) -> bool:
+    """Whether the resource with the ID `res_id` is a DC resource
+
+    The result is cached until the resource is updated or deleted
+    (see :func:`invalidate_resource`).
+    """
+    process_invalidations()
+    with _dc_resource_lock:
+        is_dc = _dc_resource_cache.get(res_id)
+        if is_dc is not None:
+            _dc_resource_cache.move_to_end(res_id)
+            return is_dc
     resource = model.Resource.get(res_id)
+    is_dc = is_dc_resource_object(resource)
+    with _dc_resource_lock:
+        _dc_resource_cache[res_id] = is_dc
+        while len(_dc_resource_cache) > IS_DC_RESOURCE_CACHE_SIZE:
+            _dc_resource_cache.popitem(last=False)
+    return is_dc
+
+
+def is_dc_resource_object(resource) -> bool:
+    """Whether a :class:`ckan.model.Resource` is a DC resource"""
     rs_name = resource.name
     is_dc = (
         # DCOR says this is a DC resource
         resource.mimetype in DC_MIME_TYPES
         # The suffix indicates that this is a DC resource
         # (in case ckanext-dcor_schemas has not yet updated the metadata)
-        or (rs_name.count(".")
-            and rs_name.rsplit(".", 1)[-1] in ["dc", "rtdc"])
+        or bool(rs_name.count(".")
+                and rs_name.rsplit(".", 1)[-1] in ["dc", "rtdc"])
     )
     return is_dc
 
 
-def get_resource_basins_dicts_private(resource_id):
+def invalidate_resource(resource_id: str, public: bool = None) -> None:
+    """Evict cached information about a resource in all workers
+
+    If `public` is None, the resource was updated or deleted and
+    all cached information (kernels, :func:`is_dc_resource`,
+    :func:`get_resource_info`, presigned URLs) is removed. Otherwise,
+    the dataset of the resource was updated and the resource is now
+    public (True) or private (False).
+    In that case, a kernel cached for the previous privacy is kept
+    (it is converted by :func:`get_resource_kernel` when requested)
+    unless a kernel for the current privacy exists already.
+
+    Other workers are notified via
+    :func:`.invalidation.publish_invalidation`.
+    """
+    evict_resource(resource_id, public=public)
+    try:
+        publish_invalidation(resource_id, public=public)
+    except BaseException:
+        logger.warning(f"Failed to publish invalidation of {resource_id}",
+                       exc_info=True)
+
+
+def _get_package_states(names_or_ids):
+    """Return a dictionary of dataset IDs and their (private, state)"""
+    states = {}
+    for name_or_id in names_or_ids:
+        pkg = model.Package.get(name_or_id) if name_or_id else None
+        if pkg is not None:
+            states[pkg.id] = (pkg.private, pkg.state)
+    return states
+
+
+def _update_changed_packages(states_before):
+    """Invalidate the resources of datasets whose privacy or state changed
+
+    `states_before` is the output of :func:`_get_package_states`
+    before the update. If a dataset was made public, the "kernel"
+    artifacts of its resources are made public as well (see
+    :func:`make_kernel_artifact_public`).
+    """
+    for pkg_id, before in states_before.items():
+        pkg = model.Package.get(pkg_id)
+        if pkg is None or (pkg.private, pkg.state) == before:
+            continue
+        for res in pkg.resources:
+            invalidate_resource(res.id, public=not pkg.private)
+        if before[0] and not pkg.private and s3.is_available():
+            # The dataset was made public.
+            for res in pkg.resources:
+                try:
+                    make_kernel_artifact_public(res.id)
+                except BaseException:
+                    logger.error(f"Failed to make kernel artifact of "
+                                 f"{res.id} public", exc_info=True)
+
+
+@toolkit.chained_action
+def package_update(up_func, context, data_dict):
+    """Invalidate resources if the privacy or state of a dataset changed
+
+    The cached information about the resources of the dataset (see
+    :func:`invalidate_resource`) is only invalidated if the update
+    changed the "private" or "state" attribute of the dataset.
+    Other changes (e.g. of the title) do not affect dcserv. If the
+    dataset was made public, the "kernel" artifacts of its resources
+    are made public as well (see :func:`make_kernel_artifact_public`).
+    """
+    states = _get_package_states([data_dict.get("id")
+                                  or data_dict.get("name")])
+    result = up_func(context, data_dict)
+    _update_changed_packages(states)
+    return result
+
+
+@toolkit.chained_action
+def bulk_update_private(up_func, context, data_dict):
+    """Invalidate resources of datasets made private in bulk
+
+    The bulk update actions do not call `package_update`, see
+    :func:`package_update` for what is invalidated.
+    """
+    states = _get_package_states(data_dict.get("datasets") or [])
+    result = up_func(context, data_dict)
+    _update_changed_packages(states)
+    return result
+
+
+@toolkit.chained_action
+def bulk_update_public(up_func, context, data_dict):
+    """Invalidate resources of datasets made public in bulk
+
+    The bulk update actions do not call `package_update`, see
+    :func:`package_update` for what is invalidated.
+    """
+    states = _get_package_states(data_dict.get("datasets") or [])
+    result = up_func(context, data_dict)
+    _update_changed_packages(states)
+    return result
+
+
+@toolkit.chained_action
+def bulk_update_delete(up_func, context, data_dict):
+    """Invalidate resources of datasets deleted in bulk
+
+    The bulk update actions do not call `package_update`, see
+    :func:`package_update` for what is invalidated.
+    """
+    states = _get_package_states(data_dict.get("datasets") or [])
+    result = up_func(context, data_dict)
+    _update_changed_packages(states)
+    return result
+
+
+def evict_resource(resource_id: str, public: bool = None,
+                   shared: bool = True) -> None:
+    """Evict cached information about a resource in this worker
+
+    See :func:`invalidate_resource` for the meaning of `public`. If
+    `shared` is False, kernel caches shared between workers are not
+    touched (used when processing messages of other workers, which
+    already updated the shared cache).
+    """
+    with _dc_resource_lock:
+        _dc_resource_cache.pop(resource_id, None)
+    with _resource_info_lock:
+        _resource_info_cache.pop(resource_id, None)
+    with _presigned_url_lock:
+        for key in [k for k in _presigned_url_cache if k[0] == resource_id]:
+            _presigned_url_cache.pop(key)
+    cache = get_kernel_cache()
+    if not shared and cache.name != "memory":
+        return
+    if public is None:
+        for pub in [True, False]:
+            cache.delete(get_resource_kernel_key(resource_id, public=pub))
+    elif cache.has(get_resource_kernel_key(resource_id, public=public)):
+        cache.delete(get_resource_kernel_key(resource_id, public=not public))
+
+
+def process_invalidations() -> None:
+    """Evict cache entries invalidated by other workers
+
+    The invalidation messages are polled at most every
+    ``ckanext.dc_serve.invalidation_poll_interval`` seconds.
+    """
+    messages = get_invalidation_listener().poll()
+    if messages is None:
+        logger.warning("Missed invalidation messages, clearing caches")
+        with _dc_resource_lock:
+            _dc_resource_cache.clear()
+        with _resource_info_lock:
+            _resource_info_cache.clear()
+        with _presigned_url_lock:
+            _presigned_url_cache.clear()
+        cache = get_kernel_cache()
+        if cache.name == "memory":
+            cache.clear()
+    else:
+        for msg in messages:
+            evict_resource(msg["id"], public=msg["public"], shared=False)
+
+
+@functools.lru_cache(maxsize=1)
+def get_thread_pool() -> concurrent.futures.ThreadPoolExecutor:
+    """Return the thread pool used for serving data concurrently
+
+    The number of threads is defined by
+    ``ckanext.dc_serve.max_threads``.
+    """
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=common.asint(common.config.get(
+            "ckanext.dc_serve.max_threads", 8)),
+        thread_name_prefix="dc_serve")
+
+
+@functools.lru_cache(maxsize=1)
+def get_open_pool() -> concurrent.futures.ThreadPoolExecutor:
+    """Return the thread pool used for opening resources on S3
+
+    The number of threads is defined by
+    ``ckanext.dc_serve.max_open_threads``. This pool is separate from
+    :func:`get_thread_pool`, because kernels are built in threads of
+    that pool (e.g. in `dcserv_batch`); submitting to the same pool
+    from its own threads could block forever when all of its threads
+    are busy. Tasks in this pool never submit tasks themselves.
+    """
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=common.asint(common.config.get(
+            "ckanext.dc_serve.max_open_threads", 4)),
+        thread_name_prefix="dc_serve_open")
+
+
+def get_resource_basins_dicts_private(resource_id, bucket_name=None):
     """Return list of private resource basin dicts
 
     Note that the condensed resource comes first in the list.
     """
     basin_dicts = []
     for artifact in ["condensed", "resource"]:
-        time_request = time.time()
-        signed_url, expires_at = s3cc.create_presigned_url(
-            resource_id,
-            artifact=artifact,
-            expiration=3600,
-            ret_expiration=True
-            )
+        signed_url, time_request, expires_at = get_presigned_url(
+            resource_id, artifact=artifact, bucket_name=bucket_name)
         basin_dicts.append({
             "name": f"{artifact}-{resource_id[:5]}",
             "format": "http",
@@ -196,115 +962,678 @@ def get_resource_basins_dicts_private(resource_id):
     return basin_dicts
 
 
-def get_resource_kernel(resource_id: str) -> dict:
-    """Return dictionary with most important resource information"""
-    public = not is_resource_private(resource_id)
-    # TODO: Caching `get_resource_kernel_base` is potentially bad for
-    #       memory. Consider storing the data in redis or a local disk cache.
-    r_data = get_resource_kernel_base(resource_id, public=public)
+def get_presigned_url(resource_id, artifact, expiration=3600,
+                      bucket_name=None):
+    """Return a (cached) presigned URL for an artifact
 
-    # The dictionary `r_data` is cached in `get_resource_kernel_base`.
-    # If we complement it, then we modify this dictionary in the cache.
-    # This is fine. It also means we do not have to cache the result
-    # of `get_resource_kernel_complement_condensed`.
-    if not r_data.get("complemented-condensed"):
-        try:
-            get_resource_kernel_complement_condensed(r_data)
-        except BaseException:
-            logger.warning(
-                f"Failed to fetch condensed resource info for {resource_id}")
+    Presigned URLs are reused until the fraction
+    ``ckanext.dc_serve.presigned_url_reuse_fraction`` of their
+    lifetime has elapsed. This saves signing work and allows HTTP
+    caches downstream to reuse the URLs. For `bucket_name`, see
+    :func:`get_s3_bucket_object`.
 
-    return r_data
+    Returns
+    -------
+    signed_url: str
+        presigned URL
+    time_request: float
+        time at which the URL was created (seconds since epoch)
+    expires_at: int
+        time at which the URL expires (seconds since epoch)
+    """
+    fraction = float(common.config.get(
+        "ckanext.dc_serve.presigned_url_reuse_fraction", 0.5))
+    key = (resource_id, artifact, expiration)
+    now = time.time()
+    with _presigned_url_lock:
+        item = _presigned_url_cache.get(key)
+        if item is not None:
+            _, time_request, expires_at = item
+            if now < time_request + fraction * (expires_at - time_request):
+                _presigned_url_cache.move_to_end(key)
+                return item
 
+    with metrics.timer("dcserv_s3_request_duration_seconds",
+                       operation="presign"):
+        bucket_name, object_name = get_s3_bucket_object(
+            resource_id, artifact=artifact, bucket_name=bucket_name)
+        signed_url, expires_at = s3.create_presigned_url(
+            bucket_name=bucket_name,
+            object_name=object_name,
+            expiration=expiration,
+            ret_expiration=True
+            )
+    item = (signed_url, now, expires_at)
+    with _presigned_url_lock:
+        _presigned_url_cache[key] = item
+        while len(_presigned_url_cache) > PRESIGNED_URL_CACHE_SIZE:
+            _presigned_url_cache.popitem(last=False)
+    return item
+
+
+def get_resource_basins_dicts_public(resource_id, bucket_name=None):
+    """Return list of public resource basin dicts
+
+    Note that the condensed resource comes first in the list.
+    """
+    # The condensed resource should come first, because it
+    # probably has better chunking / data access via HTTP.
+    # Note that we can add the condensed resource here, even
+    # if it is not yet available.
+    basin_dicts = []
+    for artifact in ["condensed", "resource"]:
+        basin_dicts.append({
+            "name": f"{artifact}-{resource_id[:5]}",
+            "format": "http",
+            "type": "remote",
+            "mapping": "same",
+            "perishable": False,
+            "key": f"dcor-{artifact}-{resource_id}",
+            "urls": [get_s3_url(resource_id,
+                                artifact=artifact,
+                                bucket_name=bucket_name)],
+        })
+    return basin_dicts
 
-@functools.lru_cache(maxsize=512)
-def get_resource_kernel_base(resource_id, public: bool = False):
+
+def get_resource_kernel(resource_id: str, public: bool = None,
+                        sections: list = None,
+                        bucket_name: str = None) -> dict:
     """Return dictionary with most important resource information
 
-    This method is cached. Complementary information can be added
-    via :func:`get_resource_kernel_complement_condensed`.
+    If `public` (or `bucket_name`, the S3 bucket of the resource) is
+    None, the privacy of the resource is looked up in the database.
+    Pass both when calling this function from a thread pool, where
+    the database must not be accessed.
+
+    Only the requested kernel `sections` (see :const:`KERNEL_SECTIONS`,
+    all sections by default) are guaranteed to be loaded. Sections are
+    loaded on first request, so that cheap queries (e.g. "size") do
+    not require extracting all tables and logs of a resource.
+
+    The kernel is stored in the cache returned by
+    :func:`.kernel_cache.get_kernel_cache`, which may be shared
+    between workers (see the ``ckanext.dc_serve.kernel_cache``
+    configuration option). On a cache miss, the kernel artifact
+    written by the condense job (which contains all sections) is
+    loaded. Only if that artifact does not exist, the resource and
+    condensed files are opened.
+    """
+    process_invalidations()
+    if public is None:
+        public = is_resource_public(resource_id)
+    if sections is None:
+        sections = KERNEL_SECTIONS
+    cache = get_kernel_cache()
+    key = get_resource_kernel_key(resource_id, public=public)
+    # Kernel caches that are not in-process are shared between workers.
+    shared = cache.name != "memory"
+    r_data = cache.get(key)
+    if r_data is None or get_resource_kernel_missing(r_data, sections):
+        # Only one thread (and worker) builds the kernel, the others wait.
+        with kernel_build_lock(key, shared=shared):
+            cached = (cache.get(key, count=False) if cache.has(key)
+                      else None)
+            r_data = cached
+            if r_data is None:
+                r_data = get_resource_kernel_load(resource_id,
+                                                  public=public,
+                                                  sections=sections,
+                                                  bucket_name=bucket_name)
+            missing = get_resource_kernel_missing(r_data, sections)
+            if missing:
+                r_data = get_resource_kernel_extended(
+                    r_data, missing, bucket_name=bucket_name)
+            if r_data is not cached:
+                set_resource_kernel_digest(r_data)
+                cache.set(key, r_data)
+
+    if (set(sections) & set(KERNEL_CONDENSED_SECTIONS)
+            and not r_data.get("complemented-condensed")
+            and is_condensed_complement_due(r_data)):
+        with kernel_build_lock(key, shared=shared):
+            # Another thread might have complemented the kernel already.
+            cached = cache.get(key, count=False)
+            if (cached is not None
+                    and not get_resource_kernel_missing(cached, sections)):
+                r_data = cached
+            if (not r_data.get("complemented-condensed")
+                    and is_condensed_complement_due(r_data)):
+                r_data = get_resource_kernel_complemented(
+                    r_data, bucket_name=bucket_name)
+                cache.set(key, r_data)
+
+    return r_data
+
+
+def get_resource_kernel_missing(r_data, sections) -> list:
+    """Return the kernel sections in `sections` not loaded in `r_data`"""
+    # Kernels loaded from the kernel artifact (or cached by older
+    # versions of this extension) are complete.
+    loaded = r_data.get("sections", KERNEL_SECTIONS)
+    return [sec for sec in sections if sec not in loaded]
+
+
+def get_resource_kernel_extended(r_data, sections,
+                                 bucket_name: str = None) -> dict:
+    """Return a copy of a kernel with additional sections
+
+    The sections are extracted via :func:`get_resource_kernel_from_s3`.
+    The input kernel is not modified. The returned kernel is only
+    marked as complemented with condensed information if that
+    applies to all of its sections.
+    """
+    new = get_resource_kernel_from_s3(r_data["id"], public=r_data["public"],
+                                      sections=sections,
+                                      bucket_name=bucket_name)
+    loaded = r_data.get("sections", KERNEL_SECTIONS)
+    complemented = (r_data.get("complemented-condensed")
+                    or not set(loaded) & set(KERNEL_CONDENSED_SECTIONS))
+    r_data = dict(r_data)
+    for name, value in new.items():
+        if name not in ["id", "public", "sections", "complemented-condensed"]:
+            r_data[name] = value
+    r_data["sections"] = [sec for sec in KERNEL_SECTIONS
+                          if sec in loaded or sec in sections]
+    if set(sections) & set(KERNEL_CONDENSED_SECTIONS):
+        if new.get("complemented-condensed") and complemented:
+            r_data["complemented-condensed"] = True
+        else:
+            r_data.pop("complemented-condensed", None)
+    return r_data
+
+
+def get_resource_kernel_load(resource_id, public: bool,
+                             sections: list = None,
+                             bucket_name: str = None) -> dict:
+    """Load a kernel that is not cached
+
+    The kernel is converted from a kernel cached for the opposite
+    privacy, loaded from the kernel artifact, or (as a last resort)
+    extracted from the resource on S3. Only in the latter case,
+    loading is restricted to `sections`.
+    """
+    # The privacy of the resource might have changed.
+    r_data = get_resource_kernel_converted(resource_id, public=public,
+                                           bucket_name=bucket_name)
+    source = "converted"
+    if r_data is None:
+        r_data = get_resource_kernel_artifact(resource_id, public=public,
+                                              bucket_name=bucket_name)
+        source = "artifact"
+    if r_data is None:
+        r_data = get_resource_kernel_from_s3(resource_id, public=public,
+                                             sections=sections,
+                                             bucket_name=bucket_name)
+        source = "dc"
+    metrics.inc("dcserv_kernel_loads_total", source=source)
+    return r_data
+
+
+def get_resource_kernel_from_s3(resource_id, public: bool,
+                                sections: list = None,
+                                bucket_name: str = None) -> dict:
+    """Build a complemented kernel from the condensed and original files
+
+    See :func:`get_resource_kernel_base`. The condensed resource is
+    only opened once for extracting and complementing the kernel.
+    """
+    if sections is None:
+        sections = KERNEL_SECTIONS
+    if bucket_name is None:
+        # The bucket name is looked up in the database, which must
+        # happen in this thread and not in the pool.
+        bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+    if set(sections) & set(KERNEL_CONDENSED_OPEN_SECTIONS):
+        future_con = get_open_pool().submit(
+            get_s3_dc_handle_timed, resource_id, artifact="condensed",
+            bucket_name=bucket_name)
+    else:
+        future_con = None
+    r_data = get_resource_kernel_base(resource_id, public=public,
+                                      sections=sections, ds_con=future_con,
+                                      bucket_name=bucket_name)
+    if set(sections) & set(KERNEL_CONDENSED_SECTIONS):
+        # This records a failure if the condensed resource is missing.
+        r_data = get_resource_kernel_complemented(r_data, ds_con=future_con,
+                                                  bucket_name=bucket_name)
+    return r_data
+
+
+def get_resource_kernel_complemented(r_data, ds_con=None,
+                                     bucket_name: str = None) -> dict:
+    """Return a copy of a kernel complemented with condensed information
+
+    The input kernel is not modified, since it might be in use by
+    other threads. If the condensed resource cannot be accessed, the
+    failure is recorded in the returned kernel and retries are delayed
+    (see :func:`is_condensed_complement_due`). For `ds_con` and
+    `bucket_name`, see :func:`get_resource_kernel_complement_condensed`.
+    """
+    r_data = dict(r_data)
+    # `complement_resource_kernel_from_dc` modifies these in-place
+    for name in ["logs", "basin_features"]:
+        if name in r_data:
+            r_data[name] = dict(r_data[name])
+    try:
+        get_resource_kernel_complement_condensed(r_data, ds_con=ds_con,
+                                                 bucket_name=bucket_name)
+    except BaseException:
+        # Remember the failure so that we do not try to access the
+        # condensed resource for every request.
+        failures = r_data.get("condensed-failures", 0) + 1
+        r_data["condensed-failures"] = failures
+        r_data["condensed-failed-at"] = time.time()
+        r_data["condensed-retry-at"] = time.time() + min(
+            CONDENSED_RETRY_INITIAL * 2 ** (failures - 1),
+            CONDENSED_RETRY_MAX)
+        logger.warning(
+            f"Failed to fetch condensed resource info for {r_data['id']} "
+            f"({failures} failures)")
+    else:
+        for fkey in ["condensed-failures", "condensed-failed-at",
+                     "condensed-retry-at"]:
+            r_data.pop(fkey, None)
+    set_resource_kernel_digest(r_data)
+    return r_data
+
+
+def is_condensed_complement_due(r_data) -> bool:
+    """Whether to (re)try complementing a kernel with condensed information
+
+    After a failure, retries are delayed with exponential backoff
+    unless the condense job signaled completion after the failure
+    (see :func:`.kernel_cache.set_condensed_signal`).
+    """
+    if time.time() >= r_data.get("condensed-retry-at", 0):
+        return True
+    signal_time = get_condensed_signal(r_data["id"])
+    return (signal_time is not None
+            and signal_time > r_data["condensed-failed-at"])
+
+
+def get_resource_kernel_etags(r_data) -> dict:
+    """Return content hashes for all sections of a resource kernel
+
+    The hashes are used as ETags by :func:`dcserv`. The "basins"
+    section combines the public basin dictionaries and the basin
+    features.
+    """
+    return {name: hash_kernel_json(value)
+            for name, value in get_resource_kernel_etag_json(r_data).items()}
+
+
+def get_resource_kernel_etag_json(r_data) -> dict:
+    """Return the JSON representations hashed for the kernel ETags"""
+    sections = {
+        "config": r_data.get("config"),
+        "logs": r_data.get("logs"),
+        "tables": r_data.get("tables"),
+        "trace_list": r_data.get("trace_list"),
+        "basins": [r_data.get("basin_dicts"), r_data.get("basin_features")],
+    }
+    return {name: json.dumps(value, sort_keys=True)
+            for name, value in sections.items()}
+
+
+def hash_kernel_json(value: str) -> str:
+    """Return the ETag for the JSON representation of a kernel section"""
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+def set_resource_kernel_digest(r_data) -> None:
+    """Set the ETags and the estimated size of a newly built kernel
+
+    The ETags ("etags", see :func:`get_resource_kernel_etags`) and the
+    size in bytes ("kernel_bytes", see
+    :func:`.kernel_cache.estimate_kernel_size`) are computed from the
+    same JSON representation, so that the kernel is serialized only
+    once when it is built and not whenever it is cached.
     """
+    r_data.pop("kernel_bytes", None)
+    dumps = get_resource_kernel_etag_json(r_data)
+    r_data["etags"] = {name: hash_kernel_json(value)
+                       for name, value in dumps.items()}
+    rest = {key: value for key, value in r_data.items()
+            if key not in KERNEL_ETAG_KEYS}
+    r_data["kernel_bytes"] = (sum(len(value) for value in dumps.values())
+                              + len(json.dumps(rest)))
+
+
+def get_resource_kernel_key(resource_id: str, public: bool) -> str:
+    """Return the key under which a resource kernel is cached"""
+    return f"{resource_id}-{'public' if public else 'private'}"
+
+
+def get_resource_kernel_converted(resource_id, public: bool,
+                                  bucket_name: str = None):
+    """Convert a cached kernel of the opposite privacy
+
+    When a dataset is made public (or private), the kernel cached for
+    the previous privacy is converted instead of building a new one.
+    The old kernel is removed from the cache. Returns None if there is
+    no kernel to convert.
+    """
+    cache = get_kernel_cache()
+    other_key = get_resource_kernel_key(resource_id, public=not public)
+    if not cache.has(other_key):
+        return None
+    other = cache.get(other_key, count=False)
+    if other is None:
+        return None
+    r_data = dict(other)
+    r_data["public"] = public
+    if public:
+        r_data["basin_dicts"] = get_resource_basins_dicts_public(
+            resource_id, bucket_name=bucket_name)
+    else:
+        # private resources get presigned URLs for every request
+        r_data.pop("basin_dicts", None)
+    cache.delete(other_key)
+    return r_data
+
+
+def get_resource_kernel_artifact(resource_id, public: bool = False,
+                                 bucket_name: str = None):
+    """Return the resource kernel from the "kernel" artifact on S3
+
+    The kernel artifact is written by the condense job (see
+    :func:`get_resource_kernel_document`). Returns None if the
+    artifact does not exist or if its version is not supported.
+    """
+    bucket_name, object_name = get_s3_bucket_object(
+        resource_id, artifact="kernel", bucket_name=bucket_name)
+    s3_client, _, _ = s3.get_s3()
+    try:
+        with metrics.timer("dcserv_s3_request_duration_seconds",
+                           operation="get_object"):
+            resp = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+            body = resp["Body"].read()
+    except botocore.exceptions.ClientError:
+        # The artifact does not exist (resource not yet condensed or
+        # condensed before kernel artifacts were introduced).
+        return None
+    doc = json.loads(gzip.decompress(body))
+    if doc.get("kernel_version") != KERNEL_ARTIFACT_VERSION:
+        logger.info(f"Ignoring kernel artifact version "
+                    f"{doc.get('kernel_version')} for {resource_id}")
+        return None
+
     r_data = {"id": resource_id,
               "public": public}
+    for section in KERNEL_ARTIFACT_SECTIONS:
+        if section in doc:
+            r_data[section] = doc[section]
+    if public:
+        r_data["basin_dicts"] = get_resource_basins_dicts_public(
+            resource_id, bucket_name=bucket_name)
+    r_data["complemented-condensed"] = True
+    return r_data
+
+
+def make_kernel_artifact_public(resource_id: str) -> None:
+    """Make the "kernel" artifact of a resource public (if it exists)
+
+    :func:`dcor_shared.s3cc.make_resource_public` only handles the
+    "condensed", "preview", and "resource" artifacts.
+    """
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact="kernel")
+    s3.make_object_public(bucket_name=bucket_name,
+                          object_name=object_name,
+                          missing_ok=True)
+
+
+def delete_kernel_artifact(resource_id: str) -> None:
+    """Delete the "kernel" artifact of a resource (if it exists)
+
+    The kernel artifact contains the logs and the configuration of
+    the resource, so it must not outlive the resource.
+    """
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact="kernel")
+    s3_client, _, _ = s3.get_s3()
+    s3_client.delete_object(Bucket=bucket_name, Key=object_name)
+
+
+def get_resource_kernel_base(resource_id, public: bool = False,
+                             sections: list = None, ds_con=None,
+                             bucket_name: str = None):
+    """Return dictionary with most important resource information
+
+    This method is not cached, use :func:`get_resource_kernel` instead.
+    Only the kernel `sections` (all by default) are extracted.
+    Complementary information can be added via
+    :func:`get_resource_kernel_complement_condensed`.
+
+    The condensed resource contains copies of the tables and logs of
+    the original resource (plus the logs of the condense job), but no
+    image, mask, or trace data. Reading the tables and logs from it via
+    S3 requires far fewer HDF5 metadata reads, so these sections are
+    extracted from the condensed resource if it contains all tables
+    and logs of the original resource (see
+    :func:`get_resource_kernel_condensed_sections`). All other
+    sections (:const:`KERNEL_ORIGINAL_SECTIONS`) are extracted from
+    the original resource, as are all sections if the condensed
+    resource is not available (e.g. not yet condensed).
+
+    The condensed resource is only opened if one of the
+    :const:`KERNEL_CONDENSED_OPEN_SECTIONS` is requested. It is opened
+    in the pool returned by :func:`get_open_pool` (unless `ds_con`, a
+    :class:`concurrent.futures.Future` of it, is given) while the
+    original resource is opened in this thread, so that this takes
+    roughly as long as the slower of the two S3 accesses instead of
+    their sum. If `bucket_name` is None, it is looked up in the
+    database (in this thread).
+    """
+    sections = [sec for sec in KERNEL_SECTIONS
+                if sections is None or sec in sections]
+    open_con = bool(set(sections) & set(KERNEL_CONDENSED_OPEN_SECTIONS))
+    if bucket_name is None:
+        # The bucket name is looked up in the database, which must
+        # happen in this thread and not in the pool.
+        bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+    if ds_con is None and open_con:
+        ds_con = get_open_pool().submit(
+            get_s3_dc_handle_timed, resource_id, artifact="condensed",
+            bucket_name=bucket_name)
+    try:
+        ds_res = get_s3_dc_handle_timed(resource_id, artifact="resource",
+                                        bucket_name=bucket_name)
+    except BaseException:
+        if ds_con is not None:
+            ds_con.cancel()
+        raise
+    sections_con = []
+    if open_con:
+        try:
+            ds_con = ds_con.result()
+        except BaseException:
+            # The resource has not been condensed (yet).
+            ds_con = None
+        else:
+            sections_con = get_resource_kernel_condensed_sections(
+                ds_res, ds_con, sections)
+
+    r_data = {"id": resource_id}
+    r_data.update(get_resource_kernel_from_dc(
+        resource_id, ds_res,
+        sections=[sec for sec in sections if sec not in sections_con]))
+    if sections_con:
+        r_data.update(get_resource_kernel_from_dc(resource_id, ds_con,
+                                                  sections=sections_con))
+    r_data["public"] = public
+    r_data["sections"] = sections
+    # basins (for public resources only, since we don't need presigned URLs)
+    if public and "basins" in sections:
+        r_data["basin_dicts"] = get_resource_basins_dicts_public(
+            resource_id, bucket_name=bucket_name)
+    return r_data
+
 
-    ds_res = s3cc.get_s3_dc_handle(resource_id, artifact="resource")
+def get_resource_kernel_condensed_sections(ds_res, ds_con, sections) -> list:
+    """Return the kernel `sections` that can be taken from the condensed data
 
+    These are the "tables" and "logs" sections if the condensed
+    resource `ds_con` contains all tables or logs of the original
+    resource `ds_res` (condensed resources created with older versions
+    of dclab might not). Only the names are compared, the tables and
+    logs are not read.
+    """
+    sections_con = []
+    if ("tables" in sections
+            and set(ds_res.tables.keys()) <= set(ds_con.tables.keys())):
+        sections_con.append("tables")
+    if ("logs" in sections
+            and set(ds_res.logs.keys()) <= set(ds_con.logs.keys())):
+        sections_con.append("logs")
+    return sections_con
+
+
+def get_resource_kernel_complement_condensed(r_data, ds_con=None,
+                                             bucket_name: str = None):
+    """Complement dictionary with condensed resource information
+
+    The input dictionary is expected to be created via
+    :func:`get_resource_kernel_base`. If the condensed resource was
+    already opened, `ds_con` is its dataset instance or a
+    :class:`concurrent.futures.Future` thereof. Otherwise, it is
+    opened from the S3 bucket `bucket_name` (looked up in the
+    database if None).
+    """
+    resource_id = r_data["id"]
+    if ds_con is None:
+        ds_con = get_s3_dc_handle_timed(resource_id, artifact="condensed",
+                                        bucket_name=bucket_name)
+    elif isinstance(ds_con, concurrent.futures.Future):
+        ds_con = ds_con.result()
+    complement_resource_kernel_from_dc(r_data, ds_con)
+
+
+def get_s3_bucket_object(resource_id, artifact, bucket_name=None):
+    """Return the bucket and object names of an artifact on S3
+
+    This is :func:`dcor_shared.s3cc.get_s3_bucket_object_for_artifact`
+    with an optional `bucket_name`. If `bucket_name` is None, it is
+    looked up in the database, which must not happen in a thread
+    pool. Threads in a pool must be given the bucket name instead.
+    """
+    if bucket_name is None:
+        bucket_name = s3cc.get_s3_bucket_name_for_resource(resource_id)
+    rid = resource_id
+    return bucket_name, f"{artifact}/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
+
+
+def get_s3_url(resource_id, artifact, bucket_name=None):
+    """Return the S3 URL of an artifact
+
+    See :func:`get_s3_bucket_object` for `bucket_name`.
+    """
+    endpoint = common.config.get("dcor_object_store.endpoint_url")
+    bucket_name, object_name = get_s3_bucket_object(
+        resource_id, artifact=artifact, bucket_name=bucket_name)
+    return f"{endpoint}/{bucket_name}/{object_name}"
+
+
+def get_s3_dc_handle_timed(resource_id, artifact, bucket_name=None):
+    """Open a resource or its condensed version on S3 (with metrics)
+
+    This is :func:`dcor_shared.s3cc.get_s3_dc_handle` with an optional
+    `bucket_name` (see :func:`get_s3_bucket_object`).
+    """
+    url = get_s3_url(resource_id, artifact=artifact, bucket_name=bucket_name)
+    with metrics.timer("dcserv_s3_request_duration_seconds",
+                       operation="open_dc"):
+        return fmt_s3.RTDC_S3(
+            url=url,
+            access_key_id=common.config.get(
+                "dcor_object_store.access_key_id"),
+            secret_access_key=common.config.get(
+                "dcor_object_store.secret_access_key"),
+            enable_basins=False,
+        )
+
+
+def get_resource_kernel_document(r_data) -> dict:
+    """Return the compact kernel document stored as "kernel" artifact
+
+    The input dictionary is expected to be created via
+    :func:`get_resource_kernel_from_dc` and complemented via
+    :func:`complement_resource_kernel_from_dc`.
+
+    The document does not contain any privacy-dependent information
+    (e.g. basin URLs), because a resource can be made public after
+    the document was created.
+    """
+    doc = {"kernel_version": KERNEL_ARTIFACT_VERSION,
+           "id": r_data["id"]}
+    for section in KERNEL_ARTIFACT_SECTIONS:
+        if section in r_data:
+            doc[section] = r_data[section]
+    return doc
+
+
+def get_resource_kernel_from_dc(resource_id, ds_res,
+                                sections: list = None) -> dict:
+    """Extract the resource kernel from an instance of the original data
+
+    Only the kernel `sections` (see :const:`KERNEL_SECTIONS`, all by
+    default) are extracted. The returned dictionary does not contain
+    basin information from the condensed resource, use
+    :func:`complement_resource_kernel_from_dc` for that.
+    """
+    if sections is None:
+        sections = KERNEL_SECTIONS
+    r_data = {"id": resource_id}
     # configuration
-    r_data["config"] = ds_res.config.as_dict(pop_filtering=True)
-    r_data["config"].setdefault("experiment", {})
-    if not r_data["config"]["experiment"]["event count"]:
-        r_data["config"]["experiment"]["event count"] = len(ds_res)
+    if "config" in sections:
+        r_data["config"] = ds_res.config.as_dict(pop_filtering=True)
+        r_data["config"].setdefault("experiment", {})
+        if not r_data["config"]["experiment"].get("event count"):
+            r_data["config"]["experiment"]["event count"] = len(ds_res)
     # trace list
-    if "trace" in ds_res:
+    if "trace_list" in sections and "trace" in ds_res:
         r_data["trace_list"] = sorted(ds_res["trace"].keys())
     # tables
-    r_data["tables"] = get_dc_tables(ds_res, from_basins=False)
+    if "tables" in sections:
+        r_data["tables"] = get_dc_tables(ds_res, from_basins=False)
+        r_data["table_dtypes"] = get_dc_table_dtypes(ds_res)
     # logs
-    r_data["logs"] = get_dc_logs(ds_res, from_basins=False)
+    if "logs" in sections:
+        r_data["logs"] = get_dc_logs(ds_res, from_basins=False)
     # basin features
-    basin_features = {
-        f"resource-{resource_id[:5]}": ds_res.features_innate,
-    }
-    r_data["basin_features"] = basin_features
-    # basins (for public resources only, since we don't need presigned URLs)
-    if public:
-        # The condensed resource should come first, because it
-        # probably has better chunking / data access via HTTP.
-        # Note that we can add the condensed resource here, even
-        # if it is not yet available.
-        basin_urls = {
-            "condensed": ds_res.path.replace("/resource/", "/condensed/"),
-            "resource": ds_res.path,
+    if "basins" in sections:
+        r_data["basin_features"] = {
+            f"resource-{resource_id[:5]}": ds_res.features_innate,
         }
-        basins_dicts = []
-        for artifact in basin_urls:
-            basins_dicts.append({
-                "name": f"{artifact}-{resource_id[:5]}",
-                "format": "http",
-                "type": "remote",
-                "mapping": "same",
-                "perishable": False,
-                "key": f"dcor-{artifact}-{resource_id}",
-                "urls": [basin_urls[artifact]],
-            })
-        r_data["basin_dicts"] = basins_dicts
-
     return r_data
 
 
-def get_resource_kernel_complement_condensed(r_data):
-    """Complement dictionary with condensed resource information
-
-    The input dictionary is expected to be created via
-    :func:`get_resource_kernel_base`.
-    """
+def complement_resource_kernel_from_dc(r_data, ds_con):
+    """Complement kernel dictionary with condensed resource information"""
     resource_id = r_data["id"]
-    ds_con = s3cc.get_s3_dc_handle(resource_id, artifact="condensed")
     # condense logs
-    new_logs = get_dc_logs(ds_con, from_basins=False)
-    for ln in new_logs:
-        if ln not in r_data["logs"]:
-            r_data["logs"][ln] = new_logs[ln]
+    if "logs" in r_data:
+        new_logs = get_dc_logs(ds_con, from_basins=False)
+        for ln in new_logs:
+            if ln not in r_data["logs"]:
+                r_data["logs"][ln] = new_logs[ln]
     # basin features
-    basin_feats = ds_con.features_innate
-    if common.asbool(common.config.get(
-            "ckanext.dc_serve.enable_intra_dataset_basins", "true")):
-        # Include all features, not only innate features, because we might
-        # have intra-dataset basins.
-        # We include all features that are listed on the first level of basins.
-        for bn_dict in ds_con.basins_get_dicts():
-            basin_feats += bn_dict.get("features", []) or []
-    basin_feats = sorted(set(basin_feats))
-    r_data["basin_features"][f"condensed-{resource_id[:5]}"] = basin_feats
+    if "basin_features" in r_data:
+        basin_feats = ds_con.features_innate
+        if common.asbool(common.config.get(
+                "ckanext.dc_serve.enable_intra_dataset_basins", "true")):
+            # Include all features, not only innate features, because we
+            # might have intra-dataset basins. We include all features
+            # that are listed on the first level of basins.
+            for bn_dict in ds_con.basins_get_dicts():
+                basin_feats += bn_dict.get("features", []) or []
+        basin_feats = sorted(set(basin_feats))
+        r_data["basin_features"][f"condensed-{resource_id[:5]}"] = \
+            basin_feats
     r_data["complemented-condensed"] = True
 
 
-def replace_nan_with_none_recursive(data):
-    if isinstance(data, (list, tuple)):
-        return [replace_nan_with_none_recursive(item) for item in data]
-    else:
-        return data if not np.isnan(data) else None
-
-
-atexit.register(is_dc_resource.cache_clear)
-atexit.register(get_resource_kernel_base.cache_clear)
+atexit.register(_dc_resource_cache.clear)
+atexit.register(_resource_info_cache.clear)
+atexit.register(_presigned_url_cache.clear)
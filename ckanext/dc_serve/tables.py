@@ -0,0 +1,108 @@
+"""Conversion of DC table data for serving via the API"""
+import io
+
+import numpy as np
+
+
+def get_table_descr(data: np.ndarray) -> list:
+    """Return a JSON-compatible description of the dtype of a table
+
+    Use :func:`list_to_table` to restore the table from the output
+    of :func:`table_to_list` and this description.
+    """
+    return np.lib.format.dtype_to_descr(data.dtype)
+
+
+def list_to_table(names, data: list, descr=None) -> np.ndarray:
+    """Convert the output of :func:`table_to_list` back to an array
+
+    Parameters
+    ----------
+    names: list of str or None
+        Column names of the table (None for non-structured tables)
+    data: list
+        Nested list as returned by :func:`table_to_list`; None is
+        converted to NaN
+    descr: list
+        Description of the table dtype as returned by
+        :func:`get_table_descr`; If not given, all columns are
+        assumed to be float64.
+    """
+    if descr:
+        dtype = np.lib.format.descr_to_dtype(descr)
+    elif names is None:
+        dtype = np.dtype(float)
+    else:
+        dtype = np.dtype([(name, float) for name in names])
+
+    if dtype.names is None:
+        return np.array(data, dtype=dtype)
+
+    if any(dtype[name].shape for name in dtype.names):
+        raise ValueError("Tables with sub-array fields are not supported!")
+
+    values = np.array(data, dtype=object)
+    if values.size == 0:
+        return np.zeros(0, dtype=dtype)
+    out = np.zeros(values.shape[:-1], dtype=dtype)
+    for ii, name in enumerate(dtype.names):
+        out[name] = values[..., ii]
+    return out
+
+
+def replace_nan_with_none_recursive(data):
+    if isinstance(data, (list, tuple)):
+        return [replace_nan_with_none_recursive(item) for item in data]
+    else:
+        return data if not np.isnan(data) else None
+
+
+def table_to_list(data: np.ndarray) -> list:
+    """Convert table data to nested lists that can be encoded as JSON
+
+    Non-finite values (NaN and inf) are replaced by None. The records
+    of structured arrays are converted to lists (not tuples), so the
+    result is identical to (but much faster to compute than)
+    ``replace_nan_with_none_recursive(data.tolist())``, except that
+    infinite values are replaced as well.
+    """
+    names = data.dtype.names
+    if names is None:
+        return _column_to_object(data).tolist()
+
+    if any(data.dtype[name].shape for name in names):
+        # Structured arrays with sub-array fields are very uncommon.
+        # Handle them with the slow generic approach.
+        return replace_nan_with_none_recursive(data.tolist())
+
+    # Assemble the columns in an object array with the fields as
+    # the last axis, so that `tolist` returns nested lists.
+    out = np.empty(data.shape + (len(names),), dtype=object)
+    for ii, name in enumerate(names):
+        out[..., ii] = _column_to_object(data[name])
+    return out.tolist()
+
+
+def _column_to_object(column: np.ndarray) -> np.ndarray:
+    """Return a column in which non-finite values are None
+
+    If the column does not contain any non-finite values, it is
+    returned unchanged (no copy).
+    """
+    if column.dtype.kind in "fc":
+        invalid = ~np.isfinite(column)
+        if np.any(invalid):
+            column = column.astype(object)
+            column[invalid] = None
+    return column
+
+
+def tables_to_npz(tables: dict) -> bytes:
+    """Return a dictionary of tables as the bytes of a compressed .npz file
+
+    Column names and dtypes of structured arrays are preserved. Load
+    the data with ``numpy.load(io.BytesIO(data))``.
+    """
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **tables)
+    return buffer.getvalue()
@@ -0,0 +1,94 @@
+import pathlib
+from unittest import mock
+
+from click.testing import CliRunner
+import pytest
+
+from ckanext.dc_serve import cli, jobs, kernel_cache, serve
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_jobs_dc_serve_workers(enqueue_job_mock):
+    make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    make_dataset_via_s3(
+        resource_path=data_path / "cytoshot_blood.rtdc",
+        activate=True)
+
+    result = CliRunner().invoke(cli.run_jobs_dc_serve, ["--workers", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Running jobs for 2 resources with 2 worker processes" \
+        in result.output
+    assert "[1/2]" in result.output
+    assert "[2/2]" in result.output
+    # the resources were already condensed when they were created
+    assert "(0 jobs run, 0 failed)" in result.output
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_jobs_dc_serve_incremental(enqueue_job_mock):
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+
+    with mock.patch.object(jobs, "condense_dataset") as cmock:
+        result = CliRunner().invoke(cli.run_jobs_dc_serve, ["--incremental"])
+    assert result.exit_code == 0, result.output
+    # the existing condensed resource was updated, not condensed again
+    assert f"OK: Condense .rtdc file and upload to S3 for {res_dict['name']}" \
+        in result.output
+    cmock.assert_not_called()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.kernel_cache', 'sqlite')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_dc_serve_warm_kernels(enqueue_job_mock, tmp_path, ckan_config,
+                               monkeypatch):
+    monkeypatch.setitem(ckan_config,
+                        "ckanext.dc_serve.kernel_cache_path",
+                        str(tmp_path / "kernels.sqlite3"))
+    kernel_cache.get_kernel_cache.cache_clear()
+    try:
+        _, res_dict = make_dataset_via_s3(
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=True)
+        cache = kernel_cache.get_kernel_cache()
+        key = serve.get_resource_kernel_key(res_dict["id"], public=True)
+        cache.clear()
+
+        result = CliRunner().invoke(cli.dc_serve_warm_kernels,
+                                    ["--workers", "2"])
+        assert result.exit_code == 0, result.output
+        assert "Warming 1 resource kernels" in result.output
+        assert cache.has(key)
+
+        # cached kernels are skipped
+        result = CliRunner().invoke(cli.dc_serve_warm_kernels)
+        assert "Warming 0 resource kernels (1 skipped)" in result.output
+    finally:
+        kernel_cache.get_kernel_cache.cache_clear()
+
+
+@pytest.mark.ckan_config('ckanext.dc_serve.kernel_cache', 'memory')
+def test_dc_serve_warm_kernels_memory_cache():
+    kernel_cache.get_kernel_cache.cache_clear()
+    try:
+        result = CliRunner().invoke(cli.dc_serve_warm_kernels)
+        assert result.exit_code != 0
+        assert "not shared" in result.output
+    finally:
+        kernel_cache.get_kernel_cache.cache_clear()
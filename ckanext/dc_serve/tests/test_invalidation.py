@@ -0,0 +1,23 @@
+from ckanext.dc_serve import invalidation
+
+
+def test_invalidation_listener():
+    invalidation.publish_invalidation("before")
+    listener = invalidation.InvalidationListener(poll_interval=0)
+    # messages published before the first poll are not lost
+    invalidation.publish_invalidation("peter")
+    assert listener.poll() == [{"id": "peter", "public": None}]
+    invalidation.publish_invalidation("pan", public=True)
+    invalidation.publish_invalidation("hook", public=False)
+    assert listener.poll() == [{"id": "pan", "public": True},
+                               {"id": "hook", "public": False},
+                               ]
+    assert listener.poll() == []
+
+
+def test_invalidation_listener_poll_interval():
+    listener = invalidation.InvalidationListener(poll_interval=3600)
+    assert listener.poll() == []
+    invalidation.publish_invalidation("peter")
+    # poll interval not yet elapsed
+    assert listener.poll() == []
@@ -22,6 +22,7 @@ import h5py
 import numpy as np
 import requests
 
+from ckanext.dc_serve import jobs, serve
 from dcor_shared import s3cc
 import dcor_shared
 
@@ -77,6 +78,149 @@ def test_create_condensed_dataset_job_upload_s3(enqueue_job_mock, tmp_path):
         assert np.allclose(ds["deform"][0], 0.011666297)
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_condensed_dataset_job_kernel_artifact(enqueue_job_mock):
+    """The condense job also uploads the resource kernel document"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    assert s3cc.artifact_exists(rid, artifact="kernel")
+
+    kernel = serve.get_resource_kernel_artifact(rid, public=True)
+    assert kernel["complemented-condensed"]
+    assert kernel["config"]["experiment"]["event count"] == 47
+    assert kernel["config"]["setup"]["channel width"] == 20
+    assert "dclab-condense" in kernel["logs"]
+    assert "image" in kernel["basin_features"][f"resource-{rid[:5]}"]
+    assert "volume" in kernel["basin_features"][f"condensed-{rid[:5]}"]
+    assert kernel["basin_dicts"][0]["urls"][0] == \
+        s3cc.get_s3_url_for_artifact(rid, "condensed")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_kernel_artifact_visibility_and_deletion(enqueue_job_mock):
+    """The kernel artifact is handled like the condensed artifact"""
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+    rid = res_dict["id"]
+    url = s3cc.get_s3_url_for_artifact(rid, "kernel")
+    assert not requests.get(url).ok
+
+    helpers.call_action("package_patch", id=ds_dict["id"], private=False)
+    assert requests.get(url).ok
+    assert requests.get(s3cc.get_s3_url_for_artifact(rid, "condensed")).ok
+
+    serve.delete_kernel_artifact(rid)
+    assert not s3cc.artifact_exists(rid, artifact="kernel")
+    # the kernel is extracted from the resource files instead
+    kernel = serve.get_resource_kernel(rid)
+    assert kernel["config"]["experiment"]["event count"] == 47
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.condense_in_memory_max_bytes',
+                         "100000000")
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_condensed_dataset_job_in_memory(enqueue_job_mock):
+    """Small condensed files are created in memory and uploaded from there"""
+    with mock.patch.object(jobs, "upload_artifact",
+                           wraps=jobs.upload_artifact) as umock:
+        _, res_dict = make_dataset_via_s3(
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=True)
+    rid = res_dict["id"]
+    # the condensed file was not uploaded from disk
+    sources = {call.kwargs["artifact"]: call.kwargs["source"]
+               for call in umock.call_args_list}
+    assert isinstance(sources["condensed"], bytes)
+
+    # the condensed resource is public
+    response = requests.get(s3cc.get_s3_url_for_artifact(rid, "condensed"))
+    assert response.ok
+    with s3cc.get_s3_dc_handle(rid, "condensed") as ds:
+        assert "volume" in ds
+        assert np.allclose(ds["deform"][0], 0.011666297)
+        basin_names = [bn["name"] for bn in ds.basins_get_dicts()]
+        assert "DCOR dcserv" in basin_names
+    assert s3cc.artifact_exists(rid, artifact="kernel")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_condensed_dataset_job_incremental(enqueue_job_mock, tmp_path):
+    """Incremental updates only compute missing features and basins"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+
+    # Remove a feature and the DCOR basins from the condensed file
+    path = tmp_path / "condensed.rtdc"
+    response = requests.get(s3cc.get_s3_url_for_artifact(rid, "condensed"))
+    path.write_bytes(response.content)
+    with h5py.File(path, "a") as h5:
+        num_basins = len(h5["basins"])
+        deform = h5["events/deform"][:]
+        del h5["events/volume"]
+        jobs._remove_dcor_basins(h5)
+        assert len(h5.get("basins", {})) < num_basins
+    jobs.upload_artifact(resource_id=rid, artifact="condensed", source=path)
+
+    with mock.patch.object(jobs, "condense_dataset") as cmock:
+        assert jobs.generate_condensed_resource(res_dict, incremental=True)
+    cmock.assert_not_called()
+
+    with s3cc.get_s3_dc_handle(rid, "condensed") as ds:
+        assert "volume" in ds.features_innate
+        assert np.allclose(ds["deform"], deform)
+        basin_names = [bn["name"] for bn in ds.basins_get_dicts()]
+        assert len(basin_names) == num_basins
+        assert basin_names.count("DCOR dcserv") == 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.condense_page_size', "65536")
+@pytest.mark.ckan_config('ckanext.dc_serve.condense_chunk_bytes', "80")
+@pytest.mark.ckan_config('ckanext.dc_serve.condense_compression', "gzip")
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_create_condensed_dataset_job_layout(enqueue_job_mock, tmp_path):
+    """The HDF5 layout of condensed files is configurable"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+
+    path = tmp_path / "condensed.rtdc"
+    response = requests.get(s3cc.get_s3_url_for_artifact(rid, "condensed"))
+    path.write_bytes(response.content)
+    with h5py.File(path) as h5:
+        fcpl = h5.id.get_create_plist()
+        assert fcpl.get_file_space_strategy()[0] == \
+            h5py.h5f.FSPACE_STRATEGY_PAGE
+        assert fcpl.get_file_space_page_size() == 65536
+        deform = h5["events/deform"]
+        assert deform.chunks == (80 // deform.dtype.itemsize,)
+        assert deform.compression == "gzip"
+    with dclab.new_dataset(path) as ds:
+        assert "volume" in ds
+        assert np.allclose(ds["deform"][0], 0.011666297)
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
 @pytest.mark.ckan_config('ckanext.dc_serve.create_condensed_datasets', "false")
 @pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
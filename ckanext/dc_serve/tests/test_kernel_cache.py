@@ -0,0 +1,181 @@
+import threading
+import time
+
+from ckan.lib.redis import connect_to_redis
+import pytest
+
+from ckanext.dc_serve import kernel_cache
+
+
+def test_memory_kernel_cache_lru():
+    # {"id": "a"} has 11 bytes, so there is space for two kernels
+    cache = kernel_cache.MemoryKernelCache(max_bytes=25)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    # access "a" so that "b" is the least recently used entry
+    assert cache.get("a") == {"id": "a"}
+    cache.set("c", {"id": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"id": "a"}
+    assert cache.get("c") == {"id": "c"}
+    assert cache.has("a")
+    assert not cache.has("b")
+
+    cache.delete("a")
+    assert cache.get("a") is None
+    cache.clear()
+    assert cache.get("c") is None
+
+
+def test_memory_kernel_cache_stats():
+    cache = kernel_cache.MemoryKernelCache(max_bytes=100)
+    small = {"logs": {"peter": ["pan"]}}
+    size = kernel_cache.estimate_kernel_size(small)
+    cache.set("small", small)
+    assert cache.get("small") is small
+    assert cache.get("unknown") is None
+    stats = cache.stats()
+    assert stats["backend"] == "memory"
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 0
+    assert stats["entries"] == 1
+    assert stats["bytes"] == size
+
+    # kernels larger than the budget are not cached at all
+    large = {"logs": {"dcnum-log": ["a" * 100]}}
+    cache.set("large", large)
+    assert cache.get("large") is None
+    assert cache.get("small") is small
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == size
+
+    # replacing a kernel updates its size
+    cache.set("small", {})
+    assert cache.stats()["bytes"] == 2
+    cache.delete("small")
+    assert cache.stats()["bytes"] == 0
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_kernel_cache_shared(tmp_path):
+    path = tmp_path / "cache" / "kernels.sqlite3"
+    cache1 = kernel_cache.SQLiteKernelCache(path)
+    cache2 = kernel_cache.SQLiteKernelCache(path)
+    kernel = {"id": "peter",
+              "config": {"experiment": {"event count": 47}},
+              "tables": {"tab": [["a", "b"], [[1, None], [2, 3.5]]]},
+              }
+    cache1.set("peter-public", kernel)
+    assert cache2.has("peter-public")
+    assert cache2.get("peter-public") == kernel
+    assert cache2.get("peter-private") is None
+
+    cache2.delete("peter-public")
+    assert cache1.get("peter-public") is None
+
+    cache1.set("peter-public", kernel)
+    cache1.clear()
+    assert cache2.get("peter-public") is None
+
+
+def test_sqlite_kernel_cache_max_bytes(tmp_path, monkeypatch):
+    # update the access time for every hit
+    monkeypatch.setattr(kernel_cache, "SQLITE_ATIME_RESOLUTION", -1)
+    path = tmp_path / "kernels.sqlite3"
+    # {"id": "a"} has 11 bytes, so there is space for two kernels
+    cache = kernel_cache.SQLiteKernelCache(path, max_bytes=25)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    assert cache.get("a") == {"id": "a"}
+    cache.set("c", {"id": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"id": "a"}
+    assert cache.get("c") == {"id": "c"}
+    stats = cache.stats()
+    assert stats["backend"] == "sqlite"
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["bytes"] == 22
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+
+def test_sqlite_kernel_cache_atime(tmp_path):
+    cache = kernel_cache.SQLiteKernelCache(tmp_path / "kernels.sqlite3")
+    cache.set("a", {"id": "a"})
+    conn = cache._connect()
+    atime, = conn.execute("SELECT atime FROM kernels").fetchone()
+    # recent access times are not updated on cache hits
+    assert cache.get("a") == {"id": "a"}
+    assert conn.execute("SELECT atime FROM kernels").fetchone()[0] == atime
+    old = atime - kernel_cache.SQLITE_ATIME_RESOLUTION - 1
+    with conn:
+        conn.execute("UPDATE kernels SET atime = ?", (old,))
+    assert cache.get("a") == {"id": "a"}
+    assert conn.execute("SELECT atime FROM kernels").fetchone()[0] > old
+
+
+def test_estimate_kernel_size():
+    kernel = {"id": "a"}
+    assert kernel_cache.estimate_kernel_size(kernel) == 11
+    # the size computed when the kernel was built is used
+    kernel["kernel_bytes"] = 1000
+    assert kernel_cache.estimate_kernel_size(kernel) == 1000
+
+
+@pytest.mark.ckan_config('ckanext.dc_serve.kernel_cache', 'sqlite')
+def test_get_kernel_cache_from_config(tmp_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config,
+                        "ckanext.dc_serve.kernel_cache_path",
+                        str(tmp_path / "kernels.sqlite3"))
+    kernel_cache.get_kernel_cache.cache_clear()
+    try:
+        cache = kernel_cache.get_kernel_cache()
+        assert isinstance(cache, kernel_cache.SQLiteKernelCache)
+        assert cache.path == tmp_path / "kernels.sqlite3"
+    finally:
+        kernel_cache.get_kernel_cache.cache_clear()
+
+
+def test_kernel_build_lock_single_flight():
+    """Only one thread at a time builds a kernel for the same key"""
+    active = {"a": 0, "b": 0}
+    max_active = {"a": 0, "b": 0}
+    counter_lock = threading.Lock()
+
+    def build(key):
+        with kernel_cache.kernel_build_lock(key):
+            with counter_lock:
+                active[key] += 1
+                max_active[key] = max(max_active[key], active[key])
+            time.sleep(0.01)
+            with counter_lock:
+                active[key] -= 1
+
+    threads = [threading.Thread(target=build, args=(key,))
+               for key in ["a", "b"] * 5]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    assert max_active == {"a": 1, "b": 1}
+    # the per-key locks are cleaned up
+    assert not kernel_cache._build_locks
+
+
+def test_record_resource_access(monkeypatch):
+    monkeypatch.setattr(kernel_cache, "ACCESS_COUNTS_MAX_RESOURCES", 2)
+    kernel_cache.flush_resource_access()
+    connect_to_redis().delete(kernel_cache.ACCESS_COUNTS_KEY)
+    try:
+        for rid in ["a", "b", "b", "c", "c", "c"]:
+            kernel_cache.record_resource_access(rid)
+        # the counts are kept in the worker until they are flushed
+        assert not connect_to_redis().exists(kernel_cache.ACCESS_COUNTS_KEY)
+        # only the most accessed resources are kept
+        assert kernel_cache.get_most_accessed_resources(5) == ["c", "b"]
+        assert connect_to_redis().ttl(kernel_cache.ACCESS_COUNTS_KEY) > 0
+    finally:
+        connect_to_redis().delete(kernel_cache.ACCESS_COUNTS_KEY)
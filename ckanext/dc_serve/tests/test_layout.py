@@ -0,0 +1,89 @@
+import h5py
+import numpy as np
+import pytest
+
+from ckanext.dc_serve import layout
+
+
+def test_copy_condensed_layout(ckan_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_chunk_bytes",
+                        "800")
+    data = np.linspace(0, 1, 1000)
+    with h5py.File(tmp_path / "src.rtdc", "w") as h5:
+        h5.attrs["experiment:event count"] = 1000
+        h5["events/deform"] = data
+        h5["events/deform"].attrs["max"] = 1
+        h5["logs/peter"] = np.array([b"pan"])
+        assert layout.needs_condensed_layout(h5)
+        with h5py.File(tmp_path / "dst.rtdc", "w") as h5_dst:
+            layout.copy_condensed_layout(h5, h5_dst)
+
+    with h5py.File(tmp_path / "dst.rtdc", "r") as h5:
+        assert h5.attrs["experiment:event count"] == 1000
+        deform = h5["events/deform"]
+        assert deform.chunks == (100,)
+        assert deform.attrs["max"] == 1
+        assert np.all(deform[:] == data)
+        assert h5["logs/peter"][0] == b"pan"
+        # the copy already has the layout
+        assert not layout.needs_condensed_layout(h5)
+
+
+def test_copy_condensed_layout_size(ckan_config, monkeypatch, tmp_path):
+    """No space is wasted when the features are written with the layout"""
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_chunk_bytes",
+                        "8000")
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_compression",
+                        "none")
+    path_src = tmp_path / "src.rtdc"
+    path_dst = tmp_path / "dst.rtdc"
+    with h5py.File(path_src, "w") as h5:
+        for feat in ["deform", "area_um", "bright_avg"]:
+            h5[f"events/{feat}"] = np.random.random(100000)
+        with h5py.File(path_dst, "w") as h5_dst:
+            layout.copy_condensed_layout(h5, h5_dst)
+    # only the chunk indices are added
+    assert path_dst.stat().st_size < 1.05 * path_src.stat().st_size
+
+
+def test_needs_condensed_layout_compression(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_compression",
+                        "gzip")
+    with h5py.File("test.rtdc", "w", driver="core",
+                   backing_store=False) as h5:
+        h5.create_dataset("events/deform", data=np.linspace(0, 1, 1000),
+                          chunks=(100,), compression="gzip")
+        assert layout.get_compression_filter(h5["events/deform"]) == \
+            h5py.h5z.FILTER_DEFLATE
+        assert not layout.needs_condensed_layout(h5)
+        h5.create_dataset("events/area_um", data=np.linspace(0, 1, 1000),
+                          chunks=(100,))
+        assert layout.needs_condensed_layout(h5)
+
+
+def test_needs_condensed_layout_default(ckan_config):
+    with h5py.File("test.rtdc", "w", driver="core",
+                   backing_store=False) as h5:
+        h5["events/deform"] = np.linspace(0, 1, 1000)
+        # dclab's layout is kept
+        assert not layout.needs_condensed_layout(h5)
+
+
+def test_get_condensed_compression_invalid(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_compression",
+                        "lzma")
+    with pytest.raises(ValueError, match="lzma"):
+        layout.get_condensed_compression()
+
+
+def test_get_condensed_file_kwargs(ckan_config, monkeypatch):
+    assert layout.get_condensed_file_kwargs() == {}
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.condense_page_size",
+                        "65536")
+    kwargs = layout.get_condensed_file_kwargs()
+    with h5py.File("test.rtdc", "w", driver="core", backing_store=False,
+                   **kwargs) as h5:
+        fcpl = h5.id.get_create_plist()
+        assert fcpl.get_file_space_strategy()[0] == \
+            h5py.h5f.FSPACE_STRATEGY_PAGE
+        assert fcpl.get_file_space_page_size() == 65536
@@ -0,0 +1,82 @@
+import pathlib
+from unittest import mock
+
+import ckan.tests.factories as factories
+from ckan.lib.redis import connect_to_redis
+import pytest
+
+from ckanext.dc_serve import metrics
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def clean_metrics():
+    metrics.flush()
+    connect_to_redis().delete(metrics.METRICS_KEY)
+    yield
+    connect_to_redis().delete(metrics.METRICS_KEY)
+
+
+@pytest.mark.ckan_config('ckanext.dc_serve.metrics', 'true')
+@pytest.mark.usefixtures('clean_metrics')
+def test_metrics_render(ckan_config):
+    metrics.inc("dcserv_errors_total", query="logs", error="KeyError")
+    metrics.inc("dcserv_errors_total", query="logs", error="KeyError")
+    metrics.observe("dcserv_request_duration_seconds", 0.2,
+                    query="logs", format="json")
+    metrics.observe("dcserv_request_duration_seconds", 3,
+                    query="logs", format="json")
+    text = metrics.render()
+    assert "# TYPE dcserv_errors_total counter" in text
+    assert 'dcserv_errors_total{error="KeyError",query="logs"} 2.0' in text
+    assert "# TYPE dcserv_request_duration_seconds histogram" in text
+    lines = [ll for ll in text.split("\n")
+             if ll.startswith("dcserv_request_duration_seconds_bucket")]
+    assert lines[0] == ('dcserv_request_duration_seconds_bucket{format="json"'
+                        ',le="0.005",query="logs"} 0.0')
+    assert lines[5] == ('dcserv_request_duration_seconds_bucket{format="json"'
+                        ',le="0.25",query="logs"} 1.0')
+    assert lines[-1] == ('dcserv_request_duration_seconds_bucket{'
+                         'format="json",le="+Inf",query="logs"} 2.0')
+    assert ('dcserv_request_duration_seconds_sum{format="json",'
+            'query="logs"} 3.2') in text
+    assert ('dcserv_request_duration_seconds_count{format="json",'
+            'query="logs"} 2.0') in text
+
+
+@pytest.mark.ckan_config('ckanext.dc_serve.metrics', 'false')
+@pytest.mark.usefixtures('clean_metrics')
+def test_metrics_disabled(ckan_config):
+    metrics.inc("dcserv_errors_total", query="logs", error="KeyError")
+    assert "dcserv_errors_total{" not in metrics.render()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.metrics', 'true')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_metrics')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_metrics_route(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    admin = factories.SysadminWithToken()
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    app.get("/api/3/action/dcserv",
+            params={"id": res_dict["id"], "query": "metadata"},
+            status=200)
+
+    app.get("/api/dcserv/metrics",
+            headers={"Authorization": user["token"]},
+            status=403)
+    resp = app.get("/api/dcserv/metrics",
+                   headers={"Authorization": admin["token"]},
+                   status=200)
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    text = resp.body
+    assert ('dcserv_request_duration_seconds_count{format="json",'
+            'query="metadata"} 1.0') in text
+    assert 'dcserv_kernel_cache_requests_total{backend="memory"' in text
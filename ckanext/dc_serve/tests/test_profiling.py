@@ -0,0 +1,66 @@
+import pathlib
+import pstats
+from unittest import mock
+
+import ckan.tests.factories as factories
+import pytest
+
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.profile_sample_fraction', '1')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_profiling_sampled(enqueue_job_mock, app, tmp_path, ckan_config,
+                           monkeypatch):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.profile_dir",
+                        str(tmp_path))
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "metadata"},
+            status=200)
+    profiles = list((tmp_path / rid).glob("metadata_*.pstats"))
+    assert len(profiles) == 1
+    stats = pstats.Stats(str(profiles[0]))
+    assert any(func[2] == "dcserv" for func in stats.stats)
+
+    # other requests are not profiled
+    app.get("/api/3/action/status_show", status=200)
+    assert len(list(tmp_path.rglob("*.pstats"))) == 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_profiling_on_demand(enqueue_job_mock, app, tmp_path, ckan_config,
+                             monkeypatch):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.profile_dir",
+                        str(tmp_path))
+    user = factories.UserWithToken()
+    admin = factories.SysadminWithToken()
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+
+    # normal users cannot request profiling
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "size", "profile": "1"},
+            headers={"Authorization": user["token"]},
+            status=200)
+    assert not list(tmp_path.rglob("*.pstats"))
+
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "size", "profile": "1"},
+            headers={"Authorization": admin["token"]},
+            status=200)
+    assert len(list((tmp_path / rid).glob("size_*.pstats"))) == 1
@@ -1,4 +1,6 @@
+import threading
 import uuid
+
 from ckanext.dc_serve import res_file_lock
 
 
@@ -46,3 +48,24 @@ def test_lock_delete():
 
     assert fla2.acquire()
     assert fla2.is_locked
+
+
+def test_lock_concurrent():
+    res_id = str(uuid.uuid4())
+    barrier = threading.Barrier(10)
+    locks = [res_file_lock.CKANResourceFileLock(
+        resource_id=res_id,
+        locker_id="collect_apples") for _ in range(10)]
+
+    def acquire(fl):
+        barrier.wait()
+        fl.acquire()
+
+    threads = [threading.Thread(target=acquire, args=(fl,)) for fl in locks]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    assert sum(fl.is_locked for fl in locks) == 1
+    for fl in locks:
+        fl.release()
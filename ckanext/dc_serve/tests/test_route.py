@@ -1,9 +1,14 @@
+import gzip
+import io
+import json
 import pathlib
 from unittest import mock
 
 import ckan.tests.factories as factories
+import dclab
 import dcor_shared
 from dcor_shared import s3cc
+import numpy as np
 
 import pytest
 
@@ -163,3 +168,81 @@ def test_route_redircet_resource_to_s3_private(enqueue_job_mock, app):
     # Since we have a presigned URL, it is longer than the normal S3 URL.
     assert redirect.location.startswith(redirect_stem)
     assert len(redirect.location) > len(redirect_stem)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_route_dcserv_binary(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    path = data_path / "cytoshot_blood.rtdc"
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=path,
+        activate=True,
+        private=True)
+    rid = res_dict["id"]
+
+    # not authorized
+    app.get(f"/api/dcserv/{rid}/tables",
+            params={"format": "npz"},
+            status=404)
+
+    # tables as npz file
+    resp = app.get(f"/api/dcserv/{rid}/tables",
+                   params={"format": "npz"},
+                   headers={"Authorization": user["token"]},
+                   status=200)
+    assert resp.headers["ETag"].strip('"').endswith("-npz")
+    # conditional GET
+    resp_cond = app.get(f"/api/dcserv/{rid}/tables",
+                        params={"format": "npz"},
+                        headers={"Authorization": user["token"],
+                                 "If-None-Match": resp.headers["ETag"]},
+                        status=304)
+    assert not resp_cond.body
+    with dclab.new_dataset(path) as ds, \
+            np.load(io.BytesIO(resp.body)) as npz:
+        assert "src_cytoshot_monitor" in npz
+        table = npz["src_cytoshot_monitor"]
+        table_ref = ds.tables["src_cytoshot_monitor"][:]
+        assert table.dtype == table_ref.dtype
+        assert np.all(table["brightness"] == table_ref["brightness"])
+
+    # logs as gzip-compressed JSON
+    resp = app.get(f"/api/dcserv/{rid}/logs",
+                   params={"format": "gzip"},
+                   headers={"Authorization": user["token"]},
+                   status=200)
+    logs = json.loads(gzip.decompress(resp.body))
+    resp_json = app.get("/api/3/action/dcserv",
+                        params={"id": rid, "query": "logs"},
+                        headers={"Authorization": user["token"]},
+                        status=200)
+    assert logs == json.loads(resp_json.body)["result"]
+
+    # the dcserv API action only supports JSON
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "tables", "format": "npz"},
+            headers={"Authorization": user["token"]},
+            status=409)
+
+    # invalid formats and queries
+    for query, fmt in [("tables", "json"),
+                       ("logs", "npz"),
+                       ("metadata", "npz"),
+                       ]:
+        app.get(f"/api/dcserv/{rid}/{query}",
+                params={"format": fmt},
+                headers={"Authorization": user["token"]},
+                status=400)
+        # validated before the ETag is compared
+        app.get(f"/api/dcserv/{rid}/{query}",
+                params={"format": fmt},
+                headers={"Authorization": user["token"],
+                         "If-None-Match": "*"},
+                status=400)
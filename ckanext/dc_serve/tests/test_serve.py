@@ -3,10 +3,12 @@ import json
 import pathlib
 from unittest import mock
 import shutil
+import threading
 import time
 import uuid
 
 import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
 import dclab
 from dclab.rtdc_dataset import fmt_http
 import h5py
@@ -14,6 +16,7 @@ import numpy as np
 
 import pytest
 
+from ckanext.dc_serve import kernel_cache, route_funcs, serve
 from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
 from dcor_shared import s3cc
 
@@ -538,6 +541,33 @@ def test_api_dcserv_metadata(enqueue_job_mock, app):
     assert jres["result"]["setup"]["channel width"] == 20
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_metadata_from_kernel_artifact(enqueue_job_mock, app):
+    """The kernel artifact makes opening the HDF5 files unnecessary"""
+    user = factories.UserWithToken()
+    # create a dataset
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+
+    with mock.patch("ckanext.dc_serve.serve.get_s3_dc_handle_timed",
+                    side_effect=AssertionError("no HDF5 access")):
+        resp = app.get(
+            "/api/3/action/dcserv",
+            params={"id": res_dict["id"],
+                    "query": "metadata",
+                    },
+            headers={"Authorization": user["token"]},
+            status=200
+        )
+    jres = json.loads(resp.body)
+    assert jres["success"]
+    assert jres["result"]["setup"]["channel width"] == 20
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
 @pytest.mark.usefixtures('with_plugins', 'clean_db')
 @mock.patch('ckan.plugins.toolkit.enqueue_job',
@@ -607,6 +637,79 @@ def test_api_dcserv_tables(enqueue_job_mock, app):
     assert "brightness" in names
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_tables_logs_select(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=data_path / "cytoshot_blood.rtdc",
+        activate=True)
+
+    def dcserv(status=200, **params):
+        resp = app.get(
+            "/api/3/action/dcserv",
+            params=dict(id=res_dict["id"], **params),
+            headers={"Authorization": user["token"]},
+            status=status
+        )
+        return json.loads(resp.body)
+
+    tables = dcserv(query="tables")["result"]
+    logs = dcserv(query="logs")["result"]
+    assert dcserv(query="tables_list")["result"] == sorted(tables)
+    assert dcserv(query="logs_list")["result"] == sorted(logs)
+
+    # single table
+    names, data = dcserv(query="tables",
+                         name="src_cytoshot_monitor")["result"]
+    assert [names, data] == tables["src_cytoshot_monitor"]
+
+    # single table with rows sliced
+    names, data = dcserv(query="tables",
+                         name="src_cytoshot_monitor",
+                         offset=1,
+                         limit=2)["result"]
+    assert data == tables["src_cytoshot_monitor"][1][1:3]
+
+    # log lines sliced
+    log_name = sorted(logs)[0]
+    lines = dcserv(query="logs", name=log_name, offset=1)["result"]
+    assert lines == logs[log_name][1:]
+    sliced = dcserv(query="logs", limit=1)["result"]
+    assert sorted(sliced) == sorted(logs)
+    assert all(len(lines) <= 1 for lines in sliced.values())
+
+    # errors
+    jres = dcserv(query="tables", name="peter", status=409)
+    assert "The table 'peter' does not exist" in jres["error"]["message"]
+    jres = dcserv(query="logs", limit=-1, status=409)
+    assert "'limit' must be a non-negative integer" \
+        in jres["error"]["message"]
+    jres = dcserv(query="metadata", name="peter", status=409)
+    assert "only supported for the queries" in jres["error"]["message"]
+
+
+def test_select_entries():
+    logs = {"peter": ["a", "b", "c"], "pan": ["d"]}
+    assert serve.select_entries(logs, kind="log") is logs
+    assert serve.select_entries(logs, kind="log", name="pan") == ["d"]
+    assert serve.select_entries(logs, kind="log", offset=1) == {
+        "peter": ["b", "c"], "pan": []}
+    assert serve.select_entries(logs, kind="log", name="peter",
+                                offset=1, limit=1) == ["b"]
+
+    tables = {"tab": (["x", "y"], [[1, 2], [3, 4], [5, None]])}
+    assert serve.select_entries(tables, kind="table", limit=1) == {
+        "tab": (["x", "y"], [[1, 2]])}
+    assert serve.select_entries(tables, kind="table", name="tab",
+                                offset=2) == (["x", "y"], [[5, None]])
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
 @pytest.mark.usefixtures('with_plugins', 'clean_db')
 @mock.patch('ckan.plugins.toolkit.enqueue_job',
@@ -736,3 +839,714 @@ def test_api_dcserv_valid(enqueue_job_mock, app):
     jres = json.loads(resp.body)
     assert jres["success"]
     assert jres["result"]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_kernel_cache_stats(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    admin = factories.SysadminWithToken()
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+
+    app.get("/api/3/action/dcserv_kernel_cache_stats",
+            headers={"Authorization": user["token"]},
+            status=403)
+
+    for _ in range(2):
+        app.get("/api/3/action/dcserv",
+                params={"id": res_dict["id"],
+                        "query": "size",
+                        },
+                headers={"Authorization": user["token"]},
+                status=200)
+
+    resp = app.get("/api/3/action/dcserv_kernel_cache_stats",
+                   headers={"Authorization": admin["token"]},
+                   status=200)
+    stats = json.loads(resp.body)["result"]
+    assert stats["backend"] == "memory"
+    assert stats["hits"] >= 1
+    assert stats["misses"] >= 1
+    assert stats["entries"] >= 1
+    assert stats["bytes"] > 0
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.create_condensed_datasets', "false")
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_get_resource_kernel_condensed_backoff(enqueue_job_mock):
+    """Missing condensed resources are not accessed on every request"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+
+    with mock.patch.object(
+            serve, "get_resource_kernel_complement_condensed",
+            wraps=serve.get_resource_kernel_complement_condensed) as cmock:
+        r_data = serve.get_resource_kernel(rid)
+        assert cmock.call_count == 1
+        assert not r_data.get("complemented-condensed")
+        assert r_data["condensed-failures"] == 1
+        assert r_data["condensed-retry-at"] > time.time()
+
+        # backoff
+        serve.get_resource_kernel(rid)
+        assert cmock.call_count == 1
+
+        # completion signal of the condense job
+        kernel_cache.set_condensed_signal(rid)
+        r_data = serve.get_resource_kernel(rid)
+        assert cmock.call_count == 2
+        # condensed resource still missing, backoff is doubled
+        assert r_data["condensed-failures"] == 2
+
+
+def test_get_resource_kernel_single_flight():
+    """Concurrent requests for an uncached kernel only build it once"""
+    rid = str(uuid.uuid4())
+    build_count = [0]
+
+    def get_resource_kernel_artifact(resource_id, public, bucket_name):
+        build_count[0] += 1
+        time.sleep(0.2)
+        return {"id": resource_id, "complemented-condensed": True}
+
+    results = []
+    with mock.patch.object(serve, "get_resource_kernel_converted",
+                           return_value=None), \
+            mock.patch.object(serve, "get_resource_kernel_artifact",
+                              side_effect=get_resource_kernel_artifact):
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                serve.get_resource_kernel(rid, public=True)))
+            for _ in range(20)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+    assert build_count[0] == 1
+    assert len(results) == 20
+    assert all(r_data["id"] == rid for r_data in results)
+
+
+class FakeDataset:
+    """Stand-in for datasets opened via S3 in kernel tests"""
+
+    def __init__(self, artifact, tables=(), logs=()):
+        self.artifact = artifact
+        self.tables = dict.fromkeys(tables)
+        self.logs = dict.fromkeys(logs)
+
+
+def test_get_resource_kernel_from_s3_concurrent_opens():
+    """The condensed and original resources are opened concurrently"""
+    rid = str(uuid.uuid4())
+    condensed_opened = threading.Event()
+    opened = []
+    sources = {}
+
+    def get_s3_dc_handle(resource_id, artifact, bucket_name):
+        opened.append(artifact)
+        if artifact == "resource":
+            # This would time out if the condensed resource was opened later
+            assert condensed_opened.wait(timeout=10)
+        else:
+            condensed_opened.set()
+        return FakeDataset(artifact)
+
+    def get_resource_kernel_from_dc(resource_id, ds, sections):
+        for sec in sections:
+            sources[sec] = ds.artifact
+        return {"id": resource_id, "logs": {}}
+
+    def complement_resource_kernel_from_dc(r_data, ds_con):
+        assert ds_con.artifact == "condensed"
+        r_data["complemented-condensed"] = True
+
+    with mock.patch.object(serve.s3cc, "get_s3_bucket_name_for_resource"), \
+            mock.patch.object(serve, "get_s3_dc_handle_timed",
+                              side_effect=get_s3_dc_handle), \
+            mock.patch.object(serve, "get_resource_kernel_from_dc",
+                              side_effect=get_resource_kernel_from_dc), \
+            mock.patch.object(serve, "complement_resource_kernel_from_dc",
+                              side_effect=complement_resource_kernel_from_dc):
+        r_data = serve.get_resource_kernel_from_s3(
+            rid, public=False, sections=["logs", "trace_list"])
+    assert r_data["sections"] == ["trace_list", "logs"]
+    assert r_data["complemented-condensed"]
+    assert "condensed-failures" not in r_data
+    assert sources == {"logs": "condensed", "trace_list": "resource"}
+    # the condensed resource is opened only once
+    assert sorted(opened) == ["condensed", "resource"]
+
+
+def test_get_resource_kernel_from_s3_original_only():
+    """The condensed resource is not opened for config-only queries"""
+    rid = str(uuid.uuid4())
+    opened = []
+
+    def get_s3_dc_handle(resource_id, artifact, bucket_name):
+        opened.append(artifact)
+        return FakeDataset(artifact)
+
+    with mock.patch.object(serve.s3cc, "get_s3_bucket_name_for_resource"), \
+            mock.patch.object(serve, "get_s3_dc_handle_timed",
+                              side_effect=get_s3_dc_handle), \
+            mock.patch.object(serve, "get_resource_kernel_from_dc",
+                              return_value={"id": rid}):
+        r_data = serve.get_resource_kernel_from_s3(
+            rid, public=False, sections=["config", "trace_list"])
+    assert r_data["sections"] == ["config", "trace_list"]
+    assert opened == ["resource"]
+
+
+def test_get_resource_kernel_base_prefers_condensed():
+    """Tables and logs are extracted from the condensed resource"""
+    rid = str(uuid.uuid4())
+    sources = {}
+    condensed_available = [False]
+    condensed_logs = ["dclab-condense", "cytoshot"]
+
+    def get_s3_dc_handle(resource_id, artifact, bucket_name):
+        if artifact == "condensed":
+            if not condensed_available[0]:
+                raise ValueError("Not condensed yet")
+            return FakeDataset(artifact, tables=["sensors"],
+                               logs=condensed_logs)
+        return FakeDataset(artifact, tables=["sensors"], logs=["cytoshot"])
+
+    def get_resource_kernel_from_dc(resource_id, ds, sections):
+        for sec in sections:
+            sources[sec] = ds.artifact
+        return {"id": resource_id}
+
+    with mock.patch.object(serve.s3cc, "get_s3_bucket_name_for_resource"), \
+            mock.patch.object(serve, "get_s3_dc_handle_timed",
+                              side_effect=get_s3_dc_handle), \
+            mock.patch.object(serve, "get_resource_kernel_from_dc",
+                              side_effect=get_resource_kernel_from_dc):
+        # condensed resource not available
+        serve.get_resource_kernel_base(rid, public=False)
+        assert sources == {sec: "resource" for sec in serve.KERNEL_SECTIONS}
+        # condensed resource available
+        sources.clear()
+        condensed_available[0] = True
+        serve.get_resource_kernel_base(rid, public=False)
+        # the metadata differ in the condensed resource
+        assert sources == {"config": "resource",
+                           "trace_list": "resource",
+                           "tables": "condensed",
+                           "logs": "condensed",
+                           "basins": "resource",
+                           }
+        # condensed resource without the logs of the original resource
+        sources.clear()
+        condensed_logs.remove("cytoshot")
+        serve.get_resource_kernel_base(rid, public=False)
+        assert sources["tables"] == "condensed"
+        assert sources["logs"] == "resource"
+
+
+def test_get_resource_kernel_lazy_sections():
+    """Kernel sections are only loaded when they are requested"""
+    rid = str(uuid.uuid4())
+    opened = []
+
+    with dclab.new_dataset(data_path / "calibration_beads_47.rtdc") as ds:
+        def get_s3_dc_handle(resource_id, artifact, bucket_name):
+            opened.append(artifact)
+            return ds
+
+        with mock.patch.object(serve.s3cc,
+                               "get_s3_bucket_name_for_resource"), \
+                mock.patch.object(serve, "get_s3_dc_handle_timed",
+                                  side_effect=get_s3_dc_handle), \
+                mock.patch.object(serve, "get_resource_kernel_converted",
+                                  return_value=None), \
+                mock.patch.object(serve, "get_resource_kernel_artifact",
+                                  return_value=None), \
+                mock.patch.object(serve, "get_resource_basins_dicts_public",
+                                  return_value=[]):
+            r_data = serve.get_resource_kernel(rid, public=True,
+                                               sections=["config"])
+            assert r_data["sections"] == ["config"]
+            assert "tables" not in r_data
+            assert "logs" not in r_data
+            # the config is extracted from the original resource only
+            assert opened == ["resource"]
+
+            assert serve.serve_query(rid, "size", public=True) == len(ds)
+            assert opened == ["resource"]
+
+            r_data = serve.get_resource_kernel(rid, public=True,
+                                               sections=["logs"])
+            assert r_data["sections"] == ["config", "logs"]
+            assert r_data["complemented-condensed"]
+            assert "logs" in r_data
+            assert "tables" not in r_data
+            assert sorted(opened) == ["condensed", "resource", "resource"]
+
+            r_data = serve.get_resource_kernel(rid, public=True)
+            assert r_data["sections"] == serve.KERNEL_SECTIONS
+            assert "tables" in r_data
+            assert "basin_features" in r_data
+            assert r_data["complemented-condensed"]
+
+
+def test_get_presigned_url_reuse():
+    rid = str(uuid.uuid4())
+    t0 = time.time()
+    urls = iter(["https://example.org/a", "https://example.org/b"])
+
+    def create_presigned_url(bucket_name, object_name, expiration,
+                             ret_expiration):
+        assert bucket_name == "bucket"
+        return next(urls), int(time.time()) + expiration
+
+    with mock.patch.object(serve.s3, "create_presigned_url",
+                           side_effect=create_presigned_url) as pmock:
+        url1, time_request1, expires_at1 = serve.get_presigned_url(
+            rid, artifact="condensed", bucket_name="bucket")
+        url2, time_request2, expires_at2 = serve.get_presigned_url(
+            rid, artifact="condensed", bucket_name="bucket")
+        assert pmock.call_count == 1
+        assert url1 == url2 == "https://example.org/a"
+        assert time_request1 == time_request2 >= t0
+        assert expires_at1 == expires_at2
+
+        # more than half of the lifetime elapsed
+        with mock.patch.object(serve.time, "time",
+                               return_value=time_request1 + 1801):
+            url3, time_request3, _ = serve.get_presigned_url(
+                rid, artifact="condensed", bucket_name="bucket")
+        assert pmock.call_count == 2
+        assert url3 == "https://example.org/b"
+        assert time_request3 == time_request1 + 1801
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_batch(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict1 = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+    _, res_dict2 = make_dataset_via_s3(
+        resource_path=data_path / "cytoshot_blood.rtdc",
+        private=False,
+        activate=True)
+    # private dataset of another user
+    _, res_dict3 = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+    rid1 = res_dict1["id"]
+    rid2 = res_dict2["id"]
+    rid3 = res_dict3["id"]
+    rid4 = str(uuid.uuid4())
+
+    with mock.patch.object(serve.logic, "check_access",
+                           wraps=serve.logic.check_access) as check_access:
+        resp = app.post(
+            "/api/3/action/dcserv_batch",
+            json={"ids": [rid1, rid2, rid3, rid4],
+                  "queries": ["size", "metadata", "trace_list"],
+                  },
+            headers={"Authorization": user["token"]},
+            status=200
+        )
+        checked = [c.kwargs["data_dict"]["id"]
+                   for c in check_access.call_args_list
+                   if c.args and c.args[0] == "resource_show"]
+    # same authorization as for a single dcserv request
+    assert checked == [rid1, rid2, rid3, rid4]
+    jres = json.loads(resp.body)
+    assert jres["success"]
+    result = jres["result"]
+    assert result[rid1]["size"] == {"success": True, "result": 47}
+    assert result[rid1]["metadata"]["result"]["setup"]["channel width"] == 20
+    with dclab.new_dataset(data_path / "calibration_beads_47.rtdc") as ds:
+        assert result[rid1]["trace_list"]["result"] == sorted(ds["trace"])
+    assert result[rid2]["size"]["success"]
+    assert "experiment" in result[rid2]["metadata"]["result"]
+    for query in ["size", "metadata", "trace_list"]:
+        assert not result[rid3][query]["success"]
+        assert "Not authorized" in result[rid3][query]["error"]
+        assert result[rid4][query] == {"success": False,
+                                       "error": "Not found"}
+
+    # invalid query
+    resp = app.get(
+        "/api/3/action/dcserv_batch",
+        params={"ids": f"{rid1},{rid2}",
+                "queries": "size,peter",
+                },
+        headers={"Authorization": user["token"]},
+        status=409
+    )
+    jres = json.loads(resp.body)
+    assert "Invalid query parameter 'peter'" in jres["error"]["message"]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_batch_bucket_names(enqueue_job_mock, app):
+    """The bucket names are not looked up in the thread pool"""
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    rids = []
+    for private in [True, False]:
+        _, res_dict = make_dataset_via_s3(
+            create_context=copy.deepcopy(create_context),
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            private=private,
+            activate=True)
+        rids.append(res_dict["id"])
+    serve.get_kernel_cache().clear()
+    threads = []
+
+    def get_s3_bucket_name_for_resource(resource_id):
+        threads.append(threading.current_thread())
+        return get_bucket_name(resource_id)
+
+    get_bucket_name = serve.s3cc.get_s3_bucket_name_for_resource
+    with mock.patch.object(serve.s3cc, "get_s3_bucket_name_for_resource",
+                           side_effect=get_s3_bucket_name_for_resource):
+        resp = app.post(
+            "/api/3/action/dcserv_batch",
+            json={"ids": rids,
+                  "queries": ["valid", "size", "basins", "logs"],
+                  },
+            headers={"Authorization": user["token"]},
+            status=200
+        )
+    result = json.loads(resp.body)["result"]
+    for rid in rids:
+        for query in ["valid", "size", "basins", "logs"]:
+            assert result[rid][query]["success"], result[rid][query]
+    assert threads
+    assert set(threads) == {threading.current_thread()}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_api_dcserv_kernel_lookups(enqueue_job_mock, app):
+    """The kernel is looked up once per request (including the ETag)"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    params = {"id": res_dict["id"], "query": "size"}
+    app.get("/api/3/action/dcserv", params=params, status=200)
+    cache = kernel_cache.get_kernel_cache()
+
+    for headers in [{}, {"If-None-Match": '"size-unknown"'}]:
+        hits = cache.stats()["hits"]
+        with mock.patch.object(serve, "get_resource_kernel",
+                               wraps=serve.get_resource_kernel) as gmock:
+            resp = app.get("/api/3/action/dcserv",
+                           params=params,
+                           headers=headers,
+                           status=200)
+        assert resp.headers["ETag"]
+        assert gmock.call_count == 1
+        assert cache.stats()["hits"] == hits + 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+@pytest.mark.parametrize("private", [True, False])
+def test_api_dcserv_etag(enqueue_job_mock, app, private):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=private,
+        activate=True)
+
+    resp = app.get(
+        "/api/3/action/dcserv",
+        params={"id": res_dict["id"],
+                "query": "metadata",
+                },
+        headers={"Authorization": user["token"]},
+        status=200
+    )
+    etag = resp.headers["ETag"]
+    assert etag.strip('"').startswith("metadata-")
+    cache_control = resp.headers["Cache-Control"]
+    if private:
+        assert "private" in cache_control
+        assert "public" not in cache_control
+        assert "no-cache" in cache_control
+        assert "max-age" not in cache_control
+    else:
+        assert "public" in cache_control
+        assert "private" not in cache_control
+        # not overridden by `ckan.cache_expires`
+        assert f"max-age={route_funcs.DCSERV_PUBLIC_MAX_AGE}" \
+            in cache_control
+
+    # conditional GET (answered without serving the query)
+    with mock.patch.object(serve, "serve_query",
+                           side_effect=AssertionError("query served")):
+        resp = app.get(
+            "/api/3/action/dcserv",
+            params={"id": res_dict["id"],
+                    "query": "metadata",
+                    },
+            headers={"Authorization": user["token"],
+                     "If-None-Match": etag},
+            status=304
+        )
+    assert not resp.body
+    assert resp.headers["ETag"] == etag
+
+    # other queries have other ETags
+    resp = app.get(
+        "/api/3/action/dcserv",
+        params={"id": res_dict["id"],
+                "query": "size",
+                },
+        headers={"Authorization": user["token"],
+                 "If-None-Match": etag},
+        status=200
+    )
+    assert resp.headers["ETag"] != etag
+
+    # no ETag for queries that are not derived from the kernel
+    resp = app.get(
+        "/api/3/action/dcserv",
+        params={"id": res_dict["id"],
+                "query": "valid",
+                },
+        headers={"Authorization": user["token"]},
+        status=200
+    )
+    assert "ETag" not in resp.headers
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_invalidate_resource_privacy_change(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+    rid = res_dict["id"]
+    cache = kernel_cache.get_kernel_cache()
+    key_private = serve.get_resource_kernel_key(rid, public=False)
+    key_public = serve.get_resource_kernel_key(rid, public=True)
+
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "metadata"},
+            headers={"Authorization": user["token"]},
+            status=200)
+    assert cache.has(key_private)
+    assert not cache.has(key_public)
+
+    helpers.call_action("package_patch",
+                        context=copy.deepcopy(create_context),
+                        id=ds_dict["id"],
+                        private=False)
+
+    # The kernel is converted instead of being built again.
+    with mock.patch.object(serve, "get_resource_kernel_artifact",
+                           side_effect=ValueError("kernel rebuilt")):
+        resp = app.get("/api/3/action/dcserv",
+                       params={"id": rid, "query": "basins"},
+                       status=200)
+    assert not cache.has(key_private)
+    assert cache.has(key_public)
+    basins = json.loads(resp.body)["result"]
+    assert basins
+    assert "Signature" not in basins[0]["urls"][0]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_invalidate_resource_dataset_update(enqueue_job_mock):
+    user = factories.User()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+
+    with mock.patch.object(serve, "invalidate_resource") as invalidate:
+        # other changes of the dataset do not affect dcserv
+        helpers.call_action("package_patch",
+                            context=copy.deepcopy(create_context),
+                            id=ds_dict["id"],
+                            title="A new title")
+        invalidate.assert_not_called()
+
+        helpers.call_action("package_patch",
+                            context=copy.deepcopy(create_context),
+                            id=ds_dict["id"],
+                            private=False)
+        invalidate.assert_called_once_with(res_dict["id"], public=True)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_invalidate_resource_bulk_update(enqueue_job_mock):
+    user = factories.User()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+
+    # the bulk update actions do not call package_update
+    with mock.patch.object(serve, "invalidate_resource") as invalidate:
+        helpers.call_action("bulk_update_public",
+                            datasets=[ds_dict["id"]],
+                            org_id=ds_dict["owner_org"])
+        invalidate.assert_called_once_with(res_dict["id"], public=True)
+
+    with mock.patch.object(serve, "invalidate_resource") as invalidate:
+        helpers.call_action("bulk_update_delete",
+                            datasets=[ds_dict["id"]],
+                            org_id=ds_dict["owner_org"])
+        invalidate.assert_called_once_with(res_dict["id"], public=True)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_invalidate_resource_update(enqueue_job_mock, app):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context=copy.deepcopy(create_context),
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    cache = kernel_cache.get_kernel_cache()
+    key_public = serve.get_resource_kernel_key(rid, public=True)
+
+    app.get("/api/3/action/dcserv",
+            params={"id": rid, "query": "metadata"},
+            status=200)
+    assert cache.has(key_public)
+    assert rid in serve._dc_resource_cache
+
+    helpers.call_action("resource_patch",
+                        context=copy.deepcopy(create_context),
+                        id=rid,
+                        description="A new description")
+    assert not cache.has(key_public)
+    assert rid not in serve._dc_resource_cache
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_get_resource_info(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=True,
+        activate=True)
+    rid = res_dict["id"]
+    info = serve.get_resource_info(rid)
+    assert info == {"package_id": ds_dict["id"],
+                    "organization_id": owner_org["id"],
+                    "private": True,
+                    "active": True,
+                    }
+    assert not serve.is_resource_public(rid)
+    # cached
+    assert serve.get_resource_info(rid) is info
+    # invalidated
+    serve.invalidate_resource(rid)
+    assert serve.get_resource_info(rid) is not info
+
+    assert serve.get_resource_info(str(uuid.uuid4())) is None
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+@pytest.mark.parametrize("private", [True, False])
+def test_api_dcserv_access_runs_auth(enqueue_job_mock, app, private):
+    user = factories.UserWithToken()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        private=private,
+        activate=True)
+
+    with mock.patch.object(serve.logic, "check_access",
+                           wraps=serve.logic.check_access) as check_access:
+        app.get(
+            "/api/3/action/dcserv",
+            params={"id": res_dict["id"],
+                    "query": "size",
+                    },
+            headers={"Authorization": user["token"]},
+            status=200
+        )
+        checked = [c for c in check_access.call_args_list
+                   if c.args and c.args[0] == "resource_show"]
+    # the authorization functions are run for public resources as well
+    assert checked
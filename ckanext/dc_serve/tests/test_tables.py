@@ -0,0 +1,88 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from ckanext.dc_serve import tables
+
+
+def assert_tables_equal(a, b):
+    assert a.dtype == b.dtype
+    assert a.shape == b.shape
+    for name in a.dtype.names:
+        assert np.array_equal(a[name], b[name],
+                              equal_nan=a.dtype[name].kind == "f")
+
+
+def make_table(size, nan_indices=()):
+    data = np.zeros((size, 1), dtype=[("frame", "<i8"),
+                                      ("brightness", "<f8"),
+                                      ("temperature", "<f4"),
+                                      ("valid", "?"),
+                                      ])
+    data["frame"][:, 0] = np.arange(size)
+    data["brightness"][:, 0] = np.linspace(-1, 1, size)
+    data["temperature"][:, 0] = 23.5
+    data["valid"][::2] = True
+    for idx in nan_indices:
+        data["brightness"][idx] = np.nan
+    return data
+
+
+@pytest.mark.parametrize("nan_indices", [(), (2,), (0, 5, 9)])
+def test_table_to_list_structured(nan_indices):
+    data = make_table(10, nan_indices=nan_indices)
+    expected = tables.replace_nan_with_none_recursive(data.tolist())
+    actual = tables.table_to_list(data)
+    assert actual == expected
+    for idx in nan_indices:
+        assert actual[idx][0][1] is None
+    # types must be JSON-serializable
+    assert json.loads(json.dumps(actual)) == actual
+
+
+def test_table_to_list_unstructured():
+    data = np.linspace(0, 1, 12).reshape(4, 3)
+    data[1, 2] = np.nan
+    actual = tables.table_to_list(data)
+    assert actual == tables.replace_nan_with_none_recursive(data.tolist())
+    assert actual[1][2] is None
+
+
+def test_table_to_list_inf():
+    data = make_table(5)
+    data["brightness"][1] = np.inf
+    data["temperature"][3] = -np.inf
+    actual = tables.table_to_list(data)
+    assert actual[1][0][1] is None
+    assert actual[3][0][2] is None
+    assert actual[2][0] == [2, 0.0, 23.5, True]
+
+
+@pytest.mark.parametrize("nan_indices", [(), (2,), (0, 5, 9)])
+def test_list_to_table(nan_indices):
+    data = make_table(10, nan_indices=nan_indices)
+    descr = json.loads(json.dumps(tables.get_table_descr(data)))
+    restored = tables.list_to_table(data.dtype.names,
+                                    tables.table_to_list(data),
+                                    descr)
+    assert_tables_equal(restored, data)
+
+
+def test_list_to_table_without_descr():
+    data = make_table(10, nan_indices=(3,))
+    restored = tables.list_to_table(data.dtype.names,
+                                    tables.table_to_list(data))
+    assert restored.dtype.names == data.dtype.names
+    assert restored.dtype["frame"] == np.float64
+    assert np.all(restored["frame"] == data["frame"])
+    assert np.isnan(restored["brightness"][3, 0])
+
+
+def test_tables_to_npz():
+    data = make_table(10, nan_indices=(3,))
+    raw = tables.tables_to_npz({"peter": data})
+    with np.load(io.BytesIO(raw)) as npz:
+        assert list(npz.keys()) == ["peter"]
+        assert_tables_equal(npz["peter"], data)
@@ -0,0 +1,88 @@
+import hashlib
+import io
+import pathlib
+from unittest import mock
+
+import pytest
+import requests
+
+from ckanext.dc_serve import upload
+from dcor_shared import s3cc
+from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
+
+
+data_path = pathlib.Path(__file__).parent / "data"
+
+
+def test_checksum_reader_etags():
+    data = bytes(range(256)) * 50
+    reader = upload.ChecksumReader(io.BytesIO(data), part_size=1000)
+    # read in chunks that are not aligned with the parts
+    while reader.read(333):
+        pass
+    assert reader.size == len(data)
+    parts = [data[ii:ii + 1000] for ii in range(0, len(data), 1000)]
+    multipart = hashlib.md5(
+        b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+    assert reader.get_etags() == {hashlib.md5(data).hexdigest(),
+                                  f"{multipart}-13"}
+
+
+def test_get_part_size(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, "ckanext.dc_serve.upload_part_size",
+                        "1024")
+    assert upload.get_part_size(10) == upload.MULTIPART_MIN_PART_SIZE
+    # the number of parts is limited
+    size = 100 * 1024**3
+    part_size = upload.get_part_size(size)
+    assert part_size * upload.MULTIPART_MAX_PARTS >= size
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.ckan_config('ckanext.dc_serve.upload_part_size', "5242880")
+@pytest.mark.ckan_config('ckanext.dc_serve.upload_max_concurrency', "2")
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_upload_artifact_multipart(enqueue_job_mock):
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    # three parts
+    data = bytes(range(256)) * (11 * 1024**2 // 256)
+    upload.upload_artifact(rid, artifact="preview", source=data)
+    # the object is public
+    response = requests.get(s3cc.get_s3_url_for_artifact(rid, "preview"))
+    assert response.ok
+    assert response.content == data
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve')
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_upload_artifact_etag_not_md5(enqueue_job_mock):
+    """Uploads are verified via SHA256 if the ETag is not an MD5 sum"""
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    data = b"kernel data"
+    # e.g. server-side encryption with KMS
+    with mock.patch.object(upload.s3cc, "get_s3_attributes_for_artifact",
+                           return_value={"etag": '"encrypted"'}), \
+            mock.patch.object(upload.s3, "compute_checksum",
+                              wraps=upload.s3.compute_checksum) as cmock:
+        upload.upload_artifact(rid, artifact="preview", source=data)
+    assert cmock.call_count == 1
+    response = requests.get(s3cc.get_s3_url_for_artifact(rid, "preview"))
+    assert response.content == data
+
+    # corrupt upload
+    with mock.patch.object(upload.s3cc, "get_s3_attributes_for_artifact",
+                           return_value={"etag": '"encrypted"'}), \
+            mock.patch.object(upload.s3, "compute_checksum",
+                              return_value="0" * 64):
+        with pytest.raises(ValueError, match="Checksum mismatch"):
+            upload.upload_artifact(rid, artifact="preview", source=data)
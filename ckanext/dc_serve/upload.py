@@ -0,0 +1,179 @@
+"""Upload of artifacts to S3 with tunable multipart transfers
+
+Artifacts larger than ``ckanext.dc_serve.upload_part_size`` are
+uploaded in parts, ``ckanext.dc_serve.upload_max_concurrency`` of
+them in parallel (:func:`dcor_shared.s3.upload_file` does not support
+this). Uploads are verified with MD5 checksums that are computed
+while the data are read for the upload. If the ETag of the uploaded
+object is not an MD5 checksum (e.g. for server-side encryption with
+KMS or customer keys, or for some S3-compatible object stores), the
+SHA256 checksum of the object is compared instead, like
+:func:`dcor_shared.s3.upload_file` does.
+"""
+import hashlib
+import io
+import logging
+import pathlib
+import time
+
+from boto3.s3.transfer import TransferConfig
+from ckan import common
+from dcor_shared import is_resource_private, s3, s3cc
+
+
+logger = logging.getLogger(__name__)
+
+#: Limits of S3 multipart uploads
+MULTIPART_MIN_PART_SIZE = 5 * 1024**2
+MULTIPART_MAX_PART_SIZE = 5 * 1024**3
+MULTIPART_MAX_PARTS = 10000
+
+
+class ChecksumReader:
+    """Read-only file wrapper that computes checksums while reading
+
+    The MD5 checksums of the whole file and of all parts of `part_size`
+    bytes are computed, so that the ETag of an uploaded S3 object can
+    be verified (see :func:`get_etags`). The SHA256 checksum of the
+    whole file is computed as well (see :func:`get_sha256`). The
+    wrapper is not seekable, which makes boto3 read the data exactly
+    once and in order.
+    """
+
+    def __init__(self, fileobj, part_size: int):
+        self.fileobj = fileobj
+        self.part_size = part_size
+        #: Number of bytes read so far
+        self.size = 0
+        self._md5 = hashlib.md5(usedforsecurity=False)
+        self._sha256 = hashlib.sha256()
+        self._part_md5 = hashlib.md5(usedforsecurity=False)
+        self._part_bytes = 0
+        self._part_digests = []
+
+    def read(self, amount: int = -1) -> bytes:
+        data = self.fileobj.read(amount)
+        self._md5.update(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            chunk = view[:self.part_size - self._part_bytes]
+            self._part_md5.update(chunk)
+            self._part_bytes += len(chunk)
+            view = view[len(chunk):]
+            if self._part_bytes == self.part_size:
+                self._part_digests.append(self._part_md5.digest())
+                self._part_md5 = hashlib.md5(usedforsecurity=False)
+                self._part_bytes = 0
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def get_etags(self) -> set:
+        """Return the possible ETags of the uploaded object
+
+        These are the MD5 sum of the data (regular upload) and the
+        MD5 sum of the concatenated MD5 sums of all parts followed
+        by the number of parts (multipart upload).
+        """
+        digests = list(self._part_digests)
+        if self._part_bytes or not digests:
+            digests.append(self._part_md5.digest())
+        multipart = hashlib.md5(b"".join(digests), usedforsecurity=False)
+        return {self._md5.hexdigest(),
+                f"{multipart.hexdigest()}-{len(digests)}"}
+
+    def get_sha256(self) -> str:
+        """Return the SHA256 checksum of the data"""
+        return self._sha256.hexdigest()
+
+
+def get_part_size(size: int) -> int:
+    """Return the part size for uploading `size` bytes
+
+    This is ``ckanext.dc_serve.upload_part_size`` within the limits
+    of S3 multipart uploads.
+    """
+    part_size = common.asint(common.config.get(
+        "ckanext.dc_serve.upload_part_size", 64 * 1024**2))
+    part_size = min(max(part_size, MULTIPART_MIN_PART_SIZE),
+                    MULTIPART_MAX_PART_SIZE)
+    while part_size * MULTIPART_MAX_PARTS < size:
+        part_size *= 2
+    return part_size
+
+
+def upload_artifact(resource_id: str, artifact: str, source,
+                    private: bool = None) -> None:
+    """Upload an artifact to S3, replacing an existing object
+
+    Parameters
+    ----------
+    resource_id: str
+        The resource identifier for the artifact
+    artifact: str
+        The artifact type (e.g. "condensed" or "kernel")
+    source: str or pathlib.Path or bytes
+        Path to the artifact file or its content
+    private: bool
+        Whether the dataset that the resource belongs to is private;
+        looked up in the database if not specified
+
+    Objects of resources in public datasets are tagged public (see
+    :func:`dcor_shared.s3.make_object_public`). A ValueError is
+    raised if the checksum of the uploaded object does not match.
+    """
+    if private is None:
+        private = is_resource_private(resource_id)
+    if isinstance(source, bytes):
+        size = len(source)
+        fd = io.BytesIO(source)
+    else:
+        size = pathlib.Path(source).stat().st_size
+        fd = pathlib.Path(source).open("rb")
+    part_size = get_part_size(size)
+    concurrency = max(1, common.asint(common.config.get(
+        "ckanext.dc_serve.upload_max_concurrency", 4)))
+    config = TransferConfig(multipart_threshold=part_size,
+                            multipart_chunksize=part_size,
+                            max_concurrency=concurrency,
+                            use_threads=concurrency > 1)
+
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact=artifact)
+    s3_client, _, _ = s3.get_s3()
+    s3.require_bucket(bucket_name)
+    t0 = time.perf_counter()
+    with fd:
+        reader = ChecksumReader(fd, part_size=part_size)
+        s3_client.upload_fileobj(reader, bucket_name, object_name,
+                                 Config=config)
+    duration = time.perf_counter() - t0
+
+    if reader.size != size:
+        raise ValueError(f"Could not read {size} bytes for "
+                         f"{bucket_name}:{object_name}!")
+    meta = s3cc.get_s3_attributes_for_artifact(resource_id=resource_id,
+                                               artifact=artifact)
+    if meta.get("etag", "").strip('"') not in reader.get_etags():
+        # The ETag is not an MD5 checksum, download the object.
+        logger.info(f"Verifying {bucket_name}:{object_name} via SHA256")
+        s3_sha256 = s3.compute_checksum(bucket_name=bucket_name,
+                                        object_name=object_name,
+                                        max_size=size)
+        if s3_sha256 != reader.get_sha256():
+            raise ValueError(
+                f"Checksum mismatch for {bucket_name}:{object_name}!")
+    if not private:
+        s3.make_object_public(bucket_name=bucket_name,
+                              object_name=object_name)
+    logger.info(f"Uploaded {artifact} of {resource_id}: "
+                f"{size / 1024**2:.1f} MiB in {duration:.2f}s "
+                f"({size / 1024**2 / max(duration, 1e-9):.1f} MiB/s, "
+                f"{-(-size // part_size)} part(s) of "
+                f"{part_size / 1024**2:.0f} MiB, concurrency {concurrency})")